@@ -0,0 +1,56 @@
+"""
+Микро-бенчмарк кодеков сообщений JIM (common/codecs).
+Сравнивает время кодирования/декодирования и размер на проводе
+для типичных сообщений протокола.
+Запуск: python benchmarks/bench_codecs.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.codecs import AVAILABLE_CODECS
+from common.utils import encode_message, MessageBuffer
+from common.variables import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, MESSAGE, SENDER, MESSAGE_RECEIVER, \
+    MESSAGE_TEXT, RESPONSE, LIST_INFO, DATA, CODECS
+from benchmarks.timing import measure, print_table
+
+# Типичные сообщения протокола
+MESSAGES = {
+    'presence': {ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: 'test_user_1'},
+                 CODECS: ['orjson', 'msgpack', 'json']},
+    'message': {ACTION: MESSAGE, SENDER: 'test_user_1', MESSAGE_RECEIVER: 'test_user_2', TIME: time.time(),
+                MESSAGE_TEXT: 'Привет! Как дела? ' * 4},
+    'response_200': {RESPONSE: 200},
+    'response_511': {RESPONSE: 511, DATA: 'a1b2c3d4' * 16},
+    'users_1000': {RESPONSE: 202, LIST_INFO: [f'test_user_{i}' for i in range(1000)]},
+}
+
+
+def run(number=10000):
+    """Функция замеров, возвращает список результатов."""
+    results = []
+    for name, message in MESSAGES.items():
+        # Длинный список пользователей замеряем меньшее число раз
+        count = number // 100 if name == 'users_1000' else number
+        for codec in AVAILABLE_CODECS:
+            frame = encode_message(message, codec)
+            buffer = MessageBuffer()
+            results.append({
+                'message': name,
+                'codec': codec.name,
+                'bytes': len(frame),
+                'encode_us': measure(lambda: encode_message(message, codec), count),
+                'decode_us': measure(lambda: buffer.feed(frame), count),
+            })
+    return results
+
+
+if __name__ == '__main__':
+    results = run()
+    print_table('Кодеки JIM (мкс на сообщение, размер кадра в байтах)',
+                [(r['message'], r['codec'], r['bytes'], f"{r['encode_us']:.2f}", f"{r['decode_us']:.2f}")
+                 for r in results],
+                ['сообщение', 'кодек', 'байт', 'кодирование', 'декодирование'])
@@ -0,0 +1,112 @@
+"""
+Микро-бенчмарк декораторов common/proj_decorators.
+func_to_log: накладные расходы на вызов без декоратора, прежняя
+реализация (обход стека и форматирование на каждый вызов),
+текущая - при уровне DEBUG, при уровне INFO и при выключенном
+логировании вызовов.
+login_required: проверка авторизованного сокета среди 1000
+клиентов, сообщения presence и вызов не от сервера.
+Запуск: python benchmarks/bench_decorators.py
+"""
+
+import os
+import sys
+import socket
+import logging
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.proj_decorators import func_to_log, login_required, set_call_logging
+from common.variables import ACTION, PRESENCE
+from benchmarks.timing import measure, print_table
+
+BENCH_LOG = logging.getLogger('app.client')
+
+
+def legacy_func_to_log(func):
+    """Прежняя реализация декоратора - для сравнения."""
+    def log_writer(*args, **kwargs):
+        ret = func(*args, **kwargs)
+        BENCH_LOG.debug(f'Вызываем функцию {func.__name__} c параметрами {args}, {kwargs} '
+                        f'из функции {traceback.format_stack()[0].strip().split()[-1]} модуля {func.__module__}.')
+        return ret
+    return log_writer
+
+
+def target(sock, message):
+    return message
+
+
+class BenchServer:
+    """Сервер с авторизованными клиентами - для login_required."""
+
+    def __init__(self, client_names):
+        self.client_names = client_names
+
+    def plain(self, message, sock):
+        return message
+
+    @login_required
+    def checked(self, message, sock):
+        return message
+
+
+def run_login_required(number=100000):
+    """Функция замеров login_required, возвращает список результатов."""
+    sockets = [socket.socket() for _ in range(1000)]
+    try:
+        server = BenchServer({sock: f'test_user_{i}' for i, sock in enumerate(sockets)})
+        sock = sockets[-1]
+        message = {ACTION: 'message'}
+        presence = {ACTION: PRESENCE}
+        checked = login_required(target)
+        return [
+            {'decorator': 'login_required', 'variant': 'без декоратора',
+             'call_us': measure(lambda: server.plain(message, sock), number)},
+            {'decorator': 'login_required', 'variant': 'авторизованный сокет',
+             'call_us': measure(lambda: server.checked(message, sock), number)},
+            {'decorator': 'login_required', 'variant': 'сообщение presence',
+             'call_us': measure(lambda: server.checked(presence, None), number)},
+            {'decorator': 'login_required', 'variant': 'вызов не от сервера',
+             'call_us': measure(lambda: checked(sock, message), number)},
+        ]
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+def run(number=100000):
+    """Функция замеров, возвращает список результатов."""
+    # Записи уровня DEBUG создаются, но никуда не выводятся
+    BENCH_LOG.handlers = [logging.NullHandler()]
+    BENCH_LOG.propagate = False
+    message = {'action': 'message', 'from': 'test_user_1', 'to': 'test_user_2', 'mess_text': 'Привет!'}
+    legacy = legacy_func_to_log(target)
+    current = func_to_log(target)
+    results = [{'variant': 'без декоратора', 'call_us': measure(lambda: target(None, message), number)}]
+    for level in (logging.DEBUG, logging.INFO):
+        BENCH_LOG.setLevel(level)
+        results.append({'variant': f'прежний, {logging.getLevelName(level)}',
+                        'call_us': measure(lambda: legacy(None, message), number // 10)})
+        results.append({'variant': f'текущий, {logging.getLevelName(level)}',
+                        'call_us': measure(lambda: current(None, message), number)})
+    set_call_logging(False)
+    try:
+        results.append({'variant': 'текущий, выключен',
+                        'call_us': measure(lambda: current(None, message), number)})
+        # Выключенное до декорирования логирование - функция без обёртки
+        bare = func_to_log(target)
+        results.append({'variant': 'выключен до декорирования',
+                        'call_us': measure(lambda: bare(None, message), number)})
+    finally:
+        set_call_logging(True)
+    return [{'decorator': 'func_to_log', **result} for result in results] + run_login_required(number)
+
+
+if __name__ == '__main__':
+    results = run()
+    for decorator in ('func_to_log', 'login_required'):
+        print_table(f'Декоратор {decorator} (мкс на вызов)',
+                    [(r['variant'], f"{r['call_us']:.3f}") for r in results if r['decorator'] == decorator],
+                    ['вариант', 'вызов'])
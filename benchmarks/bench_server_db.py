@@ -0,0 +1,170 @@
+"""
+Микро-бенчмарк методов хранилища сервера (server/server_db) на базе
+со 100 000 пользователей. База заполняется пакетными вставками во
+временном каталоге: у тысячи пользователей по 10 контактов, у каждого
+пользователя одна запись в истории входов. Изменяющие методы замеряются
+парами, возвращающими базу в исходное состояние (вход и выход,
+добавление и удаление контакта и т.п.).
+Запуск: python benchmarks/bench_server_db.py [число пользователей]
+"""
+
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import select, func
+
+from server.server_db import ServerStorage
+from benchmarks.timing import measure, print_table
+
+USERS = 100000
+# Пользователи с контактами и число контактов у каждого
+USERS_WITH_CONTACTS = 1000
+CONTACTS_PER_USER = 10
+# Участники тестовой комнаты
+ROOM_MEMBERS = 100
+# Размер пакета вставки при заполнении базы
+SEED_BATCH = 10000
+
+
+def user_name(i):
+    return f'test_user_{i}'
+
+
+def seed(database, users):
+    '''Заполнение базы пакетными вставками, минуя add_user (по транзакции на пользователя).'''
+    tables = database.metadata.tables
+    now = datetime.datetime.now()
+    with database.database_engine.begin() as conn:
+        for start in range(0, users, SEED_BATCH):
+            ids = range(start + 1, min(start + SEED_BATCH, users) + 1)
+            conn.execute(tables['Users'].insert(), [
+                {'id': i, 'name': user_name(i), 'last_login': now, 'passwd_hash': f'hash_{i}'} for i in ids])
+            conn.execute(tables['History'].insert(), [{'user': i, 'sent': 0, 'accepted': 0} for i in ids])
+            conn.execute(tables['Users_changes'].insert(), [{'name': user_name(i), 'removed': False} for i in ids])
+            conn.execute(tables['Login_history'].insert(), [
+                {'name': i, 'date_time': now, 'ip': '127.0.0.1', 'port': '7777'} for i in ids])
+        conn.execute(tables['Contacts'].insert(), [
+            {'user': i, 'contact': (i * 7 + j) % users + 1}
+            for i in range(1, USERS_WITH_CONTACTS + 1) for j in range(1, CONTACTS_PER_USER + 1)])
+    database.revision = database.session.execute(select(func.max(tables['Users_changes'].c.id))).scalar()
+    database.session.commit()
+
+
+def run(users=USERS, number=200):
+    '''Функция замеров, возвращает список результатов.'''
+    work_dir = tempfile.mkdtemp(prefix='bench_server_db_')
+    try:
+        database = ServerStorage(os.path.join(work_dir, 'bench_server.db3'))
+        try:
+            seed(database, users)
+            return measure_methods(database, users, number)
+        finally:
+            database.database_engine.dispose()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def measure_methods(database, users, number):
+    '''Замеры методов на заполненной базе.'''
+    sender, recipient = user_name(1), user_name(2)
+    middle = user_name(users // 2)
+    counter = itertools.count()
+    room = 'bench_room'
+    database.create_room(room, sender)
+    for i in range(2, ROOM_MEMBERS + 1):
+        database.join_room(room, user_name(i))
+    members = list(database.room_members(room))
+    message = {'action': 'message', 'from': sender, 'to': recipient, 'mess_text': 'Привет!'}
+    since = database.users_revision() - 10
+
+    def login_logout():
+        database.user_login(middle, '127.0.0.1', 7777)
+        database.user_logout(middle)
+
+    def add_remove_user():
+        name = f'bench_user_{next(counter)}'
+        database.add_user(name, b'hash')
+        database.remove_user(name)
+
+    def add_remove_contact():
+        database.add_contact(sender, middle)
+        database.remove_contact(sender, middle)
+
+    def create_room():
+        database.create_room(f'bench_room_{next(counter)}', sender)
+
+    def join_leave_room():
+        database.join_room(room, middle)
+        database.leave_room(room, middle)
+
+    def store_pop_offline():
+        database.store_offline_messages(middle, [message])
+        database.pop_offline_messages(middle)
+
+    def store_broadcast_pop():
+        database.store_offline_broadcast(members, message)
+        for member in members:
+            database.pop_offline_messages(member)
+
+    def check_user_miss():
+        # Промах кэша - пользователь читается из базы
+        database.users_cache.pop(middle, None)
+        database.check_user(middle)
+
+    def process_message_flush():
+        database.process_message(sender, recipient)
+        database.flush_stats()
+
+    def room_message_flush():
+        database.process_room_message(sender, members)
+        database.flush_stats()
+
+    # (метод, функция замера, число вызовов)
+    cases = [
+        ('check_user', lambda: database.check_user(middle), number * 10),
+        ('check_user (промах кэша)', check_user_miss, number),
+        ('check_user (нет такого)', lambda: database.check_user('unknown'), number),
+        ('get_hash', lambda: database.get_hash(middle), number * 10),
+        ('users_revision', database.users_revision, number * 10),
+        ('users_changes (10 изменений)', lambda: database.users_changes(since), number),
+        ('user_login + user_logout', login_logout, number),
+        ('add_user + remove_user', add_remove_user, number // 4),
+        ('add_contact + remove_contact', add_remove_contact, number),
+        ('get_contacts', lambda: database.get_contacts(sender), number),
+        ('process_message (в память)', lambda: database.process_message(sender, recipient), number * 10),
+        ('process_message + flush_stats', process_message_flush, number),
+        (f'process_room_message ({ROOM_MEMBERS}) + flush_stats', room_message_flush, number),
+        ('flush_stats_if_due', database.flush_stats_if_due, number * 10),
+        ('store_offline_messages + pop_offline_messages', store_pop_offline, number),
+        (f'store_offline_broadcast ({ROOM_MEMBERS}) + pop', store_broadcast_pop, number // 10),
+        ('pop_offline_messages (пусто)', lambda: database.pop_offline_messages(middle), number),
+        ('create_room', create_room, number),
+        ('join_room + leave_room', join_leave_room, number),
+        ('room_id', lambda: database.room_id(room), number),
+        (f'room_members ({ROOM_MEMBERS})', lambda: database.room_members(room), number * 10),
+        ('login_history (пользователь)', lambda: database.login_history(middle), number),
+        ('active_users_list', database.active_users_list, number),
+        (f'users_list ({users})', database.users_list, 1),
+        (f'login_history (все, {users})', database.login_history, 1),
+        (f'message_history ({users})', database.message_history, 1),
+        ('close', database.close, number),
+    ]
+    results = []
+    for name, case, count in cases:
+        # Долгие запросы по всей базе замеряем меньшее число раз
+        results.append({'method': name, 'calls': count,
+                        'call_us': measure(case, max(count, 1), repeat=3 if count > 1 else 2)})
+    return results
+
+
+if __name__ == '__main__':
+    results = run(int(sys.argv[1]) if len(sys.argv) > 1 else USERS)
+    print_table('Методы ServerStorage (мкс на вызов)',
+                [(r['method'], r['calls'], f"{r['call_us']:.1f}") for r in results],
+                ['метод', 'вызовов', 'вызов'])
@@ -0,0 +1,64 @@
+"""
+Микро-бенчмарк функций обмена сообщениями (common/utils):
+send_message и get_message на паре локальных сокетов (socketpair).
+Замер send_message включает чтение кадра получателем без разбора,
+замер get_message - отправку готового кадра без кодирования.
+Запуск: python benchmarks/bench_utils.py
+"""
+
+import os
+import sys
+import socket
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.codecs import AVAILABLE_CODECS
+from common.utils import encode_message, get_message, send_message, recv_exactly
+from benchmarks.bench_codecs import MESSAGES
+from benchmarks.timing import measure, print_table
+
+
+def run(number=10000):
+    """Функция замеров, возвращает список результатов."""
+    results = []
+    sender, receiver = socket.socketpair()
+    try:
+        for name, message in MESSAGES.items():
+            # Длинный список пользователей замеряем меньшее число раз
+            count = number // 100 if name == 'users_1000' else number
+            for codec in AVAILABLE_CODECS:
+                frame = encode_message(message, codec)
+                size = len(frame)
+
+                def send():
+                    send_message(sender, message, codec)
+                    recv_exactly(receiver, size)
+
+                def get():
+                    sender.sendall(frame)
+                    get_message(receiver)
+
+                def round_trip():
+                    send_message(sender, message, codec)
+                    get_message(receiver)
+
+                results.append({
+                    'message': name,
+                    'codec': codec.name,
+                    'bytes': size,
+                    'send_us': measure(send, count),
+                    'get_us': measure(get, count),
+                    'round_trip_us': measure(round_trip, count),
+                })
+    finally:
+        sender.close()
+        receiver.close()
+    return results
+
+
+if __name__ == '__main__':
+    results = run()
+    print_table('send_message/get_message на socketpair (мкс на сообщение)',
+                [(r['message'], r['codec'], r['bytes'], f"{r['send_us']:.2f}", f"{r['get_us']:.2f}",
+                  f"{r['round_trip_us']:.2f}") for r in results],
+                ['сообщение', 'кодек', 'байт', 'send_message', 'get_message', 'туда-обратно'])
@@ -0,0 +1,403 @@
+"""
+Нагрузочный тест сервера: пропускная способность и задержки.
+
+Регистрирует N пользователей во временной базе ServerStorage, запускает
+сервер (server.py --no_gui) отдельным процессом, открывает N соединений
+JIM на asyncio (без PyQt), проходит настоящую авторизацию (presence,
+запрос 511, ответ HMAC) и рассылает сообщения по заданной схеме.
+Отчёт: сообщений в секунду, задержки доставки p50/p99/p999, скорость
+подключения и авторизации, процессорное время и память сервера.
+
+Запуск: python benchmarks/load_test.py --users 200 --messages 100 --pattern pairs
+"""
+
+import os
+import sys
+import json
+import time
+import hmac
+import random
+import socket
+import asyncio
+import argparse
+import binascii
+import hashlib
+import shutil
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from common.utils import encode_message, decode_message, unpack_header, HEADER
+from common.codecs import DEFAULT_CODEC, CODECS_BY_NAME, codec_names
+from common.variables import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, RESPONSE, DATA, CODECS, CODEC, ERROR, \
+    MESSAGE, SENDER, MESSAGE_RECEIVER, MESSAGE_TEXT, REQUEST_ID, CREATE_ROOM, JOIN_ROOM, ROOM_MESSAGE, ROOM, EXIT, \
+    SLOW_CLIENT_POLICY
+
+# Схемы рассылки: pairs - каждый пишет своему напарнику, random - случайному
+# пользователю, room - все в одной комнате, сообщение получают все остальные
+PATTERNS = ('pairs', 'random', 'room')
+ROOM_NAME = 'load_test'
+PASSWORD = 'load_test'
+# Время ожидания запуска сервера и доставки последних сообщений (сек.)
+SERVER_START_TIMEOUT = 15
+DELIVERY_TIMEOUT = 30
+
+
+def password_hash(name):
+    '''Хэш пароля, как его вычисляет клиент (client/transport.py).'''
+    return binascii.hexlify(hashlib.pbkdf2_hmac('sha512', PASSWORD.encode('utf-8'),
+                                                name.lower().encode('utf-8'), 10000))
+
+
+def percentile(values, fraction):
+    '''Процентиль отсортированного списка (ближайший ранг).'''
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def process_usage(pid):
+    '''
+    Процессорное время (сек.) и память (Мб) процесса вместе с дочерними
+    (процессы-обработчики многопроцессного режима). Только Linux (/proc),
+    в других ОС - (None, None).
+    '''
+    if not os.path.isdir('/proc'):
+        return None, None
+    tick = os.sysconf('SC_CLK_TCK')
+    stats = dict()
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as file:
+                fields = file.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{entry}/status') as file:
+                rss = next((int(line.split()[1]) for line in file if line.startswith('VmRSS:')), 0)
+        except OSError:
+            continue
+        # Поля после имени: состояние, ppid, ..., utime и stime - 12 и 13
+        stats[int(entry)] = (int(fields[1]), (int(fields[11]) + int(fields[12])) / tick, rss / 1024)
+    tree = {pid}
+    changed = True
+    while changed:
+        children = {child for child, (ppid, _, _) in stats.items() if ppid in tree}
+        changed = not children <= tree
+        tree |= children
+    cpu = sum(stats[item][1] for item in tree if item in stats)
+    rss = sum(stats[item][2] for item in tree if item in stats)
+    return cpu, rss
+
+
+def free_port():
+    '''Свободный TCP порт на 127.0.0.1.'''
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def prepare_database(path, names):
+    '''Регистрация пользователей во временной базе сервера, возвращает их хэши паролей.'''
+    from server.server_db import ServerStorage
+    database = ServerStorage(path)
+    hashes = dict()
+    for name in names:
+        hashes[name] = password_hash(name)
+        database.add_user(name, hashes[name])
+    database.close()
+    database.database_engine.dispose()
+    return hashes
+
+
+def start_server(work_dir, port, options):
+    '''Запуск server.py без графического интерфейса в отдельном процессе.'''
+    with open(os.path.join(work_dir, 'server.ini'), 'w', encoding='utf-8') as file:
+        file.write(f'[SETTINGS]\ndatabase_path = {work_dir}\ndatabase_file = server_db.db3\n'
+                   f'default_port = {port}\nlisten_address = 127.0.0.1\n\n'
+                   f'[OUTBOX]\nslow_client_policy = {options.slow_client_policy}\n')
+    command = [sys.executable, os.path.join(ROOT, 'server.py'), '--no_gui', '-p', str(port), '-a', '127.0.0.1']
+    if options.asyncio:
+        command.append('--asyncio')
+    if options.workers > 1:
+        command += ['--workers', str(options.workers)]
+    process = subprocess.Popen(command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Сервер завершился при запуске с кодом {process.returncode}.')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('Сервер не начал принимать соединения.')
+
+
+class LoadClient:
+    '''Клиент нагрузочного теста: одно соединение JIM на asyncio.'''
+
+    def __init__(self, name, passwd_hash, stats):
+        self.name = name
+        self.passwd_hash = passwd_hash
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.codec = DEFAULT_CODEC
+        # Ожидающие ответа запросы: идентификатор -> Future
+        self.pending = dict()
+        self.request_id = 0
+        self.receive_task = None
+
+    async def read_message(self):
+        header = await self.reader.readexactly(HEADER.size)
+        length, codec = unpack_header(header)
+        return decode_message(await self.reader.readexactly(length), codec)
+
+    def write(self, message):
+        self.writer.write(encode_message(message, self.codec))
+
+    async def login(self, port, codec_name):
+        '''Подключение и авторизация, возвращает время от подключения до ответа 200.'''
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+        offered = [codec_name] if codec_name else codec_names()
+        self.write({ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: self.name}, CODECS: offered})
+        answer = await self.read_message()
+        if answer.get(RESPONSE) != 511:
+            raise ConnectionError(f'{self.name}: {answer.get(ERROR)}')
+        digest = hmac.new(self.passwd_hash, answer[DATA].encode('utf-8'), 'MD5').digest()
+        self.write({RESPONSE: 511, DATA: binascii.b2a_base64(digest).decode('ascii')})
+        answer = await self.read_message()
+        if answer.get(RESPONSE) != 200:
+            raise ConnectionError(f'{self.name}: {answer.get(ERROR)}')
+        self.codec = CODECS_BY_NAME.get(answer.get(CODEC), DEFAULT_CODEC)
+        self.receive_task = asyncio.create_task(self.receive())
+        return time.perf_counter() - start
+
+    async def receive(self):
+        '''Приём ответов на запросы и доставленных сообщений.'''
+        try:
+            while True:
+                message = await self.read_message()
+                if RESPONSE in message:
+                    future = self.pending.pop(message.get(REQUEST_ID), None)
+                    if future is not None and not future.done():
+                        future.set_result(message)
+                elif message.get(ACTION) in (MESSAGE, ROOM_MESSAGE):
+                    self.stats.delivered(time.time() - message[TIME])
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def request(self, message):
+        '''Отправка запроса, возвращает Future ответа.'''
+        self.request_id += 1
+        message[REQUEST_ID] = self.request_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.request_id] = future
+        self.write(message)
+        await self.writer.drain()
+        return future
+
+    async def send_messages(self, receivers, count, window, rate):
+        '''
+        Отправка count сообщений: не больше window запросов без ответа,
+        rate - сообщений в секунду (0 - без ограничения).
+        '''
+        in_flight = asyncio.Semaphore(window)
+        interval = 1 / rate if rate else 0
+        next_time = time.perf_counter()
+
+        def acknowledged(future, sent):
+            in_flight.release()
+            if not future.cancelled() and future.result().get(RESPONSE) == 200:
+                self.stats.acked(time.perf_counter() - sent)
+            else:
+                self.stats.errors += 1
+
+        for i in range(count):
+            if interval:
+                next_time += interval
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await in_flight.acquire()
+            receiver = receivers()
+            if receiver is None:
+                message = {ACTION: ROOM_MESSAGE, SENDER: self.name, ROOM: ROOM_NAME, TIME: time.time(),
+                           MESSAGE_TEXT: f'load test {i}'}
+            else:
+                message = {ACTION: MESSAGE, SENDER: self.name, MESSAGE_RECEIVER: receiver, TIME: time.time(),
+                           MESSAGE_TEXT: f'load test {i}'}
+            sent = time.perf_counter()
+            future = await self.request(message)
+            future.add_done_callback(lambda future, sent=sent: acknowledged(future, sent))
+        # Дожидаемся ответов на все запросы
+        for _ in range(window):
+            await in_flight.acquire()
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            self.write({ACTION: EXIT, TIME: time.time(), ACCOUNT_NAME: self.name})
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        if self.receive_task:
+            self.receive_task.cancel()
+        self.writer.close()
+
+
+class LoadStats:
+    '''Накопитель результатов нагрузочного теста.'''
+
+    def __init__(self):
+        self.delivery = []
+        self.ack = []
+        self.errors = 0
+        self.all_delivered = asyncio.Event()
+        self.expected = None
+
+    def delivered(self, latency):
+        self.delivery.append(latency)
+        if self.expected is not None and len(self.delivery) >= self.expected:
+            self.all_delivered.set()
+
+    def acked(self, latency):
+        self.ack.append(latency)
+
+
+async def drive(options, port, hashes):
+    '''Подключение клиентов и рассылка сообщений, возвращает результаты.'''
+    stats = LoadStats()
+    names = list(hashes)
+    clients = [LoadClient(name, hashes[name], stats) for name in names]
+    results = dict()
+
+    # Подключение и авторизация, не больше connect_concurrency одновременно
+    limit = asyncio.Semaphore(options.connect_concurrency)
+
+    async def login(client):
+        async with limit:
+            return await client.login(port, options.codec)
+
+    start = time.perf_counter()
+    auth_times = sorted(await asyncio.gather(*(login(client) for client in clients)))
+    connect_time = time.perf_counter() - start
+    results['connect_auth_per_s'] = len(clients) / connect_time
+    results['auth_p50_ms'] = percentile(auth_times, 0.5) * 1000
+    results['auth_p99_ms'] = percentile(auth_times, 0.99) * 1000
+
+    if options.pattern == 'room':
+        await (await clients[0].request({ACTION: CREATE_ROOM, TIME: time.time(), USER: names[0], ROOM: ROOM_NAME}))
+        await asyncio.gather(*[await client.request({ACTION: JOIN_ROOM, TIME: time.time(), USER: client.name,
+                                                     ROOM: ROOM_NAME}) for client in clients[1:]])
+        stats.expected = len(clients) * options.messages * (len(clients) - 1)
+    else:
+        stats.expected = len(clients) * options.messages
+
+    def receivers(index):
+        if options.pattern == 'pairs':
+            partner = names[index ^ 1] if index ^ 1 < len(names) else names[0]
+            return lambda: partner
+        if options.pattern == 'random':
+            return lambda: random.choice(names)
+        return lambda: None
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client.send_messages(receivers(index), options.messages, options.window, options.rate)
+                           for index, client in enumerate(clients)))
+    sent_time = time.perf_counter() - start
+    try:
+        await asyncio.wait_for(stats.all_delivered.wait(), DELIVERY_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    total_time = time.perf_counter() - start
+    await asyncio.gather(*(client.close() for client in clients))
+
+    delivery = sorted(stats.delivery)
+    ack = sorted(stats.ack)
+    results.update({
+        'sent': len(clients) * options.messages,
+        'acked': len(ack),
+        'errors': stats.errors,
+        'delivered': len(delivery),
+        'expected': stats.expected,
+        'send_per_s': len(ack) / sent_time,
+        'deliver_per_s': len(delivery) / total_time,
+        'ack_p50_ms': (percentile(ack, 0.5) or 0) * 1000,
+        'ack_p99_ms': (percentile(ack, 0.99) or 0) * 1000,
+        'latency_p50_ms': (percentile(delivery, 0.5) or 0) * 1000,
+        'latency_p99_ms': (percentile(delivery, 0.99) or 0) * 1000,
+        'latency_p999_ms': (percentile(delivery, 0.999) or 0) * 1000,
+    })
+    return results
+
+
+def run(options):
+    '''Функция нагрузочного теста, возвращает словарь результатов.'''
+    work_dir = tempfile.mkdtemp(prefix='jim_load_')
+    try:
+        # Лог сервера (и хранилища в этом процессе) пишется во временный каталог, а не в server/logs
+        os.environ['SERVER_LOG_FILE'] = os.path.join(work_dir, 'app.server.log')
+        os.environ['SERVER_LOG_LEVEL'] = options.log_level
+        names = [f'load_user_{i}' for i in range(options.users)]
+        hashes = prepare_database(os.path.join(work_dir, 'server_db.db3'), names)
+        port = free_port()
+        server = start_server(work_dir, port, options)
+        try:
+            cpu_before, _ = process_usage(server.pid)
+            results = asyncio.run(drive(options, port, hashes))
+            cpu_after, rss = process_usage(server.pid)
+        finally:
+            server.terminate()
+            try:
+                server.wait(SERVER_START_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                server.kill()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if cpu_after is not None:
+        results['server_cpu_s'] = cpu_after - cpu_before
+        results['server_rss_mb'] = rss
+    results['options'] = vars(options)
+    return results
+
+
+def arg_parser(args=None):
+    '''Парсер аргументов командной строки.'''
+    parser = argparse.ArgumentParser(description='Нагрузочный тест сервера JIM.')
+    parser.add_argument('--users', type=int, default=100, help='число клиентов')
+    parser.add_argument('--messages', type=int, default=100, help='сообщений от каждого клиента')
+    parser.add_argument('--pattern', choices=PATTERNS, default='pairs', help='схема рассылки')
+    parser.add_argument('--window', type=int, default=1, help='запросов без ответа на клиента')
+    parser.add_argument('--rate', type=float, default=0, help='сообщений в секунду на клиента, 0 - без ограничения')
+    parser.add_argument('--codec', choices=sorted(CODECS_BY_NAME), default=None,
+                        help='кодек (по умолчанию - выбор сервера)')
+    parser.add_argument('--connect-concurrency', type=int, default=100, help='одновременных авторизаций')
+    parser.add_argument('--asyncio', action='store_true', help='сервер на asyncio')
+    parser.add_argument('--workers', type=int, default=1, help='процессов сервера')
+    parser.add_argument('--slow-client-policy', default=SLOW_CLIENT_POLICY, help='политика для медленных клиентов')
+    parser.add_argument('--log-level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'), default='WARNING',
+                        help='уровень лога сервера (лог пишется во временный каталог)')
+    parser.add_argument('--json', help='файл для результатов в JSON')
+    return parser.parse_args(args)
+
+
+def print_results(results):
+    '''Вывод результатов теста.'''
+    for key, value in results.items():
+        if key != 'options':
+            print(f'{key:20} {value:.2f}' if isinstance(value, float) else f'{key:20} {value}')
+
+
+if __name__ == '__main__':
+    options = arg_parser()
+    results = run(options)
+    print_results(results)
+    if options.json:
+        with open(options.json, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
@@ -0,0 +1,126 @@
+"""
+Запуск всех микро-бенчмарков с сохранением результатов в JSON и
+сравнением с результатами прошлого прогона (например, прошлого релиза).
+При сравнении отмечаются замеры, ставшие медленнее порога, и программа
+завершается с кодом 1, если такие есть.
+Запуск: python benchmarks/run_all.py [--json new.json] [--compare old.json] [--quick] [бенчмарки]
+"""
+
+import os
+import sys
+import json
+import argparse
+import platform
+import datetime
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from benchmarks import bench_codecs, bench_decorators, bench_server_db, bench_utils
+from benchmarks.timing import print_table
+
+# Бенчмарки: имя -> функция запуска (полный и быстрый прогон)
+BENCHMARKS = {
+    'codecs': lambda quick: bench_codecs.run(1000 if quick else 10000),
+    'utils': lambda quick: bench_utils.run(1000 if quick else 10000),
+    'decorators': lambda quick: bench_decorators.run(10000 if quick else 100000),
+    'server_db': lambda quick: bench_server_db.run(10000, 20) if quick else bench_server_db.run(),
+}
+# Во сколько раз замер может стать медленнее, не считаясь регрессией
+THRESHOLD = 1.2
+
+
+def git_revision():
+    '''Текущая ревизия git или None, если она недоступна.'''
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names, quick=False):
+    '''Функция запуска бенчмарков names, возвращает словарь для сохранения в JSON.'''
+    results = dict()
+    for name in names:
+        print(f'Бенчмарк {name}...', file=sys.stderr)
+        results[name] = BENCHMARKS[name](quick)
+    return {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': quick,
+        },
+        'results': results,
+    }
+
+
+def row_key(row):
+    '''Ключ замера для сравнения: все поля, кроме времени (*_us).'''
+    return tuple((key, value) for key, value in row.items() if not key.endswith('_us'))
+
+
+def compare(old, new, threshold=THRESHOLD):
+    '''
+    Функция сравнения двух прогонов. Возвращает список строк
+    (бенчмарк, замер, поле, было, стало, отношение, отметка регрессии).
+    Замеры, которых нет в одном из прогонов, пропускаются.
+    '''
+    rows = []
+    for name, new_rows in new['results'].items():
+        old_rows = {row_key(row): row for row in old['results'].get(name, [])}
+        for row in new_rows:
+            old_row = old_rows.get(row_key(row))
+            if old_row is None:
+                continue
+            label = ', '.join(str(value) for _, value in row_key(row))
+            for field, value in row.items():
+                if field.endswith('_us') and old_row.get(field):
+                    ratio = value / old_row[field]
+                    rows.append((name, label, field, old_row[field], value, ratio, ratio > threshold))
+    return rows
+
+
+def arg_parser(args=None):
+    '''Парсер аргументов командной строки.'''
+    parser = argparse.ArgumentParser(description='Микро-бенчмарки с результатами в JSON.')
+    parser.add_argument('names', nargs='*', metavar='бенчмарк',
+                        help=f'бенчмарки для запуска: {", ".join(BENCHMARKS)} (по умолчанию - все)')
+    parser.add_argument('--json', help='файл для результатов')
+    parser.add_argument('--compare', help='файл с результатами прошлого прогона для сравнения')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='порог регрессии (отношение времён)')
+    parser.add_argument('--quick', action='store_true', help='быстрый прогон: меньше вызовов и пользователей')
+    options = parser.parse_args(args)
+    unknown = [name for name in options.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f'неизвестные бенчмарки: {", ".join(unknown)}')
+    return options
+
+
+def main():
+    options = arg_parser()
+    report = run(options.names or list(BENCHMARKS), options.quick)
+    if options.json:
+        with open(options.json, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    if not options.compare:
+        for name, rows in report['results'].items():
+            print_table(f'{name} (мкс на вызов)',
+                        [tuple(f'{value:.2f}' if isinstance(value, float) else value for value in row.values())
+                         for row in rows], list(rows[0]))
+        return 0
+    with open(options.compare, encoding='utf-8') as file:
+        old = json.load(file)
+    rows = compare(old, report, options.threshold)
+    print_table(f'Сравнение с {old["meta"].get("revision")} ({old["meta"].get("date")})',
+                [(name, label, field, f'{before:.2f}', f'{after:.2f}', f'{ratio:.2f}', '!' if regression else '')
+                 for name, label, field, before, after, ratio, regression in rows],
+                ['бенчмарк', 'замер', 'поле', 'было', 'стало', 'отношение', 'регрессия'])
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,23 @@
+"""Общие функции замеров для микро-бенчмарков."""
+
+import timeit
+
+
+def measure(func, number=10000, repeat=5):
+    """
+    Функция замера времени одного вызова func (без аргументов).
+    Возвращает лучшее из repeat измерений, в микросекундах на вызов.
+    """
+    timer = timeit.Timer(func)
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1e6
+
+
+def print_table(title, rows, columns):
+    """Функция вывода результатов замеров таблицей."""
+    print(title)
+    widths = [max(len(str(column)), *(len(str(row[i])) for row in rows)) for i, column in enumerate(columns)]
+    print('  '.join(str(column).ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(value).ljust(width) for value, width in zip(row, widths)))
+    print()
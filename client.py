@@ -114,11 +114,13 @@ def main():
         print(error.text)
         exit(1)
     transport.setDaemon(True)
-    transport.start()
 
     # Создаём GUI
     main_window = ClientMainWindow(database, transport)
     main_window.make_connection(transport)
+    # Транспорт запускаем после подключения сигналов, чтобы сообщения,
+    # полученные при входе, попали в интерфейс
+    transport.start()
     main_window.setWindowTitle(f'Чат Программа alpha release - {client_name}')
     client_app.exec_()
 
@@ -1,4 +1,6 @@
-from sqlalchemy import create_engine, Table, Column, Integer, String, Text, MetaData, DateTime
+from sqlalchemy import create_engine, Table, Column, Integer, String, Text, MetaData, DateTime, Index, select, \
+    exists, bindparam, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import mapper, sessionmaker
 import os
 import sys
@@ -35,6 +37,12 @@ class ClientDatabase:
             self.id = None
             self.name = contact
 
+    # Класс - отображение таблицы состояния синхронизации
+    class SyncState:
+        def __init__(self, name, revision):
+            self.name = name
+            self.revision = revision
+
     # Конструктор класса:
     def __init__(self, name):
         # Создаём движок базы данных, поскольку разрешено несколько клиентов одновременно,
@@ -55,8 +63,9 @@ class ClientDatabase:
         # Создаём таблицу известных пользователей
         users = Table('known_users', self.metadata,
                       Column('id', Integer, primary_key=True),
-                      Column('username', String)
+                      Column('username', String, index=True)
                       )
+        self.users_table = users
 
         # Создаём таблицу истории сообщений
         history = Table('message_history', self.metadata,
@@ -64,22 +73,38 @@ class ClientDatabase:
                         Column('contact', String),
                         Column('direction', String),
                         Column('message', Text),
-                        Column('date', DateTime)
+                        Column('date', DateTime),
+                        # Страница истории по контакту читается по индексу
+                        # в порядке даты (и id - он входит в индекс неявно)
+                        Index('ix_message_history_contact_date', 'contact', 'date')
                         )
+        self.history_table = history
 
         # Создаём таблицу контактов
         contacts = Table('contacts', self.metadata,
                          Column('id', Integer, primary_key=True),
                          Column('name', String, unique=True)
                          )
+        self.contacts_table = contacts
+
+        # Создаём таблицу состояния синхронизации с сервером: ревизии
+        # загруженных списков (список известных пользователей)
+        sync_state = Table('sync_state', self.metadata,
+                           Column('name', String, primary_key=True),
+                           Column('revision', Integer)
+                           )
 
         # Создаём таблицы
         self.metadata.create_all(self.database_engine)
+        # В базе, созданной прежней версией, таблицы уже есть, а индексов нет
+        for index in users.indexes | history.indexes:
+            index.create(bind=self.database_engine, checkfirst=True)
 
         # Создаём отображения
         mapper(self.KnownUsers, users)
         mapper(self.MessageHistory, history)
         mapper(self.Contacts, contacts)
+        mapper(self.SyncState, sync_state)
 
         # Создаём сессию
         Session = sessionmaker(bind=self.database_engine)
@@ -89,12 +114,20 @@ class ClientDatabase:
         self.session.query(self.Contacts).delete()
         self.session.commit()
 
-    # Функция добавления контактов
+    # Функция добавления контактов, дубль отсекает уникальный индекс
     def add_contact(self, contact):
-        if not self.session.query(self.Contacts).filter_by(name=contact).count():
-            contact_row = self.Contacts(contact)
-            self.session.add(contact_row)
-            self.session.commit()
+        self.session.execute(
+            sqlite_insert(self.contacts_table).values(name=contact).on_conflict_do_nothing())
+        self.session.commit()
+
+    # Функция замены списка контактов полученным с сервера (одна транзакция)
+    def set_contacts(self, contacts_list):
+        self.session.execute(self.contacts_table.delete())
+        if contacts_list:
+            self.session.execute(
+                sqlite_insert(self.contacts_table).on_conflict_do_nothing(),
+                [{'name': contact} for contact in contacts_list])
+        self.session.commit()
 
     def contacts_clear(self):
         """ Метод, очищающий таблицу со списком контактов. """
@@ -108,18 +141,59 @@ class ClientDatabase:
 
     # Функция добавления известных пользователей.
     # Пользователи получаются только с сервера, поэтому таблица очищается.
-    def add_users(self, users_list):
-        self.session.query(self.KnownUsers).delete()
-        for user in users_list:
-            user_row = self.KnownUsers(user)
-            self.session.add(user_row)
+    # Вставка одним пакетным запросом в одной транзакции.
+    # epoch - эпоха базы сервера, к которой относится ревизия.
+    def add_users(self, users_list, revision=0, epoch=0):
+        self.session.execute(self.users_table.delete())
+        if users_list:
+            self.session.execute(self.users_table.insert(), [{'username': user} for user in users_list])
+        self.set_revision('known_users', revision)
+        self.set_revision('known_users_epoch', epoch)
         self.session.commit()
 
-    # Функция, сохраняющая сообщения
+    # Функция, применяющая изменения списка известных пользователей,
+    # полученные с сервера. Удалённые пользователи удаляются и из контактов.
+    def apply_users_changes(self, revision, added, removed):
+        users = self.users_table
+        contacts = self.contacts_table
+        # Пакетные запросы, по строке параметров на пользователя
+        if added:
+            self.session.execute(
+                users.insert().from_select(
+                    ['username'],
+                    select(bindparam('name', type_=String)).where(
+                        ~exists().where(users.c.username == bindparam('name')))),
+                [{'name': user} for user in dict.fromkeys(added)])
+        if removed:
+            names = [{'name': user} for user in removed]
+            self.session.execute(users.delete().where(users.c.username == bindparam('name')), names)
+            self.session.execute(contacts.delete().where(contacts.c.name == bindparam('name')), names)
+        self.set_revision('known_users', revision)
+        self.session.commit()
+
+    # Функция, сохраняющая ревизию списка (без фиксации транзакции)
+    def set_revision(self, name, revision):
+        self.session.merge(self.SyncState(name, revision))
+
+    # Функция, возвращающая ревизию списка известных пользователей
+    def get_users_revision(self):
+        row = self.session.query(self.SyncState.revision).filter_by(name='known_users').first()
+        return row[0] if row else 0
+
+    # Функция, возвращающая эпоху базы сервера, к которой относится ревизия
+    # (0 - неизвестна, например список загружен прежней версией)
+    def get_users_epoch(self):
+        row = self.session.query(self.SyncState.revision).filter_by(name='known_users_epoch').first()
+        return row[0] if row else 0
+
+    # Функция, сохраняющая сообщения. Возвращает запись в том же виде,
+    # что и get_history, чтобы окно могло добавить её без перечитывания истории.
     def save_message(self, contact, direction, message):
-        message_row = self.MessageHistory(contact, direction, message)
-        self.session.add(message_row)
+        date = datetime.datetime.now()
+        result = self.session.execute(self.history_table.insert().values(
+            contact=contact, direction=direction, message=message, date=date))
         self.session.commit()
+        return contact, direction, message, date, result.inserted_primary_key[0]
 
     # Функция, возвращающая контакты
     def get_contacts(self):
@@ -131,25 +205,32 @@ class ClientDatabase:
 
     # Функция, проверяющая наличие пользователя в известных
     def check_user(self, user):
-        if self.session.query(self.KnownUsers).filter_by(username=user).count():
+        if self.session.query(self.KnownUsers.id).filter_by(username=user).first():
             return True
         else:
             return False
 
     # Функция, проверяющая наличие пользователя контактах
     def check_contact(self, contact):
-        if self.session.query(self.Contacts).filter_by(name=contact).count():
+        if self.session.query(self.Contacts.id).filter_by(name=contact).first():
             return True
         else:
             return False
 
-    # Функция, возвращающая историю переписки
-    def get_history(self, contact):
-        query = self.session.query(self.MessageHistory).filter_by(contact=contact)
-        return [(history_row.contact, history_row.direction,
-                 history_row.message, history_row.date)
-                for history_row in query.all()]
-
+    # Функция, возвращающая историю переписки в порядке даты.
+    # limit - не больше стольких последних сообщений, before - курсор
+    # (дата, id) самого старого уже загруженного сообщения: выдаются
+    # сообщения старше него. Запрос читает только нужную страницу индекса.
+    def get_history(self, contact, limit=None, before=None):
+        history = self.history_table
+        query = select(history.c.contact, history.c.direction, history.c.message, history.c.date,
+                       history.c.id).where(history.c.contact == contact)
+        if before is not None:
+            query = query.where(tuple_(history.c.date, history.c.id) < tuple_(*before))
+        query = query.order_by(history.c.date.desc(), history.c.id.desc()).limit(limit)
+        rows = self.session.execute(query).all()
+        rows.reverse()
+        return [tuple(row) for row in rows]
 
 # отладка
 if __name__ == '__main__':
@@ -166,6 +247,6 @@ if __name__ == '__main__':
     print(test_db.get_users())
     print(test_db.check_user('test1'))
     print(test_db.check_user('test10'))
-    print(sorted(test_db.get_history('test2'), key=lambda item: item[3]))
+    print(test_db.get_history('test2'))
     test_db.del_contact('test4')
     print(test_db.get_contacts())
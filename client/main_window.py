@@ -1,6 +1,6 @@
 import os
 
-from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QApplication
+from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QApplication, QAbstractItemView
 from PyQt5.QtGui import QStandardItemModel, QStandardItem, QBrush, QColor
 from PyQt5.QtCore import pyqtSlot, Qt
 import sys
@@ -8,7 +8,7 @@ import logging
 import client.logs.client_log_config
 
 # sys.path.append('../')
-from common.variables import SENDER, MESSAGE, MESSAGE_TEXT
+from common.variables import SENDER, MESSAGE, MESSAGE_TEXT, HISTORY_PAGE_SIZE, HISTORY_VIEW_LIMIT
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 
@@ -50,10 +50,14 @@ class ClientMainWindow(QMainWindow):
         # Дополнительные требующиеся атрибуты
         self.contacts_model = None
         self.history_model = None
+        # Признак того, что история текущего чата загружена полностью
+        self.history_complete = True
         self.messages = QMessageBox()
         self.current_chat = None  # Текущий контакт с которым идёт обмен сообщениями
         self.ui.list_messages.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.ui.list_messages.setWordWrap(True)
+        # При прокрутке к началу подгружаются более старые сообщения
+        self.ui.list_messages.verticalScrollBar().valueChanged.connect(self.history_scrolled)
 
         # Double click по списку контактов отправляется в обработчик
         self.ui.list_contacts.doubleClicked.connect(self.select_active_user)
@@ -70,47 +74,82 @@ class ClientMainWindow(QMainWindow):
         self.ui.text_message.clear()
         if self.history_model:
             self.history_model.clear()
+        self.history_complete = True
 
         # Поле ввода и кнопка отправки неактивны до выбора получателя.
         self.ui.btn_clear.setDisabled(True)
         self.ui.btn_send.setDisabled(True)
         self.ui.text_message.setDisabled(True)
 
-    # Заполняем историю сообщений.
+    # Создаёт элемент окна истории для сообщения, входящие и исходящие
+    # сообщения различаются выравниванием и фоном. В данных элемента
+    # хранится курсор сообщения для подгрузки более старых.
+    @staticmethod
+    def history_item(item):
+        if item[1] == 'in':
+            mess = QStandardItem(f'Входящее от {item[3].replace(microsecond=0)}:\n {item[2]}')
+            mess.setBackground(QBrush(QColor(255, 213, 213)))
+            mess.setTextAlignment(Qt.AlignLeft)
+        else:
+            mess = QStandardItem(f'Исходящее от {item[3].replace(microsecond=0)}:\n {item[2]}')
+            mess.setTextAlignment(Qt.AlignRight)
+            mess.setBackground(QBrush(QColor(204, 255, 204)))
+        mess.setEditable(False)
+        mess.setData(item[3:5], Qt.UserRole)
+        return mess
+
+    # Заполняем историю сообщений: последняя страница, более старые
+    # сообщения подгружаются при прокрутке вверх.
     def history_list_update(self):
-        # Получаем историю сортированную по дате
-        list_messages = sorted(self.database.get_history(self.current_chat),
-                               key=lambda item: item[3])
+        list_messages = self.database.get_history(self.current_chat, HISTORY_PAGE_SIZE)
         # Если модель не создана, создадим.
         if not self.history_model:
             self.history_model = QStandardItemModel()
             self.ui.list_messages.setModel(self.history_model)
         # Очистим от старых записей
         self.history_model.clear()
-        # Берём не более 20 последних записей.
-        length = len(list_messages)
-        start_index = 0
-        if length > 20:
-            start_index = length - 20
-        # Заполнение модели записями, так же стоит разделить входящие и исходящие
-        # сообщения выравниванием и разным фоном.
-        # Записи в обратном порядке, поэтому выбираем их с конца и не более 20
-        for i in range(start_index, length):
-            item = list_messages[i]
-            if item[1] == 'in':
-                mess = QStandardItem(f'Входящее от {item[3].replace(microsecond=0)}:\n {item[2]}')
-                mess.setEditable(False)
-                mess.setBackground(QBrush(QColor(255, 213, 213)))
-                mess.setTextAlignment(Qt.AlignLeft)
-                self.history_model.appendRow(mess)
-            else:
-                mess = QStandardItem(f'Исходящее от {item[3].replace(microsecond=0)}:\n {item[2]}')
-                mess.setEditable(False)
-                mess.setTextAlignment(Qt.AlignRight)
-                mess.setBackground(QBrush(QColor(204, 255, 204)))
-                self.history_model.appendRow(mess)
+        for item in list_messages:
+            self.history_model.appendRow(self.history_item(item))
+        self.history_complete = len(list_messages) < HISTORY_PAGE_SIZE
         self.ui.list_messages.scrollToBottom()
 
+    # Обработчик прокрутки окна истории
+    def history_scrolled(self, value):
+        if value == self.ui.list_messages.verticalScrollBar().minimum() and self.current_chat:
+            self.load_older_history()
+
+    # Подгрузка предыдущей страницы истории в начало окна
+    def load_older_history(self):
+        if self.history_complete or not self.history_model or not self.history_model.rowCount():
+            return
+        list_messages = self.database.get_history(
+            self.current_chat, HISTORY_PAGE_SIZE, before=self.history_model.item(0).data(Qt.UserRole))
+        self.history_complete = len(list_messages) < HISTORY_PAGE_SIZE
+        if not list_messages:
+            return
+        for row, item in enumerate(list_messages):
+            self.history_model.insertRow(row, self.history_item(item))
+        # Оставляем на месте сообщение, которое было первым видимым
+        self.ui.list_messages.scrollTo(self.history_model.index(len(list_messages), 0),
+                                       QAbstractItemView.PositionAtTop)
+
+    # Добавление нового сообщения в конец окна истории без перестроения
+    # модели. Если окно прокручено до конца, оно остаётся в конце, а самые
+    # старые строки сверх HISTORY_VIEW_LIMIT убираются из окна.
+    def append_history(self, item):
+        if not self.history_model:
+            self.history_list_update()
+            return
+        scroll_bar = self.ui.list_messages.verticalScrollBar()
+        at_bottom = scroll_bar.value() == scroll_bar.maximum()
+        self.history_model.appendRow(self.history_item(item))
+        if at_bottom:
+            extra = self.history_model.rowCount() - HISTORY_VIEW_LIMIT
+            if extra > 0:
+                self.history_model.removeRows(0, extra)
+                self.history_complete = False
+            self.ui.list_messages.scrollToBottom()
+
     # Функция обработчик double click по контакту
     def select_active_user(self):
         # Выбранный пользователем контакт находится в выделенном элементе в QListView
@@ -221,9 +260,9 @@ class ClientMainWindow(QMainWindow):
             self.messages.critical(self, 'Ошибка', 'Потеряно соединение с сервером!')
             self.close()
         else:
-            self.database.save_message(self.current_chat, 'out', message_text)
+            item = self.database.save_message(self.current_chat, 'out', message_text)
             CLIENT_LOG.debug(f'Отправлено сообщение для {self.current_chat}: {message_text}')
-            self.history_list_update()
+            self.append_history(item)
 
     # Слот приёма нового сообщений
     # @pyqtSlot(str)
@@ -232,11 +271,11 @@ class ClientMainWindow(QMainWindow):
         sender = message[SENDER]
 
         if sender == self.current_chat:
-            self.database.save_message(
+            item = self.database.save_message(
                 self.current_chat,
                 'in',
                 message[MESSAGE_TEXT])
-            self.history_list_update()
+            self.append_history(item)
         else:
             # Проверим есть ли такой пользователь у нас в контактах:
             if self.database.check_contact(sender):
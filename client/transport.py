@@ -1,12 +1,17 @@
 import binascii
+import errno
 import hashlib
 import hmac
 import socket
+import selectors
 import sys
 import time
 import json
 import threading
+import itertools
 import logging
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 import client.logs.client_log_config
 CLIENT_LOG = logging.getLogger('app.client')
 
@@ -14,9 +19,12 @@ from PyQt5.QtCore import pyqtSignal, QObject
 sys.path.append('../')
 from common.utils import *
 from common.variables import *
-from common.errors import ServerError
+from common.errors import ServerError, IncorrectDataRecivedError
+from common.codecs import DEFAULT_CODEC, CODECS_BY_NAME, codec_names
 
-# Логер и объект блокировки для работы с сокетом.
+# Логер и объект блокировки для работы с сокетом. Блокировка удерживается
+# только на время отправки: порядок ожидающих запросов совпадает с порядком
+# запросов в сокете.
 socket_lock = threading.Lock()
 
 
@@ -27,6 +35,7 @@ class ClientTransport(threading.Thread, QObject):
     '''
     # Сигналы новое сообщение и потеря соединения
     new_message_sig = pyqtSignal(dict)
+    room_message_sig = pyqtSignal(dict)
     message_205_sig = pyqtSignal()
     connection_lost_sig = pyqtSignal()
 
@@ -43,6 +52,28 @@ class ClientTransport(threading.Thread, QObject):
         self.password = passwd
         # Сокет для работы с сервером
         self.transport = None
+        # Кодек для отправки сообщений, сервер сообщает его при авторизации
+        self.codec = DEFAULT_CODEC
+        # Сообщения сервера, пришедшие в ожидании ответа на запрос (например,
+        # отложенные сообщения сразу после входа). Обрабатываются потоком
+        # транспорта, когда сигналы уже подключены к интерфейсу.
+        self.pushed_messages = deque()
+        # Таблица запросов, ожидающих ответа: идентификатор запроса -> Future.
+        # Сервер повторяет идентификатор в ответе; ответ без него (сервер
+        # прежней версии) относится к самому раннему запросу - сервер
+        # отвечает по порядку.
+        self.pending = dict()
+        self.request_ids = itertools.count(1)
+        # Блокировка таблицы запросов. Поток транспорта не берёт socket_lock:
+        # иначе он мог бы ждать отправителя, который ждёт, пока сервер
+        # примет данные, а сервер не читает, пока мы не примем ответы.
+        self.pending_lock = threading.Lock()
+        # Буфер приёма: за одно чтение из сокета разбираются все целые кадры
+        self.buffer = MessageBuffer()
+        # Признак того, что ответы принимает поток транспорта
+        self.receiving = False
+        # Пара сокетов для пробуждения потока транспорта при завершении работы
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
         # Набор ключей для шифрования
         # self.keys = keys
         # Устанавливаем соединение:
@@ -114,7 +145,8 @@ class ClientTransport(threading.Thread, QObject):
                 USER: {
                     ACCOUNT_NAME: self.username
                     # PUBLIC_KEY: pubkey
-                }
+                },
+                CODECS: codec_names()
             }
             CLIENT_LOG.debug(f"Presense message = {presense}")
             # Отправляем серверу приветственное сообщение.
@@ -132,16 +164,93 @@ class ClientTransport(threading.Thread, QObject):
                         ans_data = ans[DATA]
                         hash = hmac.new(passwd_hash_string, ans_data.encode('utf-8'), 'MD5')
                         digest = hash.digest()
-                        my_ans = RESPONSE_511
+                        my_ans = RESPONSE_511.copy()
                         my_ans[DATA] = binascii.b2a_base64(
                             digest).decode('ascii')
                         send_message(self.transport, my_ans)
-                        self.process_server_ans(get_message(self.transport))
+                        ans = get_message(self.transport)
+                        # Переходим на кодек, выбранный сервером
+                        if CODEC in ans:
+                            self.codec = CODECS_BY_NAME.get(ans[CODEC], DEFAULT_CODEC)
+                        self.process_server_ans(ans)
             except (OSError, json.JSONDecodeError) as err:
                 CLIENT_LOG.debug(f'Connection error.', exc_info=err)
                 raise ServerError('Сбой соединения в процессе авторизации.')
 
 
+    def send_request(self, message):
+        '''
+        Метод отправки запроса серверу без ожидания ответа, возвращает
+        Future ответа. Запросы можно отправлять, не дожидаясь ответов
+        на предыдущие.
+        '''
+        future = Future()
+        with socket_lock:
+            if self.receiving and not self.running:
+                raise ConnectionResetError(errno.ECONNRESET, 'Потеряно соединение с сервером.')
+            request_id = future.request_id = next(self.request_ids)
+            message[REQUEST_ID] = request_id
+            with self.pending_lock:
+                self.pending[request_id] = future
+            try:
+                send_message(self.transport, message, self.codec)
+            except OSError:
+                with self.pending_lock:
+                    self.pending.pop(request_id, None)
+                raise
+        return future
+
+    def request(self, message):
+        '''Метод отправки запроса и ожидания ответа сервера.'''
+        return self.wait_response(self.send_request(message))
+
+    def wait_response(self, future):
+        '''
+        Метод ожидания ответа на отправленный запрос. Пока поток
+        транспорта не запущен, ответ читается из сокета в вызывающем потоке.
+        '''
+        try:
+            if not self.receiving:
+                while not future.done():
+                    self.dispatch(get_message(self.transport))
+            return future.result(RESPONSE_TIMEOUT)
+        except (socket.timeout, FutureTimeoutError):
+            # Запрос без ответа убираем из таблицы: иначе он копится в ней, а
+            # ответы сервера прежней версии (без идентификатора) сопоставлялись
+            # бы со сдвигом на один запрос
+            with self.pending_lock:
+                self.pending.pop(future.request_id, None)
+            raise TimeoutError('Таймаут ожидания ответа сервера.') from None
+
+    def dispatch(self, message):
+        '''
+        Метод распределения принятого сообщения: ответ передаётся ожидающему
+        его запросу, сообщения пользователей и уведомления 205 обрабатываются
+        потоком транспорта (до его запуска - откладываются).
+        '''
+        if RESPONSE in message and message[RESPONSE] != 205:
+            with self.pending_lock:
+                if REQUEST_ID in message:
+                    future = self.pending.pop(message[REQUEST_ID], None)
+                else:
+                    future = self.pending.pop(next(iter(self.pending)), None) if self.pending else None
+            if future is not None:
+                future.set_result(message)
+            else:
+                CLIENT_LOG.error(f'Принят ответ сервера без запроса: {message}')
+        elif self.receiving:
+            self.process_server_ans(message)
+        else:
+            self.pushed_messages.append(message)
+
+    def fail_pending(self):
+        '''Метод завершения ожидающих запросов ошибкой соединения.'''
+        with self.pending_lock:
+            pending, self.pending = self.pending, dict()
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError(errno.ECONNRESET, 'Потеряно соединение с сервером.'))
+
     @func_to_log
     def process_server_ans(self, message):
         '''Метод обработчик поступающих сообщений с сервера.'''
@@ -154,9 +263,17 @@ class ClientTransport(threading.Thread, QObject):
             elif message[RESPONSE] == 400:
                 raise ServerError(f'{message[ERROR]}')
             elif message[RESPONSE] == 205:
-                self.user_list_update()
-                self.contacts_list_update()
-                self.message_205_sig.emit()
+                # Изменения списка пользователей применяем, если они
+                # продолжают нашу ревизию той же эпохи базы сервера, иначе
+                # запрашиваем их сами
+                if SINCE in message and message[SINCE] == self.database.get_users_revision() \
+                        and message.get(EPOCH, 0) == self.database.get_users_epoch():
+                    self.database.apply_users_changes(message[REVISION], message[ADDED], message[REMOVED])
+                    self.message_205_sig.emit()
+                else:
+                    # Ответы на запросы принимает этот же поток, поэтому
+                    # запросы выполняются в отдельном
+                    threading.Thread(target=self.update_lists, daemon=True).start()
             else:
                 CLIENT_LOG.error(
                     f'Принят неизвестный код подтверждения {message[RESPONSE]}')
@@ -169,10 +286,16 @@ class ClientTransport(threading.Thread, QObject):
                 f'Получено сообщение от пользователя {message[SENDER]}:{message[MESSAGE_TEXT]}')
             self.new_message_sig.emit(message)
 
+        # Если это сообщение в комнату, даём сигнал о нём
+        elif ACTION in message and message[ACTION] == ROOM_MESSAGE and SENDER in message and ROOM in message \
+                and MESSAGE_TEXT in message:
+            CLIENT_LOG.debug(
+                f'Получено сообщение в комнату {message[ROOM]} от {message[SENDER]}:{message[MESSAGE_TEXT]}')
+            self.room_message_sig.emit(message)
+
     @func_to_log
     def contacts_list_update(self):
         '''Метод обновляющий с сервера список контактов.'''
-        self.database.contacts_clear()
         CLIENT_LOG.debug(f'Запрос контакт листа для пользователся {self.name}')
         req = {
             ACTION: GET_CONTACTS,
@@ -180,13 +303,10 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username
         }
         CLIENT_LOG.debug(f'Сформирован запрос {req}')
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.request(req)
         CLIENT_LOG.debug(f'Получен ответ {ans}')
         if RESPONSE in ans and ans[RESPONSE] == 202:
-            for contact in ans[LIST_INFO]:
-                self.database.add_contact(contact)
+            self.database.set_contacts(ans[LIST_INFO])
         else:
             CLIENT_LOG.error('Не удалось обновить список контактов.')
 
@@ -197,16 +317,30 @@ class ClientTransport(threading.Thread, QObject):
         req = {
             ACTION: USERS_REQUEST,
             TIME: time.time(),
-            ACCOUNT_NAME: self.username
+            ACCOUNT_NAME: self.username,
+            REVISION: self.database.get_users_revision(),
+            EPOCH: self.database.get_users_epoch()
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.request(req)
         if RESPONSE in ans and ans[RESPONSE] == 202:
-            self.database.add_users(ans[LIST_INFO])
+            # Сервер присылает полный список или изменения с нашей ревизии
+            if LIST_INFO in ans:
+                self.database.add_users(ans[LIST_INFO], ans.get(REVISION, 0), ans.get(EPOCH, 0))
+            else:
+                self.database.apply_users_changes(ans[REVISION], ans[ADDED], ans[REMOVED])
         else:
             CLIENT_LOG.error('Не удалось обновить список известных пользователей.')
 
+    def update_lists(self):
+        '''Метод полного обновления списков пользователей и контактов по уведомлению 205.'''
+        try:
+            self.user_list_update()
+            self.contacts_list_update()
+        except (OSError, ServerError) as err:
+            CLIENT_LOG.error(f'Не удалось обновить списки: {err}')
+            return
+        self.message_205_sig.emit()
+
     # def key_request(self, user):
     #     '''Метод запрашивающий с сервера публичный ключ пользователя.'''
     #     CLIENT_LOG.debug(f'Запрос публичного ключа для {user}')
@@ -233,9 +367,7 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
+        self.process_server_ans(self.request(req))
 
     @func_to_log
     def remove_contact(self, contact):
@@ -247,9 +379,35 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
+        self.process_server_ans(self.request(req))
+
+    @func_to_log
+    def room_action(self, action, room):
+        '''Метод создания комнаты, вступления в неё или выхода (CREATE_ROOM, JOIN_ROOM, LEAVE_ROOM).'''
+        CLIENT_LOG.debug(f'Запрос {action} для комнаты {room}')
+        req = {
+            ACTION: action,
+            TIME: time.time(),
+            USER: self.username,
+            ROOM: room
+        }
+        self.process_server_ans(self.request(req))
+
+    def send_room_message_nowait(self, room, message):
+        '''Метод отправки сообщения в комнату без ожидания ответа, возвращает Future ответа.'''
+        return self.send_request({
+            ACTION: ROOM_MESSAGE,
+            SENDER: self.username,
+            ROOM: room,
+            TIME: time.time(),
+            MESSAGE_TEXT: message
+        })
+
+    @func_to_log
+    def send_room_message(self, room, message):
+        '''Метод отправляющий на сервер сообщение в комнату.'''
+        self.process_server_ans(self.wait_response(self.send_room_message_nowait(room, message)))
+        CLIENT_LOG.info(f'Отправлено сообщение в комнату {room}')
 
     @func_to_log
     def transport_shutdown(self):
@@ -262,15 +420,31 @@ class ClientTransport(threading.Thread, QObject):
         }
         with socket_lock:
             try:
-                send_message(self.transport, message)
+                send_message(self.transport, message, self.codec)
             except OSError:
                 pass
         CLIENT_LOG.debug('Транспорт завершает работу.')
-        time.sleep(0.5)
+        self.wakeup()
+
+    def wakeup(self):
+        '''Метод пробуждения потока транспорта, ожидающего данных.'''
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            pass
 
     @func_to_log
     def send_message(self, to, message):
         '''Метод отправляющий на сервер сообщения для пользователя.'''
+        self.process_server_ans(self.wait_response(self.send_message_nowait(to, message)))
+        CLIENT_LOG.info(f'Отправлено сообщение для пользователя {to}')
+
+    def send_message_nowait(self, to, message):
+        '''
+        Метод отправки сообщения пользователю без ожидания ответа сервера.
+        Возвращает Future ответа; результат проверяется process_server_ans.
+        Позволяет отправить много сообщений за время одного обмена с сервером.
+        '''
         message_dict = {
             ACTION: MESSAGE,
             SENDER: self.username,
@@ -279,39 +453,53 @@ class ClientTransport(threading.Thread, QObject):
             MESSAGE_TEXT: message
         }
         CLIENT_LOG.debug(f'Сформирован словарь сообщения: {message_dict}')
-        # Необходимо дождаться освобождения сокета для отправки сообщения
-        with socket_lock:
-            send_message(self.transport, message_dict)
-            self.process_server_ans(get_message(self.transport))
-            CLIENT_LOG.info(f'Отправлено сообщение для пользователя {to}')
+        return self.send_request(message_dict)
+
+    def start(self):
+        '''Метод запуска потока транспорта: с этого момента ответы принимает он.'''
+        self.receiving = True
+        super().start()
 
     def run(self):
-        '''Метод содержащий основной цикл работы транспортного потока.'''
+        '''
+        Метод содержащий основной цикл работы транспортного потока.
+        Поток спит, пока в сокете нет данных, и разбирает за раз все
+        пришедшие сообщения.
+        '''
         CLIENT_LOG.debug('Запущен процесс - приёмник собщений с сервера.')
-        while self.running:
-            # Отдыхаем секунду и снова пробуем захватить сокет.
-            # если не сделать тут задержку, то отправка может достаточно долго
-            # ждать освобождения сокета.
-            time.sleep(1)
-            message = None
-            with socket_lock:
-                try:
-                    self.transport.settimeout(1)
-                    message = get_message(self.transport)
-                except OSError as err:
-                    if err.errno:
-                        CLIENT_LOG.critical(f'Потеряно соединение с сервером.')
-                        self.running = False
-                        self.connection_lost_sig.emit()
-                # Проблемы с соединением
-                except (ConnectionError, ConnectionAbortedError, ConnectionResetError, json.JSONDecodeError, TypeError):
-                    CLIENT_LOG.debug(f'Потеряно соединение с сервером.')
-                    self.running = False
-                    self.connection_lost_sig.emit()
-                finally:
-                    self.transport.settimeout(5)
-
-            # Если сообщение получено, то вызываем функцию обработчик:
-            if message:
-                CLIENT_LOG.debug(f'Принято сообщение с сервера: {message}')
-                self.process_server_ans(message)
+        # Сначала разбираем сообщения, отложенные в ожидании ответов
+        while self.pushed_messages:
+            self.process_server_ans(self.pushed_messages.popleft())
+        selector = selectors.DefaultSelector()
+        selector.register(self.transport, selectors.EVENT_READ)
+        selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        try:
+            while self.running:
+                for key, mask in selector.select():
+                    if key.fileobj is self.wakeup_reader:
+                        self.wakeup_reader.recv(MAX_PACKAGE_LENGTH)
+                    else:
+                        self.read_messages()
+        # Проблемы с соединением
+        except (OSError, json.JSONDecodeError, TypeError, ValueError, IncorrectDataRecivedError) as err:
+            if self.running:
+                CLIENT_LOG.critical(f'Потеряно соединение с сервером.', exc_info=err)
+                self.running = False
+                self.connection_lost_sig.emit()
+        finally:
+            selector.close()
+            self.fail_pending()
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
+
+    def read_messages(self):
+        '''Метод чтения из сокета и обработки всех пришедших сообщений.'''
+        try:
+            data = self.transport.recv(MAX_PACKAGE_LENGTH)
+        except (BlockingIOError, socket.timeout):
+            return
+        if not data:
+            raise ConnectionResetError(errno.ECONNRESET, 'Соединение закрыто сервером.')
+        for message in self.buffer.feed(data):
+            CLIENT_LOG.debug(f'Принято сообщение с сервера: {message}')
+            self.dispatch(message)
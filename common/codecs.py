@@ -0,0 +1,93 @@
+"""
+Кодеки сообщений JIM.
+
+По умолчанию используется стандартный json. Если установлены
+orjson и/или msgpack, становятся доступны соответствующие кодеки.
+Клиент перечисляет поддерживаемые кодеки в сообщении presence,
+сервер выбирает первый подходящий из своего списка предпочтений
+и сообщает его в ответе 200. Номер кодека передаётся в заголовке
+каждого кадра, поэтому получатель всегда знает, как его декодировать.
+"""
+
+import json
+from common.variables import ENCODING
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec:
+    """Кодек на стандартном модуле json."""
+    name = 'json'
+    code = 0
+
+    @staticmethod
+    def dumps(message):
+        return json.dumps(message).encode(ENCODING)
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data.decode(ENCODING))
+
+
+class OrjsonCodec:
+    """Кодек на orjson - тот же JSON на проводе, но кодирование быстрее."""
+    name = 'orjson'
+    code = 1
+
+    @staticmethod
+    def dumps(message):
+        return orjson.dumps(message)
+
+    @staticmethod
+    def loads(data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec:
+    """Бинарный кодек msgpack - меньше байт на проводе."""
+    name = 'msgpack'
+    code = 2
+
+    @staticmethod
+    def dumps(message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    @staticmethod
+    def loads(data):
+        return msgpack.unpackb(data, raw=False)
+
+
+DEFAULT_CODEC = JsonCodec
+
+# Доступные кодеки в порядке предпочтения
+AVAILABLE_CODECS = [codec for codec, module in ((OrjsonCodec, orjson), (MsgpackCodec, msgpack))
+                    if module is not None] + [JsonCodec]
+
+CODECS_BY_CODE = {codec.code: codec for codec in AVAILABLE_CODECS}
+CODECS_BY_NAME = {codec.name: codec for codec in AVAILABLE_CODECS}
+
+
+def codec_names():
+    """Функция возвращает имена доступных кодеков в порядке предпочтения."""
+    return [codec.name for codec in AVAILABLE_CODECS]
+
+
+def choose_codec(names):
+    """
+    Функция выбора кодека по списку, присланному собеседником.
+    Возвращает первый из доступных локально кодеков, который
+    поддерживает собеседник, или кодек по умолчанию.
+    """
+    if isinstance(names, list):
+        for codec in AVAILABLE_CODECS:
+            if codec.name in names:
+                return codec
+    return DEFAULT_CODEC
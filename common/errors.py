@@ -13,7 +13,7 @@ class ReqFieldMissingError(Exception):
         return f'В принятом словаре отсутствует обязательное поле {self.missing_field}.'
 
 
-class IncorrectDataRecivedError(Exception):
+class IncorrectDataRecivedError(ValueError):
     """
     Исключение  - некорректные данные получены от сокета
     """
@@ -1,28 +1,51 @@
 import sys
 import logging
-import traceback
-import socket
+from functools import wraps
+
+from common.variables import ACTION, PRESENCE
+
+# Флаг логирования вызовов декорированных функций.
+# Переключается во время работы функцией set_call_logging.
+CALL_LOGGING = True
+
+
+def set_call_logging(enabled):
+    """
+    Функция включения/выключения логирования вызовов.
+    Если выключить до импорта модулей, декоратор вернёт
+    функции без обёртки.
+    """
+    global CALL_LOGGING
+    CALL_LOGGING = bool(enabled)
 
 
 def func_to_log(func):
-    """Декоратор """
+    """
+    Декоратор, записывающий в лог вызов функции с параметрами.
+    Запись формируется только если логирование вызовов включено
+    и логгер пропускает уровень DEBUG, иначе обёртка сразу вызывает
+    функцию - без форматирования аргументов и обхода стека.
+    """
+    if not CALL_LOGGING:
+        return func
+
     if 'server.py' in sys.argv[0]:
         current_log = logging.getLogger('app.server')
     else:
         current_log = logging.getLogger('app.client')
 
+    @wraps(func)
     def log_writer(*args, **kwargs):
         """Обертка"""
-        current_log.debug(
-            f'Вызываем функцию {func.__name__} c параметрами {args}, {kwargs}'
-            f'из функции {traceback.format_stack()[0].strip().split()[-1]} модуля {func.__module__}.'
-        )
-        res = func(*args, **kwargs)
-
-        return res
+        if CALL_LOGGING and current_log.isEnabledFor(logging.DEBUG):
+            current_log.debug(
+                'Вызываем функцию %s c параметрами %s, %s из функции %s модуля %s.',
+                func.__name__, args, kwargs, sys._getframe(1).f_code.co_name, func.__module__)
+        return func(*args, **kwargs)
 
     return log_writer
 
+
 def login_required(func):
     """
     Декоратор, проверяющий, что клиент авторизован на сервере.
@@ -33,40 +56,30 @@ def login_required(func):
     генерирует исключение TypeError
     """
 
+    @wraps(func)
     def checker(*args, **kwargs):
-        # проверяем, что первый аргумент - экземпляр MessageProcessor
-        # Импортить необходимо тут, иначе ошибка рекурсивного импорта.
+        # проверяем, что первый аргумент - сервер, то есть объект со
+        # словарём client_names (сокет -> имя авторизованного пользователя).
         # ----------------------------------------------------------------
         # args = (
-        #         <MessageProcessor(Thread-5, started daemon 140650633856768)>,
+        #         <Server(Thread-5, started daemon 140650633856768)>,
         #         {'action': 'presence',
         #          'time': 1654900198.8001323,
-        #           'user': {
-        #                    'account_name': 'test1',
-        #                    'pubkey': '-----BEGIN PUBLIC KEY-----\nMIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEAmKN/CFSxgU8eu0oO0oKw\n29WTZQSfqw/mJgEtr8nLUAOHGcg3kT7epUgPfwbo/V67sJlGhb/UD7dPK81utWRn\nFKhhUGuo+ad/4HnvbSQjIHy2Wbr85T4gJCL1IqTkodAgSOo4Nuv/Qq9r5po0dNIC\nF4YTZrzfCy6V0v349iXM2CXf+/14fHCxsm3OkNCUwHsOW6nzh5fIyAs1UhssJm/Z\nbCNzX5PkRjI7bwBJhoXHNgS1fDyII6vGrQAyAwxU0hKrBAtAzYIon5ZlIYxyF2/5\nKb8IVmLmnrvCpmtjTQ4u80Dp6YuErMCD82GzgUi50UdQoW617AmFxaKpvO7Lu+aA\nfwIDAQAB\n-----END PUBLIC KEY-----'
-        #                    }
+        #          'user': {'account_name': 'test1', 'pubkey': '...'}
         #          },
         #          <socket.socket fd=25, family=AddressFamily.AF_INET, type=SocketKind.SOCK_STREAM, proto=0, laddr=('127.0.0.1', 7777), raddr=('127.0.0.1', 52416)>
         # )
-        from server.core import Server
-        from common.variables import ACTION, PRESENCE
-        if isinstance(args[0], Server):
+        client_names = getattr(args[0], 'client_names', None) if args else None
+        if client_names is not None:
             found = False
-            for arg in args:
-                if isinstance(arg, socket.socket):
-                    # Проверяем, что данный сокет есть в списке names класса
-                    # Server
-                    for client in args[0].names:
-                        # args[0].names = {'test1': <socket.socket fd=25, family=AddressFamily.AF_INET, type=SocketKind.SOCK_STREAM, proto=0, laddr=('127.0.0.1', 7777), raddr=('127.0.0.1', 52420)>}
-                        if args[0].names[client] == arg:
-                            found = True
-
-            # Теперь надо проверить, что передаваемые аргументы не presence
-            # сообщение. Если presence, то разрешаем
-            for arg in args:
+            for arg in args[1:]:
+                # Presence сообщение (начало авторизации) разрешаем
                 if isinstance(arg, dict):
-                    if ACTION in arg and arg[ACTION] == PRESENCE:
+                    if arg.get(ACTION) == PRESENCE:
                         found = True
+                # Проверяем, что данный сокет авторизован - поиск в словаре
+                elif arg in client_names:
+                    found = True
             # Если не не авторизован и не сообщение начала авторизации, то
             # вызываем исключение.
             if not found:
@@ -1,15 +1,59 @@
+import errno
 import json
-from common.variables import MAX_PACKAGE_LENGTH, ENCODING
+import struct
+from common.variables import MAX_PACKAGE_LENGTH, MAX_MESSAGE_LENGTH
 from common.errors import IncorrectDataRecivedError
 from common.proj_decorators import func_to_log
+from common.codecs import DEFAULT_CODEC, CODECS_BY_CODE
+
+# Заголовок кадра - длина закодированного сообщения (4 байта, сетевой порядок)
+# и номер кодека (1 байт). Каждое сообщение передаётся как заголовок + тело,
+# поэтому склеенные или разбитые TCP сегменты корректно разбираются на стороне
+# получателя, а кодек можно сменить в любой момент.
+HEADER = struct.Struct('!IB')
 
 
 # @func_to_log
 def get_message(sock):
-    encoded_msg = sock.recv(MAX_PACKAGE_LENGTH)
-    if isinstance(encoded_msg, bytes):
-        json_response = encoded_msg.decode(ENCODING)
-        response = json.loads(json_response)
+    """
+    Функция приёма одного сообщения из блокирующего сокета.
+    Читает ровно один кадр: заголовок, затем тело сообщения.
+    """
+    header = recv_exactly(sock, HEADER.size)
+    length, codec = unpack_header(header)
+    return decode_message(recv_exactly(sock, length), codec)
+
+
+def unpack_header(header, offset=0):
+    """Функция разбора заголовка кадра, возвращает длину тела и кодек."""
+    length, code = HEADER.unpack_from(header, offset)
+    if length > MAX_MESSAGE_LENGTH or code not in CODECS_BY_CODE:
+        raise IncorrectDataRecivedError
+    return length, CODECS_BY_CODE[code]
+
+
+def recv_exactly(sock, length):
+    """Функция чтения из сокета ровно length байт."""
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(min(length - len(data), MAX_PACKAGE_LENGTH))
+        if not isinstance(chunk, bytes):
+            raise IncorrectDataRecivedError
+        if not chunk:
+            raise ConnectionResetError(errno.ECONNRESET, 'Соединение закрыто удалённым компьютером.')
+        data += chunk
+    return data
+
+
+def decode_message(encoded_msg, codec=DEFAULT_CODEC):
+    """Функция декодирования принятых байтов в словарь - сообщение."""
+    if isinstance(encoded_msg, (bytes, bytearray)):
+        try:
+            response = codec.loads(encoded_msg)
+        except json.JSONDecodeError:
+            raise
+        except ValueError:
+            raise IncorrectDataRecivedError
         if isinstance(response, dict):
             return response
         else:
@@ -17,10 +61,41 @@ def get_message(sock):
     else:
         raise IncorrectDataRecivedError
 
-@func_to_log
-def send_message(sock, message):
+
+def encode_message(message, codec=DEFAULT_CODEC):
+    """Функция кодирования словаря - сообщения в кадр для передачи."""
     if not isinstance(message, dict):
         raise TypeError
-    json_message = json.dumps(message)
-    encoded_message = json_message.encode(ENCODING)
-    sock.send(encoded_message)
+    encoded_message = codec.dumps(message)
+    return HEADER.pack(len(encoded_message), codec.code) + encoded_message
+
+
+@func_to_log
+def send_message(sock, message, codec=DEFAULT_CODEC):
+    sock.sendall(encode_message(message, codec))
+
+
+class MessageBuffer:
+    """
+    Буфер приёма для неблокирующего чтения. Накапливает байты,
+    полученные из сокета, и выделяет из них все целые сообщения;
+    неполный кадр остаётся в буфере до следующего поступления данных.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def feed(self, data):
+        """Метод добавляет принятые байты и возвращает список целых сообщений."""
+        self.data += data
+        messages = []
+        start = 0
+        while len(self.data) - start >= HEADER.size:
+            length, codec = unpack_header(self.data, start)
+            end = start + HEADER.size + length
+            if end > len(self.data):
+                break
+            messages.append(decode_message(self.data[start + HEADER.size:end], codec))
+            start = end
+        del self.data[:start]
+        return messages
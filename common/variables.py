@@ -1,7 +1,28 @@
 DEFAULT_PORT = 7777
 DEFAULT_IP_ADDRESS = '127.0.0.1'
-MAX_CONNECTIONS = 10
-MAX_PACKAGE_LENGTH = 1024
+# Очередь входящих соединений слушающего сокета (listen backlog): при
+# массовом переподключении клиентов маленькая очередь теряет соединения
+MAX_CONNECTIONS = 1024
+# Таймаут ожидания событий в селекторе сервера (сек.)
+SELECT_TIMEOUT = 0.5
+# Границы очереди отправки клиенту (байт): выше верхней клиент считается
+# медленным, ниже нижней - снова нормальным
+OUTBOX_HIGH_WATERMARK = 1024 * 1024
+OUTBOX_LOW_WATERMARK = 256 * 1024
+# Что делать с медленным клиентом: drop - отбрасывать новые сообщения,
+# disconnect - отключать, spill - откладывать до разгрузки очереди
+SLOW_CLIENT_DROP = 'drop'
+SLOW_CLIENT_DISCONNECT = 'disconnect'
+SLOW_CLIENT_SPILL = 'spill'
+SLOW_CLIENT_POLICY = SLOW_CLIENT_DISCONNECT
+# Таймаут ответа клиента на запрос авторизации (сек.)
+AUTH_TIMEOUT = 5
+# Число потоков проверки ответов клиентов при авторизации
+AUTH_WORKERS = 2
+# Максимальный размер блока, читаемого из сокета за один вызов recv
+MAX_PACKAGE_LENGTH = 65536
+# Максимальная длина одного сообщения (кадра) протокола
+MAX_MESSAGE_LENGTH = 16 * 1024 * 1024
 ENCODING = 'utf-8'
 # Протокол JIM, осн. ключи
 ACTION = 'action'
@@ -24,6 +45,27 @@ ADD_CONTACT = 'add'
 USERS_REQUEST = 'get_users'
 DATA = 'bin'
 PUBLIC_KEY = 'pubkey'
+CODECS = 'codecs'
+CODEC = 'codec'
+# Версии списка пользователей: ревизия списка, ревизия, от которой
+# передаются изменения, добавленные и удалённые пользователи
+REVISION = 'revision'
+SINCE = 'since'
+ADDED = 'added'
+REMOVED = 'removed'
+# Эпоха базы сервера: случайное число, создаётся вместе с базой. Ревизии
+# из другой эпохи (база сервера пересоздана) не сравниваются с текущими
+EPOCH = 'epoch'
+# Комнаты (групповые чаты): создание, вступление, выход, сообщение
+# в комнату и имя комнаты
+CREATE_ROOM = 'create_room'
+JOIN_ROOM = 'join_room'
+LEAVE_ROOM = 'leave_room'
+ROOM_MESSAGE = 'room_message'
+ROOM = 'room'
+# Необязательный идентификатор запроса клиента, сервер повторяет его в
+# ответе (200/202/400) - клиент может отправлять запросы не дожидаясь ответов
+REQUEST_ID = 'request_id'
 # Словари - ответы:
 # 200
 RESPONSE_200 = {RESPONSE: 200}
@@ -49,3 +91,32 @@ RESPONSE_511 = {
 
 
 SERVER_DB = 'sqlite:///server_db.db3'
+# Запись статистики сообщений в базу: не реже чем раз в STATS_FLUSH_INTERVAL
+# секунд и не позже чем через STATS_FLUSH_MESSAGES сообщений
+STATS_FLUSH_INTERVAL = 0.5
+STATS_FLUSH_MESSAGES = 1000
+# Очередь сообщений для пользователей не в сети: не больше сообщений
+# на пользователя и срок хранения (сек.)
+OFFLINE_MESSAGES_LIMIT = 1000
+OFFLINE_MESSAGES_TTL = 7 * 24 * 60 * 60
+# Настройки SQLite сервера по умолчанию (секция [SQLITE] в server.ini):
+# журнал WAL - чтение не блокирует запись, synchronous=NORMAL - без fsync
+# на каждую транзакцию, кэш 16 Мб, отображение файла в память до 256 Мб
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'mmap_size': 268435456
+}
+# История переписки в окне клиента загружается страницами по столько сообщений
+HISTORY_PAGE_SIZE = 20
+# Не больше стольких сообщений держится в окне переписки: при добавлении
+# новых самые старые убираются из окна (остаются в базе и подгружаются
+# при прокрутке)
+HISTORY_VIEW_LIMIT = 500
+# Консоль администратора сервера без графического интерфейса: локальный
+# Unix сокет, а в ОС без них - TCP порт на 127.0.0.1
+ADMIN_SOCKET = 'server_admin.sock'
+ADMIN_PORT = 7778
+# Время ожидания клиентом ответа сервера на запрос (сек.)
+RESPONSE_TIMEOUT = 5
@@ -2,16 +2,17 @@ import argparse
 import sys
 import os
 import configparser
+import signal
 import threading
 
-from PyQt5.QtCore import QTimer
-from PyQt5.QtWidgets import QApplication, QMessageBox
-
-from common.proj_decorators import func_to_log
+from common.proj_decorators import func_to_log, set_call_logging
 from server.server_db import ServerStorage
 from server.core import Server
-from common.variables import DEFAULT_PORT
-from server.main_window import MainWindow
+from server.async_core import AsyncServer
+from server.cluster import run_cluster
+from server.admin import AdminConsole, admin_address, HELP_TEXT
+from common.variables import DEFAULT_PORT, OUTBOX_HIGH_WATERMARK, OUTBOX_LOW_WATERMARK, SLOW_CLIENT_POLICY, \
+    ADMIN_SOCKET
 
 import logging
 import server.logs.server_log_config
@@ -30,12 +31,16 @@ def serv_arg_parser(default_port, default_address):
     parser.add_argument('-p', default=default_port, type=int, nargs='?')
     parser.add_argument('-a', default=default_address, nargs='?')
     parser.add_argument('--no_gui', action='store_true')
+    parser.add_argument('--asyncio', action='store_true')
+    parser.add_argument('--workers', default=1, type=int)
     namespace = parser.parse_args(sys.argv[1:])
     listen_address = namespace.a
     listen_port = namespace.p
     gui_flag = namespace.no_gui
+    async_flag = namespace.asyncio
+    workers = namespace.workers
     SERVER_LOG.debug('Аргументы успешно загружены.')
-    return listen_address, listen_port, gui_flag
+    return listen_address, listen_port, gui_flag, async_flag, workers
 # def serv_arg_parser():
 #     """
 #            Сперва пытаемся обработать параметры командной строки (address_to_listen и port_to_listen).
@@ -70,28 +75,15 @@ def serv_arg_parser(default_port, default_address):
 
 
 def print_help():
-    print('Поддерживаемые комманды:')
-    print('users - список известных пользователей')
-    print('connected - список подключённых пользователей')
-    print('loghist - история входов пользователя')
-    print('exit - завершение работы сервера.')
-    print('help - вывод справки по поддерживаемым командам')
+    print(HELP_TEXT)
 
 
-def main():
-    config = configparser.ConfigParser()
-    ini_path = os.path.join(os.getcwd(), 'server.ini')
-    config.read(ini_path)
+def run_gui(server, database, config):
+    '''Запуск сервера в фоновом потоке и графического интерфейса.'''
+    # PyQt импортируется только здесь: режим без интерфейса его не загружает
+    from PyQt5.QtWidgets import QApplication
+    from server.main_window import MainWindow
 
-    database = ServerStorage(
-        os.path.join(
-            config['SETTINGS']['Database_path'],
-            config['SETTINGS']['Database_file'])
-    )
-
-    address_to_listen, port_to_listen, gui_flag = serv_arg_parser(
-        config['SETTINGS']['Default_port'], config['SETTINGS']['Listen_Address'])
-    server = Server(address_to_listen, port_to_listen, database)
     server.daemon = True
     server.start()
 
@@ -101,6 +93,89 @@ def main():
     # Запускаем GUI
     server_app.exec_()
 
+    # GUI закрыт - останавливаем сервер, дожидаясь записи статистики
+    server.running = False
+    server.join()
+
+
+def run_headless(server, database, address):
+    '''
+    Запуск сервера без графического интерфейса: ядро работает в основном
+    потоке до SIGINT/SIGTERM или команды exit консоли администратора.
+    '''
+    def stop(*args):
+        server.running = False
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    console = AdminConsole(address, database, server)
+    try:
+        console.init_socket()
+    except OSError as err:
+        SERVER_LOG.error(f'Не удалось запустить консоль администратора {address}: {err}')
+    else:
+        console.start()
+    try:
+        server.run()
+    finally:
+        console.stop()
+
+
+def configure_logging(config):
+    '''
+    Настройка логирования из секции [LOGGING]: level - уровень лога сервера,
+    call_logging - запись вызовов функций (декоратор func_to_log, по умолчанию
+    выключена). Уровень передаётся процессам-обработчикам через окружение.
+    '''
+    level = config.get('LOGGING', 'level', fallback=None)
+    if level:
+        SERVER_LOG.setLevel(level.upper())
+        os.environ['SERVER_LOG_LEVEL'] = level.upper()
+    call_logging = config.getboolean('LOGGING', 'call_logging', fallback=False)
+    set_call_logging(call_logging)
+    return call_logging
+
+
+def main():
+    config = configparser.ConfigParser()
+    ini_path = os.path.join(os.getcwd(), 'server.ini')
+    config.read(ini_path)
+    call_logging = configure_logging(config)
+
+    # Настройки SQLite из секции [SQLITE], если она есть
+    pragmas = dict(config['SQLITE']) if config.has_section('SQLITE') else None
+    database_path = os.path.join(
+        config['SETTINGS']['Database_path'],
+        config['SETTINGS']['Database_file'])
+
+    address_to_listen, port_to_listen, no_gui, async_flag, workers = serv_arg_parser(
+        config['SETTINGS']['Default_port'], config['SETTINGS']['Listen_Address'])
+
+    # Границы очереди отправки и политика для медленных клиентов из секции [OUTBOX]
+    server_options = dict(
+        high_watermark=config.getint('OUTBOX', 'high_watermark', fallback=OUTBOX_HIGH_WATERMARK),
+        low_watermark=config.getint('OUTBOX', 'low_watermark', fallback=OUTBOX_LOW_WATERMARK),
+        slow_client_policy=config.get('OUTBOX', 'slow_client_policy', fallback=SLOW_CLIENT_POLICY))
+
+    # Многопроцессный режим - без графического интерфейса, до Ctrl+C
+    if workers > 1:
+        run_cluster(workers, address_to_listen, port_to_listen, database_path, pragmas, call_logging,
+                    **server_options)
+        return
+
+    database = ServerStorage(database_path, pragmas)
+
+    # Ядро сервера: на селекторе (по умолчанию) или на asyncio
+    server_class = AsyncServer if async_flag else Server
+    server = server_class(address_to_listen, port_to_listen, database, **server_options)
+
+    if no_gui:
+        run_headless(server, database, admin_address(
+            config.get('SETTINGS', 'admin_socket', fallback=ADMIN_SOCKET)))
+    else:
+        run_gui(server, database, config)
+
 
 if __name__ == '__main__':
     main()
@@ -89,7 +89,8 @@ class RegisterUser(QDialog):
             self.messages.information(
                 self, 'Успех', 'Пользователь успешно зарегистрирован.')
             # Рассылаем клиентам сообщение о необходимости обновить справочники
-            self.server.service_update_lists()
+            # (в потоке сервера)
+            self.server.call_soon(self.server.service_update_lists)
             self.close()
 
 
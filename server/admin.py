@@ -0,0 +1,154 @@
+"""
+Консоль администратора сервера для режима без графического интерфейса.
+
+Сервер принимает текстовые команды (users, connected, loghist, exit,
+help) по локальному сокету, по одной команде в строке, и отвечает
+текстом, завершённым пустой строкой. Подключиться можно командой
+python -m server.admin [адрес].
+"""
+
+import os
+import sys
+import socket
+import threading
+import logging
+
+import server.logs.server_log_config
+
+sys.path.append('../')
+
+from common.variables import ADMIN_SOCKET, ADMIN_PORT, SELECT_TIMEOUT, ENCODING
+
+SERVER_LOG = logging.getLogger('app.server')
+
+HELP_TEXT = '\n'.join([
+    'Поддерживаемые комманды:',
+    'users - список известных пользователей',
+    'connected - список подключённых пользователей',
+    'loghist [имя] - история входов пользователя',
+    'exit - завершение работы сервера.',
+    'help - вывод справки по поддерживаемым командам'])
+
+
+def admin_address(path=ADMIN_SOCKET):
+    '''Функция выбора адреса консоли: Unix сокет или TCP порт на 127.0.0.1.'''
+    if hasattr(socket, 'AF_UNIX'):
+        return path
+    return '127.0.0.1', ADMIN_PORT
+
+
+def admin_socket(address):
+    '''Функция создания сокета консоли для адреса - пути или пары (хост, порт).'''
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    return socket.socket(family, socket.SOCK_STREAM)
+
+
+class AdminConsole(threading.Thread):
+    """
+    Класс - консоль администратора. Работает в отдельном потоке, каждое
+    подключение администратора обслуживается своим потоком. Команды
+    читают данные из хранилища сервера, exit останавливает сервер.
+    """
+
+    def __init__(self, address, database, server):
+        self.address = address
+        self.database = database
+        self.server = server
+        self.sock = None
+        self.running = True
+        super().__init__(name='server_admin', daemon=True)
+
+    def init_socket(self):
+        '''Метод создания слушающего сокета консоли.'''
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            # Сокет, оставшийся от прошлого запуска
+            os.remove(self.address)
+        self.sock = admin_socket(self.address)
+        self.sock.bind(self.address)
+        self.sock.listen()
+        self.sock.settimeout(SELECT_TIMEOUT)
+        SERVER_LOG.info(f'Консоль администратора ожидает подключений: {self.address}')
+
+    def run(self):
+        '''Метод основной цикл потока, принимает подключения администраторов.'''
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def stop(self):
+        '''Метод остановки консоли.'''
+        self.running = False
+        if self.sock is not None:
+            self.sock.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def serve(self, conn):
+        '''Метод обслуживания подключения администратора: команда - ответ.'''
+        with conn, conn.makefile('r', encoding=ENCODING) as reader:
+            for line in reader:
+                command, *args = line.split() or ['']
+                try:
+                    answer = self.execute(command, *args)
+                except Exception as err:
+                    SERVER_LOG.error(f'Ошибка выполнения команды консоли {command}: {err}')
+                    answer = f'Ошибка: {err}'
+                try:
+                    conn.sendall(f'{answer}\n\n'.encode(ENCODING))
+                except OSError:
+                    return
+                if command == 'exit':
+                    return
+
+    def execute(self, command, *args):
+        '''Метод выполнения команды, возвращает текст ответа.'''
+        if command == 'users':
+            return '\n'.join(f'Пользователь {user}, последний вход: {last_login}'
+                             for user, last_login in sorted(self.database.users_list()))
+        elif command == 'connected':
+            return '\n'.join(f'Пользователь {user}, подключен: {ip}:{port}, время установки соединения: {time}'
+                             for user, ip, port, time in sorted(self.database.active_users_list()))
+        elif command == 'loghist':
+            return '\n'.join(f'Пользователь: {user} время входа: {time}. Вход с: {ip}:{port}'
+                             for user, time, ip, port in sorted(self.database.login_history(*args[:1])))
+        elif command == 'exit':
+            SERVER_LOG.info('Остановка сервера по команде консоли администратора.')
+            self.server.running = False
+            return 'Сервер останавливается.'
+        elif command == 'help':
+            return HELP_TEXT
+        return 'Команда не распознана. help - список команд.'
+
+
+def main():
+    '''Функция - клиент консоли: передаёт серверу введённые команды.'''
+    address = sys.argv[1] if len(sys.argv) > 1 else admin_address()
+    if isinstance(address, str) and address.isdigit():
+        address = '127.0.0.1', int(address)
+    with admin_socket(address) as sock:
+        sock.connect(address)
+        reader = sock.makefile('r', encoding=ENCODING)
+        print(HELP_TEXT)
+        while True:
+            try:
+                command = input('Введите комманду: ').strip()
+            except (EOFError, KeyboardInterrupt):
+                break
+            if not command:
+                continue
+            sock.sendall(f'{command}\n'.encode(ENCODING))
+            for line in reader:
+                if line == '\n':
+                    break
+                print(line, end='')
+            if command == 'exit':
+                break
+
+
+if __name__ == '__main__':
+    main()
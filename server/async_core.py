@@ -0,0 +1,204 @@
+import asyncio
+import binascii
+import os
+import sys
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import server.logs.server_log_config
+
+sys.path.append('../')
+
+from server.core import Server, check_digest
+from common.utils import decode_message, unpack_header, HEADER
+from common.codecs import choose_codec
+from common.errors import IncorrectDataRecivedError
+from common.variables import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, RESPONSE, DATA, RESPONSE_511, \
+    MAX_CONNECTIONS, SELECT_TIMEOUT, CODECS, AUTH_TIMEOUT
+
+SERVER_LOG = logging.getLogger('app.server')
+
+
+class StreamConnection:
+    """
+    Класс - обёртка над парой StreamReader/StreamWriter.
+    Предоставляет обработчикам класса Server тот же интерфейс,
+    что и сокет (send, getpeername, close), поэтому разбор
+    протокола JIM остаётся общим для обеих реализаций сервера.
+    Методы можно вызывать из любого потока - запись передаётся
+    в цикл событий через call_soon_threadsafe.
+    """
+
+    def __init__(self, loop, reader, writer):
+        self.loop = loop
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+
+    def send(self, data):
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+        return len(data)
+
+    sendall = send
+
+    def getpeername(self):
+        return self.writer.get_extra_info('peername')[:2]
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+    def __repr__(self):
+        return f'<StreamConnection raddr={self.writer.get_extra_info("peername")}>'
+
+
+class AsyncServer(Server):
+    """
+    Сервер на asyncio. Каждое соединение обслуживается отдельной
+    корутиной, поэтому простаивающие клиенты ничего не стоят.
+    Обработка сообщений (process_client_message и все запросы к
+    ServerStorage) выполняется в однопоточном исполнителе, чтобы
+    цикл событий никогда не блокировался на базе данных, а состояние
+    сервера изменялось только из одного потока.
+    """
+
+    def __init__(self, listen_address, listen_port, database, **kwargs):
+        super().__init__(listen_address, listen_port, database, **kwargs)
+        # Цикл событий, создаётся при запуске потока
+        self.loop = None
+        # Исполнитель для блокирующих вызовов базы данных и обработчиков
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='server_db')
+
+    def run(self):
+        '''Метод основной цикл потока.'''
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        '''Корутина запуска сервера, работает пока установлен флаг running.'''
+        self.loop = asyncio.get_running_loop()
+        SERVER_LOG.info(
+            f'Запущен asyncio сервер, порт для подключений: {self.port} , адрес с которого принимаются подключения: {self.addr}. Если адрес не указан, принимаются соединения с любых адресов.')
+        listener = await asyncio.start_server(
+            self.handle_connection, self.addr or None, self.port, backlog=MAX_CONNECTIONS)
+        async with listener:
+            while self.running:
+                await asyncio.sleep(SELECT_TIMEOUT)
+                # Записываем накопленную статистику, если подошёл срок
+                await self.run_db(self.database.flush_stats_if_due)
+        await self.run_db(self.database.close)
+        self.executor.shutdown(wait=False)
+
+    def call_soon(self, func, *args):
+        '''Метод постановки вызова в очередь: состояние сервера изменяет только исполнитель.'''
+        self.executor.submit(func, *args)
+
+    async def run_db(self, func, *args):
+        '''Выполнение блокирующего вызова в исполнителе базы данных.'''
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def read_message(self, reader):
+        '''Чтение очередного сообщения клиента, None - соединение закрыто.'''
+        try:
+            header = await reader.readexactly(HEADER.size)
+            length, codec = unpack_header(header)
+            data = await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            return None
+        return decode_message(data, codec)
+
+    async def handle_connection(self, reader, writer):
+        '''Корутина обслуживания одного клиентского соединения.'''
+        conn = StreamConnection(self.loop, reader, writer)
+        SERVER_LOG.info(f'Установлено соедение с ПК {conn.getpeername()}')
+        self.clients.append(conn)
+        # Границы буфера отправки транспорта: выше верхней drain() ждёт,
+        # пока буфер не опустится ниже нижней
+        writer.transport.set_write_buffer_limits(self.high_watermark, self.low_watermark)
+        try:
+            while self.running and not conn.closed:
+                # Не читаем от клиента, пока он не принял наши ответы
+                await writer.drain()
+                message = await self.read_message(reader)
+                if message is None:
+                    break
+                if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
+                    await self.autorize_user_async(message, conn)
+                else:
+                    await self.run_db(self.process_client_message, message, conn)
+        except (OSError, ValueError, TypeError, IncorrectDataRecivedError) as err:
+            # ValueError - в том числе json.JSONDecodeError
+            SERVER_LOG.debug(f'Getting data from client exception.', exc_info=err)
+        except asyncio.CancelledError:
+            # Сервер останавливается - цикл событий отменяет корутины соединений
+            writer.close()
+            return
+        if not conn.closed:
+            await self.run_db(self.remove_client, conn)
+
+    async def autorize_user_async(self, message, conn):
+        '''
+        Корутина авторизации пользователя. Повторяет autorize_user,
+        но ожидание ответа клиента не блокирует остальные соединения.
+        '''
+        account_name = message[USER][ACCOUNT_NAME]
+        SERVER_LOG.debug(f'Start auth process for {message[USER]}')
+        if self.user_online(account_name):
+            await self.run_db(self.reject_user, conn, 'Имя пользователя уже занято.')
+            return
+        if not await self.run_db(self.database.check_user, account_name):
+            await self.run_db(self.reject_user, conn, 'Пользователь не зарегистрирован.')
+            return
+
+        self.codecs[conn] = choose_codec(message.get(CODECS))
+        message_auth = RESPONSE_511.copy()
+        random_str = binascii.hexlify(os.urandom(64))
+        message_auth[DATA] = random_str.decode('ascii')
+        passwd_hash = await self.run_db(self.database.get_hash, account_name)
+        self.send_to_client(conn, message_auth)
+        try:
+            ans = await asyncio.wait_for(self.read_message(conn.reader), AUTH_TIMEOUT)
+        except asyncio.TimeoutError:
+            ans = None
+        # Ответ разбирается как в Server.process_auth_answer: некорректный - отказ
+        client_digest = None
+        if ans and RESPONSE in ans and ans[RESPONSE] == 511 and isinstance(ans.get(DATA), str):
+            try:
+                client_digest = binascii.a2b_base64(ans[DATA])
+            except binascii.Error:
+                pass
+        if client_digest is not None and check_digest(passwd_hash, random_str, client_digest):
+            await self.run_db(self.finish_login, account_name, conn)
+        else:
+            await self.run_db(self.reject_user, conn, 'Неверный пароль.')
+
+    def write_to_client(self, client, data, bounded=True):
+        '''
+        Метод отправки кадра клиенту. Запись буферизуется транспортом,
+        при переполнении буфера применяется политика для медленных клиентов.
+        '''
+        if client.closed:
+            raise ConnectionResetError('Соединение с клиентом закрыто.')
+        if bounded and client.writer.transport.get_write_buffer_size() > self.high_watermark:
+            return self.slow_client(client)
+        client.send(data)
+        return True
+
+    def finish_login(self, account_name, conn):
+        '''Регистрация пользователя после проверки пароля (в потоке базы данных).'''
+        # Имя могли занять, пока клиент отвечал на запрос авторизации
+        if self.user_online(account_name):
+            self.reject_user(conn, 'Имя пользователя уже занято.')
+        else:
+            self.login_user(account_name, conn)
+
+    def close_connection(self, client):
+        '''Метод закрывающий соединение клиента.'''
+        try:
+            SERVER_LOG.info(f'Клиент {client.getpeername()} отключился от сервера.')
+        except (OSError, TypeError):
+            pass
+        if client in self.clients:
+            self.clients.remove(client)
+        self.codecs.pop(client, None)
+        client.close()
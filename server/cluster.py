@@ -0,0 +1,274 @@
+"""
+Многопроцессный режим сервера.
+
+Несколько процессов - обработчиков слушают один порт (SO_REUSEPORT),
+ядро ОС распределяет между ними входящие соединения. Процессы
+связаны локальной шиной на датаграммных Unix сокетах: о входе и
+выходе пользователей сообщается всем процессам (общая карта
+присутствия), а сообщение пользователю, подключённому к другому
+процессу, пересылается этому процессу.
+"""
+
+import os
+import sys
+import time
+import shutil
+import signal
+import select
+import socket
+import selectors
+import tempfile
+import threading
+import multiprocessing
+import logging
+
+import server.logs.server_log_config
+
+sys.path.append('../')
+
+from server.core import Server
+from server.server_db import ServerStorage
+from common.codecs import JsonCodec
+from common.proj_decorators import set_call_logging
+from common.utils import decode_message
+from common.variables import ACTION, ACCOUNT_NAME, DATA, MESSAGE_RECEIVER, ROOM
+
+SERVER_LOG = logging.getLogger('app.server')
+
+# События шины
+BUS_LOGIN = 'bus_login'
+BUS_LOGOUT = 'bus_logout'
+BUS_MESSAGE = 'bus_message'
+BUS_ROOM_MESSAGE = 'bus_room_message'
+BUS_ROOM_CHANGED = 'bus_room_changed'
+# Номер процесса - источника события
+WORKER = 'worker'
+# Участники комнаты, подключённые к процессу - получателю события
+MEMBERS = 'members'
+
+# Максимальный размер датаграммы шины
+BUS_MAX_DATAGRAM = 256 * 1024
+# Таймаут отправки в шину, если очередь получателя заполнена (сек.)
+BUS_SEND_TIMEOUT = 1
+# Пауза между попытками отправки в заполненную очередь (сек.)
+BUS_RETRY_INTERVAL = 0.01
+# Время ожидания завершения процессов при остановке (сек.)
+WORKER_STOP_TIMEOUT = 5
+
+
+class ClusterServer(Server):
+    """
+    Сервер - процесс-обработчик многопроцессного режима.
+    Кроме клиентских сокетов обслуживает в том же селекторе
+    входящий сокет шины.
+    """
+    reuse_port = True
+
+    def __init__(self, listen_address, listen_port, database, worker_id, workers, bus_dir, **kwargs):
+        super().__init__(listen_address, listen_port, database, **kwargs)
+        # Номер процесса и адреса шины всех процессов
+        self.worker_id = worker_id
+        self.bus_paths = [os.path.join(bus_dir, f'worker_{i}.sock') for i in range(workers)]
+
+        # Пользователи, подключённые к другим процессам: имя -> номер процесса
+        self.remote_names = dict()
+
+        # Входящий сокет шины обслуживается селектором. Оба сокета
+        # неблокирующие: при заполненной очереди получателя отправитель
+        # ненадолго ждёт (см. bus_send), а не теряет событие.
+        self.bus_in = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.bus_in.bind(self.bus_paths[worker_id])
+        self.bus_in.setblocking(False)
+        self.bus_out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.bus_out.setblocking(False)
+
+    def init_socket(self):
+        '''Метод инициализатор сокета, дополнительно подключает шину к селектору.'''
+        super().init_socket()
+        self.selector.register(self.bus_in, selectors.EVENT_READ, self.read_bus)
+
+    def run(self):
+        '''Метод основной цикл процесса.'''
+        try:
+            super().run()
+        finally:
+            self.bus_in.close()
+            self.bus_out.close()
+
+    def bus_send(self, worker, event):
+        '''
+        Метод отправки события процессу worker, возвращает успех отправки.
+        Пока очередь получателя заполнена, принимает события своей шины:
+        иначе два процесса, одновременно пишущие друг другу, ждали бы
+        друг друга до таймаута.
+        '''
+        data = JsonCodec.dumps(event)
+        deadline = time.monotonic() + BUS_SEND_TIMEOUT
+        while True:
+            try:
+                self.bus_out.sendto(data, self.bus_paths[worker])
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    SERVER_LOG.error(f'Не удалось отправить событие процессу {worker}: очередь заполнена')
+                    return False
+                select.select([self.bus_in], [], [], BUS_RETRY_INTERVAL)
+                self.read_bus(self.bus_in, selectors.EVENT_READ)
+            except OSError as err:
+                SERVER_LOG.error(f'Не удалось отправить событие процессу {worker}: {err}')
+                return False
+
+    def bus_broadcast(self, event):
+        '''Метод рассылки события всем остальным процессам.'''
+        for worker in range(len(self.bus_paths)):
+            if worker != self.worker_id:
+                self.bus_send(worker, event)
+
+    def read_bus(self, bus_sock, mask):
+        '''Метод обработчик готовности шины к чтению, принимает все события.'''
+        while True:
+            try:
+                data = bus_sock.recv(BUS_MAX_DATAGRAM)
+            except BlockingIOError:
+                return
+            try:
+                event = decode_message(data, JsonCodec)
+            except ValueError:
+                SERVER_LOG.error(f'Принято некорректное событие шины.')
+                continue
+            self.process_bus_event(event)
+
+    def process_bus_event(self, event):
+        '''Метод обработчик события шины.'''
+        action = event.get(ACTION)
+        if action == BUS_LOGIN:
+            self.remote_names[event[ACCOUNT_NAME]] = event[WORKER]
+        elif action == BUS_LOGOUT:
+            # Пользователь мог уже войти через другой процесс
+            if self.remote_names.get(event[ACCOUNT_NAME]) == event[WORKER]:
+                del self.remote_names[event[ACCOUNT_NAME]]
+        elif action == BUS_MESSAGE:
+            # Доставка своему клиенту, иначе - в очередь для пользователей не в сети
+            super().process_message(event[DATA])
+        elif action == BUS_ROOM_MESSAGE:
+            offline = super().deliver_room_message(event[DATA], event[MEMBERS])
+            if offline:
+                self.database.store_offline_broadcast(offline, event[DATA])
+        elif action == BUS_ROOM_CHANGED:
+            # Состав комнаты изменён через другой процесс - кэш устарел
+            self.database.invalidate_room(event[ROOM])
+
+    def register_name(self, account_name, client):
+        '''Метод сопоставления имени и сокета, сообщает о входе остальным процессам.'''
+        super().register_name(account_name, client)
+        self.bus_broadcast({ACTION: BUS_LOGIN, ACCOUNT_NAME: account_name, WORKER: self.worker_id})
+
+    def unregister_name(self, client):
+        '''Метод удаления сопоставления сокета, сообщает о выходе остальным процессам.'''
+        name = super().unregister_name(client)
+        if name is not None:
+            self.bus_broadcast({ACTION: BUS_LOGOUT, ACCOUNT_NAME: name, WORKER: self.worker_id})
+        return name
+
+    def room_changed(self, room):
+        '''Метод оповещения остальных процессов об изменении состава комнаты.'''
+        self.bus_broadcast({ACTION: BUS_ROOM_CHANGED, ROOM: room, WORKER: self.worker_id})
+
+    def user_online(self, account_name):
+        '''Метод проверки, подключён ли пользователь к любому из процессов.'''
+        return super().user_online(account_name) or account_name in self.remote_names
+
+    def process_message(self, message):
+        '''
+        Метод отправки сообщения клиенту. Сообщение пользователю
+        другого процесса пересылается через шину.
+        '''
+        worker = self.remote_names.get(message[MESSAGE_RECEIVER])
+        if message[MESSAGE_RECEIVER] not in self.names and worker is not None:
+            if self.bus_send(worker, {ACTION: BUS_MESSAGE, DATA: message, WORKER: self.worker_id}):
+                return
+        super().process_message(message)
+
+    def deliver_room_message(self, message, recipients):
+        '''
+        Метод отправки сообщения в комнату. Участникам других процессов
+        сообщение пересылается одним событием шины на процесс.
+        '''
+        local = []
+        remote = dict()
+        for name in recipients:
+            worker = self.remote_names.get(name)
+            if name not in self.names and worker is not None:
+                remote.setdefault(worker, []).append(name)
+            else:
+                local.append(name)
+        for worker, names in remote.items():
+            event = {ACTION: BUS_ROOM_MESSAGE, DATA: message, MEMBERS: names, WORKER: self.worker_id}
+            if not self.bus_send(worker, event):
+                # Не доставленное процессу сохраняется как для пользователей не в сети
+                local.extend(names)
+        return super().deliver_room_message(message, local)
+
+
+def run_worker(worker_id, workers, bus_dir, database_lock, barrier, stop_event, listen_address, listen_port,
+               database_path, pragmas, call_logging, server_options):
+    '''Функция - тело процесса-обработчика.'''
+    set_call_logging(call_logging)
+    # Ctrl+C получает вся группа процессов, останавливает их главный процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Базу открываем по очереди: первый процесс создаёт таблицы
+    with database_lock:
+        database = ServerStorage(database_path, pragmas)
+    server = ClusterServer(listen_address, listen_port, database, worker_id, workers, bus_dir, **server_options)
+    # Начинаем принимать соединения, когда шина готова у всех процессов
+    barrier.wait()
+
+    def stop(*args):
+        server.running = False
+
+    def wait_stop():
+        stop_event.wait()
+        stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    threading.Thread(target=wait_stop, daemon=True).start()
+    SERVER_LOG.info(f'Запущен процесс-обработчик {worker_id} (pid {os.getpid()}).')
+    server.run()
+
+
+def run_cluster(workers, listen_address, listen_port, database_path, pragmas=None, call_logging=False,
+                **server_options):
+    '''
+    Функция запуска многопроцессного режима: workers процессов-обработчиков
+    на одном порту. Работает до Ctrl+C или завершения процессов.
+    '''
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+        raise RuntimeError('Многопроцессный режим не поддерживается в этой ОС.')
+    # Процессы запускаются заново (spawn): отображения ORM и пул соединений
+    # не должны наследоваться от главного процесса
+    context = multiprocessing.get_context('spawn')
+    bus_dir = tempfile.mkdtemp(prefix='jim_bus_')
+    database_lock = context.Lock()
+    barrier = context.Barrier(workers)
+    stop_event = context.Event()
+    processes = [
+        context.Process(
+            target=run_worker, name=f'server_worker_{worker_id}',
+            args=(worker_id, workers, bus_dir, database_lock, barrier, stop_event, listen_address, listen_port,
+                  database_path, pragmas, call_logging, server_options))
+        for worker_id in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        SERVER_LOG.info('Остановка многопроцессного режима.')
+    finally:
+        stop_event.set()
+        for process in processes:
+            process.join(WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        shutil.rmtree(bus_dir, ignore_errors=True)
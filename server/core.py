@@ -1,12 +1,16 @@
 import binascii
+import datetime
 import hmac
 import json
 import os
 import sys
+import time
 import threading
-import select
+import selectors
 import socket
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import server.logs.server_log_config
 from common.proj_decorators import func_to_log, login_required
 
@@ -14,19 +18,50 @@ sys.path.append('../')
 
 SERVER_LOG = logging.getLogger('app.server')
 
-from common.utils import get_message, send_message
+from common.utils import encode_message, MessageBuffer
+from common.codecs import DEFAULT_CODEC, choose_codec
+from common.errors import IncorrectDataRecivedError
 from common.descriptors import PortDescriptor
 from common.metaclasses import ServerVerifier
 from common.variables import RESPONSE_202, LIST_INFO, GET_CONTACTS, ADD_CONTACT, RESPONSE_200, \
     RESPONSE_400, REMOVE_CONTACT, USERS_REQUEST, ACTION, PRESENCE, USER, ACCOUNT_NAME, ERROR, \
     MAX_CONNECTIONS, TIME, MESSAGE_TEXT, MESSAGE, SENDER, MESSAGE_RECEIVER, EXIT, RESPONSE, PUBLIC_KEY, DATA, \
-    RESPONSE_511, RESPONSE_205
+    RESPONSE_511, RESPONSE_205, SELECT_TIMEOUT, MAX_PACKAGE_LENGTH, CODECS, CODEC, OUTBOX_HIGH_WATERMARK, \
+    OUTBOX_LOW_WATERMARK, SLOW_CLIENT_POLICY, SLOW_CLIENT_DROP, SLOW_CLIENT_DISCONNECT, SLOW_CLIENT_SPILL, AUTH_TIMEOUT, \
+    AUTH_WORKERS, REVISION, SINCE, ADDED, REMOVED, EPOCH, REQUEST_ID, CREATE_ROOM, JOIN_ROOM, LEAVE_ROOM, \
+    ROOM_MESSAGE, ROOM
 
 sys.path.append('../')
 
 new_connection = False
 conflag_lock = threading.Lock()
 
+# События сервера для подписчиков (окно сервера, консоль администратора)
+USER_LOGIN = 'user_login'
+USER_LOGOUT = 'user_logout'
+
+
+class AuthState:
+    '''
+    Класс - состояние авторизации клиента: запрос (511) отправлен
+    и ожидается ответ, либо ответ проверяется в пуле потоков.
+    '''
+    CHALLENGE_SENT = 'challenge_sent'
+    VERIFYING = 'verifying'
+
+    def __init__(self, account_name, passwd_hash, random_str):
+        self.account_name = account_name
+        self.passwd_hash = passwd_hash
+        self.random_str = random_str
+        self.stage = self.CHALLENGE_SENT
+        self.deadline = time.monotonic() + AUTH_TIMEOUT
+
+
+def check_digest(passwd_hash, random_str, client_digest):
+    '''Функция проверки ответа клиента на запрос авторизации.'''
+    digest = hmac.new(passwd_hash, random_str, 'MD5').digest()
+    return hmac.compare_digest(digest, client_digest)
+
 
 class Server(threading.Thread):
     """
@@ -36,11 +71,22 @@ class Server(threading.Thread):
     """
     listen_port = PortDescriptor()
 
-    def __init__(self, listen_address, listen_port, database):
+    # Разрешить нескольким процессам слушать один порт (SO_REUSEPORT)
+    reuse_port = False
+
+    def __init__(self, listen_address, listen_port, database, high_watermark=OUTBOX_HIGH_WATERMARK,
+                 low_watermark=OUTBOX_LOW_WATERMARK, slow_client_policy=SLOW_CLIENT_POLICY):
         # Параметры подключения
         self.addr = listen_address
         self.port = listen_port
 
+        # Границы очереди отправки и политика для медленных клиентов
+        if slow_client_policy not in (SLOW_CLIENT_DROP, SLOW_CLIENT_DISCONNECT, SLOW_CLIENT_SPILL):
+            raise ValueError(f'Неизвестная политика для медленных клиентов: {slow_client_policy}')
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.slow_client_policy = slow_client_policy
+
         # База данных сервера
         self.database = database
 
@@ -50,9 +96,47 @@ class Server(threading.Thread):
         # Список подключённых клиентов.
         self.clients = []
 
-        # Сокеты
-        self.listen_sockets = None
-        self.error_sockets = None
+        # Селектор (epoll/kqueue/select в зависимости от ОС), в котором
+        # зарегистрированы слушающий сокет и сокеты клиентов. В поле data
+        # ключа регистрации хранится обработчик события готовности.
+        self.selector = selectors.DefaultSelector()
+
+        # Буферы приёма клиентских сокетов: накапливают байты до получения
+        # целого кадра, за одно чтение может прийти несколько сообщений.
+        self.buffers = dict()
+
+        # Кодеки, согласованные с клиентами при авторизации (по умолчанию json)
+        self.codecs = dict()
+
+        # Очереди отправки клиентских сокетов: байты, которые не удалось
+        # отправить сразу, досылаются при готовности сокета к записи.
+        self.outboxes = dict()
+
+        # Медленные клиенты - очередь отправки превысила верхнюю границу.
+        # Чтение от них приостановлено, пока очередь не опустится ниже нижней.
+        self.slow_clients = set()
+
+        # Авторизация без блокировки основного потока: состояния клиентов,
+        # проходящих авторизацию, пул потоков для проверки их ответов и
+        # очередь готовых результатов проверки.
+        self.auth_states = dict()
+        self.auth_executor = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix='server_auth')
+        self.auth_results = deque()
+
+        # Команды других потоков (GUI), выполняемые в потоке сервера: всё
+        # состояние соединений (очереди отправки, регистрация в селекторе)
+        # изменяется только этим потоком
+        self.commands = deque()
+
+        # Пара сокетов для пробуждения селектора из потоков пула и GUI
+        self.wakeup_reader = None
+        self.wakeup_writer = None
+
+        # Ревизия списка пользователей, последней разосланная клиентам
+        self.users_revision = database.users_revision()
+
+        # Подписчики на события сервера (вход и выход пользователей)
+        self.listeners = []
 
         # Флаг продолжения работы
         self.running = True
@@ -61,6 +145,11 @@ class Server(threading.Thread):
         # {'test1': <socket.socket fd=25, family=AddressFamily.AF_INET, type=SocketKind.SOCK_STREAM, proto=0, laddr=('127.0.0.1', 7777), raddr=('127.0.0.1', 52420)>}
         self.names = dict()
 
+        # Обратный словарь: сокет -> имя авторизованного пользователя.
+        # Вместе с names даёт поиск за O(1) в обе стороны, изменяются
+        # только методами register_name и unregister_name.
+        self.client_names = dict()
+
         # Конструктор предка
         super().__init__()
 
@@ -69,54 +158,220 @@ class Server(threading.Thread):
         # Инициализация Сокета
         self.init_socket()
 
-        # Основной цикл программы сервера
+        # Основной цикл программы сервера. Поток спит в селекторе до
+        # появления событий на сокетах, таймаут нужен лишь для проверки
+        # флага running.
         while self.running:
-            # Ждём подключения, если таймаут вышел, ловим исключение.
-            try:
-                client, client_address = self.sock.accept()
-            except OSError:
-                pass
-            else:
-                SERVER_LOG.info(f'Установлено соедение с ПК {client_address}')
-                client.settimeout(5)
-                self.clients.append(client)
-
-            recv_data_lst = []
-            send_data_lst = []
-            err_lst = []
-            # Проверяем на наличие ждущих клиентов
             try:
-                if self.clients:
-                    recv_data_lst, self.listen_sockets, self.error_sockets = select.select(
-                        self.clients, self.clients, [], 0)
+                events = self.selector.select(SELECT_TIMEOUT)
             except (OSError, ValueError) as err:
-                SERVER_LOG.error(f'Ошибка работы с сокетами: {err.errno}')
-
-            # принимаем сообщения и если ошибка, исключаем клиента.
-            if recv_data_lst:
-                for client_with_message in recv_data_lst:
-                    try:
-                        self.process_client_message(
-                            get_message(client_with_message), client_with_message)
-                    except (OSError, json.JSONDecodeError, TypeError) as err:
-                        SERVER_LOG.debug(f'Getting data from client exception.', exc_info=err)
-                        self.remove_client(client_with_message)
+                SERVER_LOG.error(f'Ошибка работы с сокетами: {err}')
+                continue
+            for key, mask in events:
+                handler = key.data
+                handler(key.fileobj, mask)
+            # Отключаем клиентов, не ответивших на запрос авторизации
+            self.check_auth_timeouts()
+            # Записываем накопленную статистику, если подошёл срок
+            self.database.flush_stats_if_due()
+
+        # При остановке сохраняем статистику, накопленную в памяти
+        self.auth_executor.shutdown(wait=False)
+        self.database.close()
+
+    def accept_client(self, listen_sock, mask):
+        '''Метод обработчик нового подключения на слушающем сокете.'''
+        try:
+            client, client_address = listen_sock.accept()
+        except OSError:
+            return
+        SERVER_LOG.info(f'Установлено соедение с ПК {client_address}')
+        client.setblocking(False)
+        self.clients.append(client)
+        self.buffers[client] = MessageBuffer()
+        self.outboxes[client] = bytearray()
+        self.selector.register(client, selectors.EVENT_READ, self.serve_client)
+
+    def serve_client(self, client, mask):
+        '''
+        Метод обработчик событий клиентского сокета. Клиента могли отключить
+        при обработке предыдущих событий той же выборки селектора.
+        '''
+        if mask & selectors.EVENT_WRITE and client in self.outboxes:
+            self.write_client(client)
+        if mask & selectors.EVENT_READ and client in self.buffers:
+            self.read_client(client)
+
+    def read_client(self, client):
+        '''
+        Метод обработчик готовности клиентского сокета к чтению.
+        Принимает все пришедшие сообщения и если ошибка, исключает клиента.
+        '''
+        try:
+            try:
+                data = client.recv(MAX_PACKAGE_LENGTH)
+            except BlockingIOError:
+                return
+            if not data:
+                raise ConnectionResetError('Соединение закрыто клиентом.')
+            for message in self.buffers[client].feed(data):
+                # Клиент в процессе авторизации присылает только ответ на запрос
+                if client in self.auth_states:
+                    self.process_auth_answer(message, client)
+                else:
+                    self.process_client_message(message, client)
+                # Клиент мог быть отключён при обработке (выход, ошибка авторизации)
+                if client not in self.buffers:
+                    break
+        except (OSError, json.JSONDecodeError, TypeError, IncorrectDataRecivedError) as err:
+            SERVER_LOG.debug(f'Getting data from client exception.', exc_info=err)
+            self.remove_client(client)
 
     @func_to_log
-    def remove_client(self, client):
+    def remove_client(self, client, logout=True):
         '''
         Метод обработчик клиента с которым прервана связь.
-        Ищет клиента и удаляет его из списков и базы:
+        Ищет клиента и удаляет его из списков и базы. logout=False -
+        без отметки о выходе в базе (пользователь из неё удалён),
+        подписчики всё равно получают событие выхода.
         '''
-        SERVER_LOG.info(f'Клиент {client.getpeername()} отключился от сервера.')
-        for name in self.names:
-            if self.names[name] == client:
+        name = self.unregister_name(client)
+        if name is not None:
+            if logout:
                 self.database.user_logout(name)
-                del self.names[name]
-                break
-        self.clients.remove(client)
+            self.notify(USER_LOGOUT, name)
+        self.close_connection(client)
+
+    def add_listener(self, listener):
+        '''
+        Метод подписки на события сервера. Подписчик вызывается в потоке
+        сервера как listener(event, account_name, info), где info для
+        USER_LOGIN - кортеж (ip, порт, время входа), для USER_LOGOUT - None.
+        '''
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        '''Метод отписки от событий сервера.'''
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def notify(self, event, account_name, info=None):
+        '''Метод оповещения подписчиков о событии, ошибка подписчика не мешает серверу.'''
+        for listener in list(self.listeners):
+            try:
+                listener(event, account_name, info)
+            except Exception as err:
+                SERVER_LOG.error(f'Ошибка подписчика на события сервера: {err}')
+
+    def register_name(self, account_name, client):
+        '''Метод сопоставления имени пользователя и сокета клиента.'''
+        self.names[account_name] = client
+        self.client_names[client] = account_name
+
+    def user_online(self, account_name):
+        '''Метод проверки, подключён ли пользователь к серверу.'''
+        return account_name in self.names
+
+    def unregister_name(self, client):
+        '''Метод удаления сопоставления сокета клиента, возвращает имя или None.'''
+        name = self.client_names.pop(client, None)
+        if name is not None and self.names.get(name) is client:
+            del self.names[name]
+        return name
+
+    def close_connection(self, client):
+        '''Метод снимающий сокет с регистрации в селекторе и закрывающий его.'''
+        try:
+            SERVER_LOG.info(f'Клиент {client.getpeername()} отключился от сервера.')
+        except OSError:
+            pass
+        try:
+            self.selector.unregister(client)
+        except (KeyError, ValueError):
+            pass
+        if client in self.clients:
+            self.clients.remove(client)
+        self.buffers.pop(client, None)
+        self.codecs.pop(client, None)
+        self.outboxes.pop(client, None)
+        self.slow_clients.discard(client)
+        self.auth_states.pop(client, None)
         client.close()
 
+    def send_to_client(self, client, message):
+        '''Метод отправки сообщения клиенту согласованным с ним кодеком.'''
+        return self.write_to_client(client, encode_message(message, self.codecs.get(client, DEFAULT_CODEC)))
+
+    def write_to_client(self, client, data, bounded=True):
+        '''
+        Метод отправки кадра клиенту без блокировки. Что не удалось
+        отправить сразу, ставится в очередь отправки клиента.
+        Возвращает False, если кадр отброшен политикой drop или spill.
+        Для медленного клиента с политикой disconnect, как и при
+        разрыве связи, генерирует OSError. При bounded=False кадр
+        ставится в очередь без учёта её границ.
+        '''
+        outbox = self.outboxes.get(client)
+        if outbox is None:
+            raise ConnectionResetError('Соединение с клиентом закрыто.')
+        if bounded and client in self.slow_clients:
+            return self.slow_client(client)
+        if not outbox:
+            try:
+                sent = client.send(data)
+            except BlockingIOError:
+                sent = 0
+            if sent == len(data):
+                return True
+            data = memoryview(data)[sent:]
+        outbox += data
+        if bounded and len(outbox) > self.high_watermark:
+            self.slow_clients.add(client)
+            if self.slow_client_policy == SLOW_CLIENT_DISCONNECT:
+                return self.slow_client(client)
+            SERVER_LOG.warning(f'Клиент {client.getpeername()} не успевает принимать сообщения.')
+        self.update_events(client)
+        return True
+
+    def slow_client(self, client):
+        '''Метод применения политики к клиенту, не успевающему принимать сообщения.'''
+        if self.slow_client_policy == SLOW_CLIENT_DISCONNECT:
+            raise ConnectionAbortedError('Клиент не успевает принимать сообщения.')
+        SERVER_LOG.debug(f'Очередь отправки клиента переполнена, сообщение отброшено.')
+        return False
+
+    def write_client(self, client):
+        '''Метод обработчик готовности клиентского сокета к записи.'''
+        outbox = self.outboxes[client]
+        try:
+            sent = client.send(outbox)
+        except BlockingIOError:
+            return
+        except OSError as err:
+            SERVER_LOG.debug(f'Sending data to client exception.', exc_info=err)
+            self.remove_client(client)
+            return
+        del outbox[:sent]
+        if client in self.slow_clients and len(outbox) <= self.low_watermark:
+            self.slow_clients.discard(client)
+            # Клиент разгрузил очередь - досылаем отложенные для него сообщения
+            if self.slow_client_policy == SLOW_CLIENT_SPILL and client in self.client_names:
+                self.deliver_offline_messages(self.client_names[client], client)
+                if client not in self.outboxes:
+                    return
+        self.update_events(client)
+
+    def update_events(self, client):
+        '''
+        Метод обновления событий клиентского сокета в селекторе:
+        запись - пока есть очередь отправки, чтение - пока клиент не медленный.
+        '''
+        events = 0 if client in self.slow_clients else selectors.EVENT_READ
+        if self.outboxes[client]:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(client).events != events:
+            self.selector.modify(client, events, self.serve_client)
+
     def init_socket(self):
         '''Метод инициализатор сокета.'''
         SERVER_LOG.info(
@@ -124,35 +379,185 @@ class Server(threading.Thread):
         # Готовим сокет
         transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         transport.bind((self.addr, self.port))
-        transport.settimeout(1)
+        transport.setblocking(False)
 
         # Начинаем слушать сокет.
         self.sock = transport
         self.sock.listen(MAX_CONNECTIONS)
+        self.selector.register(self.sock, selectors.EVENT_READ, self.accept_client)
+        self.init_wakeup()
+
+    def init_wakeup(self):
+        '''Метод создания пары сокетов для пробуждения селектора.'''
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, self.read_wakeup)
+        # Команды, поставленные до запуска, выполняются на первой итерации
+        if self.commands:
+            self.wakeup()
+
+    def wakeup(self):
+        '''Метод пробуждения селектора, можно вызывать из любого потока.'''
+        if self.wakeup_writer is None:
+            # Сервер ещё не запущен - команды выполнятся при запуске
+            return
+        try:
+            self.wakeup_writer.send(b'\0')
+        except OSError:
+            # Буфер полон - пробуждение и так произойдёт
+            pass
+
+    def read_wakeup(self, reader, mask):
+        '''
+        Метод обработчик пробуждения: завершает авторизации, проверенные
+        в пуле, и выполняет команды других потоков.
+        '''
+        try:
+            reader.recv(MAX_PACKAGE_LENGTH)
+        except BlockingIOError:
+            pass
+        while self.auth_results:
+            sock, future = self.auth_results.popleft()
+            self.finish_auth(sock, future)
+        while self.commands:
+            func, args = self.commands.popleft()
+            try:
+                func(*args)
+            except Exception as err:
+                SERVER_LOG.error(f'Ошибка выполнения команды {func.__name__}: {err}')
+
+    def call_soon(self, func, *args):
+        '''
+        Метод постановки вызова func(*args) в очередь потока сервера.
+        Другие потоки (GUI) не вызывают методы соединений напрямую, а
+        только через него.
+        '''
+        self.commands.append((func, args))
+        self.wakeup()
+
+    def disconnect_user(self, account_name):
+        '''Метод отключения пользователя, удалённого из базы (в потоке сервера).'''
+        sock = self.names.get(account_name)
+        if sock is not None:
+            # Пользователь уже удалён из базы, отметка о выходе не нужна
+            self.remove_client(sock, logout=False)
 
     @func_to_log
     def process_message(self, message):
         '''
         Метод отправки сообщения клиенту.
         '''
-        if message[MESSAGE_RECEIVER] in self.names and self.names[message[MESSAGE_RECEIVER]
-        ] in self.listen_sockets:
+        receiver = self.names.get(message[MESSAGE_RECEIVER])
+        if receiver is not None:
             try:
-                send_message(self.names[message[MESSAGE_RECEIVER]], message)
-                SERVER_LOG.info(
-                    f'Отправлено сообщение пользователю {message[MESSAGE_RECEIVER]} от пользователя {message[SENDER]}.')
+                if self.send_to_client(receiver, message):
+                    SERVER_LOG.info(
+                        f'Отправлено сообщение пользователю {message[MESSAGE_RECEIVER]} от пользователя {message[SENDER]}.')
+                    return
+                if self.slow_client_policy != SLOW_CLIENT_SPILL:
+                    SERVER_LOG.warning(
+                        f'Пользователь {message[MESSAGE_RECEIVER]} не успевает принимать сообщения, сообщение от {message[SENDER]} отброшено.')
+                    return
             except OSError:
-                self.remove_client(message[MESSAGE_RECEIVER])
-        elif message[MESSAGE_RECEIVER] in self.names and self.names[
-            message[MESSAGE_RECEIVER]] not in self.listen_sockets:
-            SERVER_LOG.error(
-                f'Связь с клиентом {message[MESSAGE_RECEIVER]} была потеряна. Соединение закрыто, доставка невозможна.')
-            self.remove_client(self.names[message[MESSAGE_RECEIVER]])
+                SERVER_LOG.error(
+                    f'Связь с клиентом {message[MESSAGE_RECEIVER]} была потеряна. Соединение закрыто.')
+                self.remove_client(receiver)
+        # Получатель не в сети (или не успевает принимать) - сообщение
+        # сохраняется и будет доставлено при его входе
+        if self.database.store_offline_messages(message[MESSAGE_RECEIVER], [message]):
+            SERVER_LOG.info(
+                f'Сообщение пользователю {message[MESSAGE_RECEIVER]} от пользователя {message[SENDER]} отложено до его входа.')
         else:
             SERVER_LOG.error(
                 f'Пользователь {message[MESSAGE_RECEIVER]} не зарегистрирован на сервере, отправка сообщения невозможна.')
 
+    def process_room_message(self, message, recipients):
+        '''
+        Метод рассылки сообщения участникам комнаты. Участникам не в сети
+        сообщение сохраняется одной транзакцией.
+        '''
+        offline = self.deliver_room_message(message, recipients)
+        if offline:
+            self.database.store_offline_broadcast(offline, message)
+        SERVER_LOG.info(f'Сообщение от {message[SENDER]} в комнату {message[ROOM]}: получателей {len(recipients)}, '
+                        f'отложено {len(offline)}.')
+
+    def deliver_room_message(self, message, recipients):
+        '''
+        Метод отправки сообщения в комнату подключённым участникам.
+        Сообщение кодируется один раз для каждого кодека, всем участникам
+        отправляются одни и те же байты. Возвращает список участников,
+        которым сообщение не доставлено.
+        '''
+        frames = dict()
+        offline = []
+        for name in recipients:
+            sock = self.names.get(name)
+            if sock is None:
+                offline.append(name)
+                continue
+            codec = self.codecs.get(sock, DEFAULT_CODEC)
+            data = frames.get(codec)
+            if data is None:
+                data = frames[codec] = encode_message(message, codec)
+            try:
+                if not self.write_to_client(sock, data) and self.slow_client_policy == SLOW_CLIENT_SPILL:
+                    offline.append(name)
+            except OSError:
+                self.remove_client(sock)
+                offline.append(name)
+        return offline
+
+    def deliver_offline_messages(self, account_name, sock):
+        '''
+        Метод доставки сообщений, накопленных пока пользователь был не в сети.
+        Все сообщения отправляются одной записью в сокет.
+        '''
+        messages = self.database.pop_offline_messages(account_name)
+        if not messages:
+            return
+        codec = self.codecs.get(sock, DEFAULT_CODEC)
+        try:
+            # Объём ограничен лимитом очереди в базе, поэтому пачка ставится
+            # в очередь отправки целиком, без проверки верхней границы
+            self.write_to_client(sock, b''.join(encode_message(message, codec) for message in messages),
+                                 bounded=False)
+            SERVER_LOG.info(f'Пользователю {account_name} доставлено отложенных сообщений: {len(messages)}.')
+        except OSError:
+            self.database.store_offline_messages(account_name, messages)
+            self.remove_client(sock)
+
+    def room_changed(self, room):
+        '''
+        Метод, вызываемый после изменения состава комнаты. Кэш этого
+        процесса хранилище уже сбросило, в многопроцессном режиме
+        сбрасываются кэши остальных процессов.
+        '''
+        pass
+
+    def reply(self, client, request, response):
+        '''
+        Метод отправки ответа на запрос клиента. Идентификатор запроса,
+        если клиент его указал, повторяется в ответе.
+        '''
+        if REQUEST_ID in request:
+            response = dict(response)
+            response[REQUEST_ID] = request[REQUEST_ID]
+        return self.send_to_client(client, response)
+
+    @staticmethod
+    def forwarded(message):
+        '''Метод возвращающий сообщение для получателей - без идентификатора запроса отправителя.'''
+        if REQUEST_ID not in message:
+            return message
+        message = dict(message)
+        del message[REQUEST_ID]
+        return message
+
     @login_required
     @func_to_log
     def process_client_message(self, message, client):
@@ -165,65 +570,120 @@ class Server(threading.Thread):
 
         # Если это сообщение, то отправляем его получателю.
         elif ACTION in message and message[ACTION] == MESSAGE and MESSAGE_RECEIVER in message and TIME in message \
-                and SENDER in message and MESSAGE_TEXT in message and self.names[message[SENDER]] == client:
-            if message[MESSAGE_RECEIVER] in self.names:
+                and SENDER in message and MESSAGE_TEXT in message and self.client_names.get(client) == message[SENDER]:
+            # Сообщение пользователю не в сети будет доставлено при его входе
+            if message[MESSAGE_RECEIVER] in self.names or self.database.check_user(message[MESSAGE_RECEIVER]):
                 self.database.process_message(
                     message[SENDER], message[MESSAGE_RECEIVER])
-                self.process_message(message)
+                self.process_message(self.forwarded(message))
                 try:
-                    send_message(client, RESPONSE_200)
+                    self.reply(client, message, RESPONSE_200)
                 except OSError:
                     self.remove_client(client)
             else:
-                response = RESPONSE_400
+                response = RESPONSE_400.copy()
                 response[ERROR] = 'Пользователь не зарегистрирован на сервере.'
                 try:
-                    send_message(client, response)
+                    self.reply(client, message, response)
                 except OSError:
                     pass
             return
 
+        # Если это сообщение в комнату, рассылаем его участникам
+        elif ACTION in message and message[ACTION] == ROOM_MESSAGE and ROOM in message and TIME in message \
+                and SENDER in message and MESSAGE_TEXT in message and self.client_names.get(client) == message[SENDER]:
+            members = self.database.room_members(message[ROOM])
+            if members is not None and message[SENDER] in members:
+                recipients = [name for name in members if name != message[SENDER]]
+                self.database.process_room_message(message[SENDER], recipients)
+                self.process_room_message(self.forwarded(message), recipients)
+                response = RESPONSE_200
+            else:
+                response = RESPONSE_400.copy()
+                response[ERROR] = 'Комната не существует или вы не состоите в ней.'
+            try:
+                self.reply(client, message, response)
+            except OSError:
+                self.remove_client(client)
+            return
+
+        # Если это создание комнаты, вступление в комнату или выход из неё
+        elif ACTION in message and message[ACTION] in (CREATE_ROOM, JOIN_ROOM, LEAVE_ROOM) and ROOM in message \
+                and USER in message and self.client_names.get(client) == message[USER]:
+            if message[ACTION] == CREATE_ROOM:
+                done = self.database.create_room(message[ROOM], message[USER])
+                error = 'Комната уже существует.'
+            elif message[ACTION] == JOIN_ROOM:
+                done = self.database.join_room(message[ROOM], message[USER])
+                error = 'Комната не существует.'
+            else:
+                done = self.database.leave_room(message[ROOM], message[USER])
+                error = 'Комната не существует.'
+            if done:
+                self.room_changed(message[ROOM])
+                response = RESPONSE_200
+            else:
+                response = RESPONSE_400.copy()
+                response[ERROR] = error
+            try:
+                self.reply(client, message, response)
+            except OSError:
+                self.remove_client(client)
+
         # Если клиент выходит
         elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
+                and self.client_names.get(client) == message[ACCOUNT_NAME]:
             self.remove_client(client)
 
         # Если это запрос контакт-листа
         elif ACTION in message and message[ACTION] == GET_CONTACTS and USER in message and \
-                self.names[message[USER]] == client:
-            response = RESPONSE_202
+                self.client_names.get(client) == message[USER]:
+            response = RESPONSE_202.copy()
             response[LIST_INFO] = self.database.get_contacts(message[USER])
             try:
-                send_message(client, response)
+                self.reply(client, message, response)
             except OSError:
                 self.remove_client(client)
 
         # Если это добавление контакта
         elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
+                and self.client_names.get(client) == message[USER]:
             self.database.add_contact(message[USER], message[ACCOUNT_NAME])
             try:
-                send_message(client, RESPONSE_200)
+                self.reply(client, message, RESPONSE_200)
             except OSError:
                 self.remove_client(client)
 
         # Если это удаление контакта
         elif ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
+                and self.client_names.get(client) == message[USER]:
             self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
             try:
-                send_message(client, RESPONSE_200)
+                self.reply(client, message, RESPONSE_200)
             except OSError:
                 self.remove_client(client)
 
         # Если это запрос известных пользователей
         elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = [user[0]
-                                   for user in self.database.users_list()]
+                and self.client_names.get(client) == message[ACCOUNT_NAME]:
+            response = RESPONSE_202.copy()
+            # Клиент, знающий ревизию списка той же эпохи базы, получает
+            # только изменения
+            epoch = self.database.users_epoch()
+            response[EPOCH] = epoch
+            changes = self.database.users_changes(message[REVISION]) \
+                if REVISION in message and message.get(EPOCH) == epoch else None
+            if changes is None:
+                # Ревизию берём до списка: изменение между запросами
+                # клиент получит повторно, но не пропустит
+                response[REVISION] = self.database.users_revision()
+                response[LIST_INFO] = [user[0]
+                                       for user in self.database.users_list()]
+            else:
+                del response[LIST_INFO]
+                response[REVISION], response[ADDED], response[REMOVED] = changes
             try:
-                send_message(client, response)
+                self.reply(client, message, response)
             except OSError:
                 self.remove_client(client)
 
@@ -232,82 +692,147 @@ class Server(threading.Thread):
         """ Метод реализующий авторизацию пользователей. """
         # Если имя пользователя уже занято то возвращаем 400
         SERVER_LOG.debug(f'Start auth process for {message[USER]}')
-        if message[USER][ACCOUNT_NAME] in self.names.keys():
-            response = RESPONSE_400
-            response[ERROR] = 'Имя пользователя уже занято.'
-            try:
-                SERVER_LOG.debug(f'Username busy, sending {response}')
-                send_message(sock, response)
-            except OSError:
-                SERVER_LOG.debug('OS Error')
-                pass
-            self.clients.remove(sock)
-            sock.close()
+        if self.user_online(message[USER][ACCOUNT_NAME]):
+            SERVER_LOG.debug('Username busy.')
+            self.reject_user(sock, 'Имя пользователя уже занято.')
         # Проверяем что пользователь зарегистрирован на сервере.
         elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
-            response = RESPONSE_400
-            response[ERROR] = 'Пользователь не зарегистрирован.'
-            try:
-                SERVER_LOG.debug(f'Unknown username, sending {response}')
-                send_message(sock, response)
-            except OSError:
-                pass
-            self.clients.remove(sock)
-            sock.close()
+            SERVER_LOG.debug('Unknown username.')
+            self.reject_user(sock, 'Пользователь не зарегистрирован.')
         else:
             SERVER_LOG.debug('Correct username, starting passwd check.')
+            # Выбираем кодек из предложенных клиентом, дальше сервер
+            # отправляет этому клиенту сообщения в нём.
+            self.codecs[sock] = choose_codec(message.get(CODECS))
             # Иначе отвечаем 511 и проводим процедуру авторизации
             # Словарь - заготовка
-            message_auth = RESPONSE_511
+            message_auth = RESPONSE_511.copy()
             # Набор байтов в hex представлении
             random_str = binascii.hexlify(os.urandom(64))
             # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
             message_auth[DATA] = random_str.decode('ascii')
-            # Создаём хэш пароля и связки с рандомной строкой, сохраняем
-            # серверную версию ключа
-            hash = hmac.new(self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str, 'MD5')
-            digest = hash.digest()
             SERVER_LOG.debug(f'Auth message = {message_auth}')
             try:
-                # Обмен с клиентом
-                send_message(sock, message_auth)
-                ans = get_message(sock)
+                self.send_to_client(sock, message_auth)
             except OSError as err:
                 SERVER_LOG.debug('Error in auth, data:', exc_info=err)
-                sock.close()
+                self.close_connection(sock)
                 return
-            client_digest = binascii.a2b_base64(ans[DATA])
-            # Если ответ клиента корректный, то сохраняем его в список
-            # пользователей.
-            if RESPONSE in ans and ans[RESPONSE] == 511 and \
-                    hmac.compare_digest(digest, client_digest):
-                self.names[message[USER][ACCOUNT_NAME]] = sock
-                client_ip, client_port = sock.getpeername()
-                try:
-                    send_message(sock, RESPONSE_200)
-                except OSError:
-                    self.remove_client(message[USER][ACCOUNT_NAME])
-                # добавляем пользователя в список активных и,
-                # если у него изменился открытый ключ, то сохраняем новый
-                self.database.user_login(
-                    message[USER][ACCOUNT_NAME],
-                    client_ip,
-                    client_port)
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Неверный пароль.'
-                try:
-                    send_message(sock, response)
-                except OSError:
-                    pass
-                self.clients.remove(sock)
-                sock.close()
+            # Ответ клиента придёт следующим сообщением, до тех пор
+            # основной цикл обслуживает остальных клиентов
+            self.auth_states[sock] = AuthState(
+                message[USER][ACCOUNT_NAME], self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str)
+
+    def process_auth_answer(self, message, sock):
+        '''
+        Метод обработки ответа клиента на запрос авторизации.
+        Проверка ответа (HMAC) выполняется в пуле потоков.
+        '''
+        state = self.auth_states[sock]
+        if state.stage != AuthState.CHALLENGE_SENT:
+            SERVER_LOG.debug(f'Сообщение до завершения авторизации проигнорировано: {message}')
+            return
+        client_digest = None
+        if RESPONSE in message and message[RESPONSE] == 511 and isinstance(message.get(DATA), str):
+            try:
+                client_digest = binascii.a2b_base64(message[DATA])
+            except binascii.Error:
+                pass
+        if client_digest is None:
+            self.reject_user(sock, 'Неверный пароль.')
+            return
+        state.stage = AuthState.VERIFYING
+        future = self.auth_executor.submit(check_digest, state.passwd_hash, state.random_str, client_digest)
+        future.add_done_callback(lambda future: self.auth_done(sock, future))
+
+    def auth_done(self, sock, future):
+        '''Метод завершения проверки в потоке пула: передаёт результат основному циклу.'''
+        self.auth_results.append((sock, future))
+        self.wakeup()
+
+    def finish_auth(self, sock, future):
+        '''Метод завершения авторизации по результату проверки ответа клиента.'''
+        state = self.auth_states.pop(sock, None)
+        # Клиент мог отключиться, пока ответ проверялся
+        if state is None:
+            return
+        try:
+            verified = future.result()
+        except Exception as err:
+            SERVER_LOG.error(f'Ошибка проверки ответа клиента: {err}')
+            verified = False
+        if not verified:
+            self.reject_user(sock, 'Неверный пароль.')
+        # Имя могли занять, пока клиент отвечал на запрос авторизации
+        elif self.user_online(state.account_name):
+            self.reject_user(sock, 'Имя пользователя уже занято.')
+        else:
+            self.login_user(state.account_name, sock)
+
+    def check_auth_timeouts(self):
+        '''Метод отключения клиентов, не ответивших на запрос авторизации вовремя.'''
+        if not self.auth_states:
+            return
+        now = time.monotonic()
+        for sock, state in list(self.auth_states.items()):
+            if state.stage == AuthState.CHALLENGE_SENT and state.deadline < now:
+                SERVER_LOG.info(f'Клиент {state.account_name} не ответил на запрос авторизации.')
+                self.close_connection(sock)
+
+    def login_user(self, account_name, sock):
+        '''
+        Метод завершения успешной авторизации: сохраняет сокет пользователя,
+        записывает в базу факт входа и отвечает клиенту 200.
+        '''
+        # Клиент мог сбросить соединение, пока ответ проверялся
+        try:
+            client_ip, client_port = sock.getpeername()
+        except OSError:
+            self.close_connection(sock)
+            return
+        self.register_name(account_name, sock)
+        # добавляем пользователя в список активных
+        self.database.user_login(account_name, client_ip, client_port)
+        self.notify(USER_LOGIN, account_name, (client_ip, client_port, datetime.datetime.now()))
+        # Сообщаем клиенту выбранный кодек
+        response = RESPONSE_200.copy()
+        response[CODEC] = self.codecs.get(sock, DEFAULT_CODEC).name
+        try:
+            self.send_to_client(sock, response)
+        except OSError:
+            self.remove_client(sock)
+            return
+        # Доставляем сообщения, пришедшие пока пользователь был не в сети
+        self.deliver_offline_messages(account_name, sock)
+
+    def reject_user(self, sock, error_text):
+        '''Метод отказа в авторизации: отвечает клиенту 400 и закрывает соединение.'''
+        response = RESPONSE_400.copy()
+        response[ERROR] = error_text
+        try:
+            SERVER_LOG.debug(f'Auth failed, sending {response}')
+            self.send_to_client(sock, response)
+        except OSError:
+            pass
+        self.close_connection(sock)
 
     @func_to_log
     def service_update_lists(self):
-        '''Метод реализующий отправки сервисного сообщения 205 клиентам.'''
-        for client in self.names:
+        '''
+        Метод реализующий отправки сервисного сообщения 205 клиентам.
+        Сообщение содержит изменения списка пользователей с прошлой рассылки.
+        '''
+        message = RESPONSE_205.copy()
+        changes = self.database.users_changes(self.users_revision)
+        if changes is not None:
+            message[SINCE] = self.users_revision
+            message[EPOCH] = self.database.users_epoch()
+            message[REVISION], message[ADDED], message[REMOVED] = changes
+            self.users_revision = message[REVISION]
+        else:
+            self.users_revision = self.database.users_revision()
+        for client in list(self.client_names):
             try:
-                send_message(self.names[client], RESPONSE_205)
+                self.send_to_client(client, message)
             except OSError:
-                self.remove_client(self.names[client])
+                self.remove_client(client)
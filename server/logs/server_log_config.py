@@ -13,16 +13,18 @@ SERVER_LOG = logging.getLogger('app.server')
 # Создаём объект форматирования:
 SERVER_FORMATTER = logging.Formatter("%(asctime)s %(levelname)s %(filename)s %(message)s ")
 
-# Создаём файловый обработчик логирования:
+# Создаём файловый обработчик логирования. Файл и уровень можно задать
+# переменными окружения SERVER_LOG_FILE и SERVER_LOG_LEVEL (например, при нагрузочном тесте):
 PATH = os.path.dirname(os.path.abspath(__file__))
-PATH = os.path.join(PATH, 'app.server.log')
+PATH = os.environ.get('SERVER_LOG_FILE') or os.path.join(PATH, 'app.server.log')
 FILE_HANDLER = handlers.TimedRotatingFileHandler(PATH, encoding='utf-8', when="D", interval=1)
 # Задаем форматтер для обработчика
 FILE_HANDLER.setFormatter(SERVER_FORMATTER)
 
 # Добавляем в логгер обработчик  и задаем уровень логгирования
 SERVER_LOG.addHandler(FILE_HANDLER)
-SERVER_LOG.setLevel(logging.DEBUG)
+# (по умолчанию INFO: отладочные записи, в т.ч. о каждом вызове функций, не пишутся)
+SERVER_LOG.setLevel(os.environ.get('SERVER_LOG_LEVEL', 'INFO').upper())
 
 if __name__ == '__main__':
     SERVER_LOG.debug('Отладочное сообщение от конф. файла')
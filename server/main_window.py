@@ -2,11 +2,12 @@ import sys
 
 from PyQt5.QtWidgets import QMainWindow, QAction, qApp, QApplication, QLabel, QTableView
 from PyQt5.QtGui import QStandardItemModel, QStandardItem
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import QObject, pyqtSignal
 from server.stat_window import StatWindow
 from server.config_window import ConfigWindow
 from server.add_user import RegisterUser
 from server.remove_user import DelUserDialog
+from server.core import USER_LOGIN, USER_LOGOUT
 
 import logging
 sys.path.append('../')
@@ -14,6 +15,22 @@ import server.logs.server_log_config
 SERVER_LOG = logging.getLogger('app.server')
 
 
+class ServerEvents(QObject):
+    '''
+    Класс - мост событий сервера в графический интерфейс. Подписывается
+    на сервер и вызывается в его потоке, а сигналы Qt доставляют событие
+    в поток окна.
+    '''
+    user_login = pyqtSignal(str, str, int, object)
+    user_logout = pyqtSignal(str)
+
+    def __call__(self, event, account_name, info):
+        if event == USER_LOGIN:
+            self.user_login.emit(account_name, *info)
+        elif event == USER_LOGOUT:
+            self.user_logout.emit(account_name)
+
+
 class MainWindow(QMainWindow):
     '''Класс - основное окно сервера.'''
 
@@ -76,10 +93,18 @@ class MainWindow(QMainWindow):
         self.active_clients_table.move(10, 45)
         self.active_clients_table.setFixedSize(780, 400)
 
-        # Таймер, обновляющий список клиентов 1 раз в секунду
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.create_users_model)
-        self.timer.start(1000)
+        # Модель таблицы подключённых клиентов и её строки по именам
+        self.users_model = None
+        self.user_rows = dict()
+
+        # Список клиентов обновляется по событиям входа и выхода от сервера.
+        # Подписываемся до загрузки списка из базы: события, пришедшие
+        # во время загрузки, будут применены после неё.
+        self.server_events = ServerEvents()
+        self.server_events.user_login.connect(self.user_login)
+        self.server_events.user_logout.connect(self.user_logout)
+        self.server_thread.add_listener(self.server_events)
+        self.create_users_model()
 
         # Связываем кнопки с процедурами
         self.refresh_button.triggered.connect(self.create_users_model)
@@ -92,28 +117,44 @@ class MainWindow(QMainWindow):
         self.show()
 
     def create_users_model(self):
-        '''Метод заполняющий таблицу активных пользователей.'''
-        list_users = self.database.active_users_list()
-        list = QStandardItemModel()
-        list.setHorizontalHeaderLabels(
+        '''Метод заполняющий таблицу активных пользователей из базы.'''
+        self.users_model = QStandardItemModel()
+        self.users_model.setHorizontalHeaderLabels(
             ['Имя Клиента', 'IP Адрес', 'Порт', 'Время подключения'])
-        for row in list_users:
-            user, ip, port, time = row
-            user = QStandardItem(user)
-            user.setEditable(False)
-            ip = QStandardItem(ip)
-            ip.setEditable(False)
-            port = QStandardItem(str(port))
-            port.setEditable(False)
-            # Уберём милисекунды из строки времени, т.к. такая точность не
-            # требуется.
-            time = QStandardItem(str(time.replace(microsecond=0)))
-            time.setEditable(False)
-            list.appendRow([user, ip, port, time])
-        self.active_clients_table.setModel(list)
+        self.user_rows = dict()
+        for row in self.database.active_users_list():
+            self.add_user_row(*row)
+        self.active_clients_table.setModel(self.users_model)
         self.active_clients_table.resizeColumnsToContents()
         self.active_clients_table.resizeRowsToContents()
 
+    def add_user_row(self, user, ip, port, time):
+        '''Метод добавления строки клиента в таблицу.'''
+        # Уберём милисекунды из строки времени, т.к. такая точность не
+        # требуется.
+        items = [QStandardItem(user), QStandardItem(ip), QStandardItem(str(port)),
+                 QStandardItem(str(time.replace(microsecond=0)))]
+        for item in items:
+            item.setEditable(False)
+        self.users_model.appendRow(items)
+        self.user_rows[user] = items[0]
+
+    def user_login(self, user, ip, port, time):
+        '''Слот события входа пользователя: добавляет одну строку.'''
+        self.user_logout(user)
+        self.add_user_row(user, ip, port, time)
+
+    def user_logout(self, user):
+        '''Слот события выхода пользователя: удаляет его строку.'''
+        item = self.user_rows.pop(user, None)
+        if item is not None:
+            self.users_model.removeRow(item.row())
+
+    def closeEvent(self, event):
+        '''Метод закрытия окна, отписывается от событий сервера.'''
+        self.server_thread.remove_listener(self.server_events)
+        super().closeEvent(event)
+
     def show_statistics(self):
         '''Метод создающий окно со статистикой клиентов.'''
         global stat_window
@@ -50,12 +50,10 @@ class DelUserDialog(QDialog):
     def remove_user(self):
         '''Метод - обработчик удаления пользователя.'''
         self.database.remove_user(self.selector.currentText())
-        if self.selector.currentText() in self.server.names:
-            sock = self.server.names[self.selector.currentText()]
-            del self.server.names[self.selector.currentText()]
-            self.server.remove_client(sock)
-        # Рассылаем клиентам сообщение о необходимости обновить справочники
-        self.server.service_update_lists()
+        # Соединения принадлежат потоку сервера: отключение пользователя и
+        # рассылка сообщения о необходимости обновить справочники - в нём
+        self.server.call_soon(self.server.disconnect_user, self.selector.currentText())
+        self.server.call_soon(self.server.service_update_lists)
         self.close()
 
 
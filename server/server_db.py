@@ -1,17 +1,66 @@
-from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text
-from sqlalchemy.orm import mapper, sessionmaker
+from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text, Boolean, \
+    bindparam, Index, event, select, func, inspect
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import mapper, sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+from functools import wraps
+import os
 import datetime
+import json
+import threading
+import time
 import logging
 import server.logs.server_log_config
+from common.variables import STATS_FLUSH_INTERVAL, STATS_FLUSH_MESSAGES, SQLITE_PRAGMAS, OFFLINE_MESSAGES_LIMIT, \
+    OFFLINE_MESSAGES_TTL
 
 SERVER_LOG = logging.getLogger('app.server')
 
 
+def read_transaction(method):
+    """
+    Декоратор методов чтения. По завершении закрывает транзакцию сессии
+    потока: соединение возвращается в пул, а поток не удерживает старый
+    снимок базы (в режиме WAL это мешало бы видеть новые данные).
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.session.rollback()
+
+    return wrapper
+
+
+def write_transaction(method):
+    """
+    Декоратор методов записи. Записи из разных потоков выполняются по
+    очереди (SQLite допускает одного писателя), при ошибке транзакция
+    сессии потока откатывается.
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.write_lock:
+            try:
+                return method(self, *args, **kwargs)
+            except Exception:
+                self.session.rollback()
+                raise
+
+    return wrapper
+
+
 class ServerStorage:
     '''
     Класс - оболочка для работы с базой данных сервера.
     Использует SQLite базу данных, реализован с помощью
     SQLAlchemy ORM и используется классический подход.
+    Каждый поток (сервер, GUI) работает со своей сессией,
+    чтение идёт параллельно с записью (журнал WAL).
     '''
 
     class AllUsers:
@@ -61,15 +110,26 @@ class ServerStorage:
             self.sent = 0
             self.accepted = 0
 
-    def __init__(self, path):
+    def __init__(self, path, pragmas=None, stats_flush_interval=STATS_FLUSH_INTERVAL,
+                 stats_flush_messages=STATS_FLUSH_MESSAGES, offline_limit=OFFLINE_MESSAGES_LIMIT,
+                 offline_ttl=OFFLINE_MESSAGES_TTL):
         # Создаём движок базы данных
+        # Пул соединений: каждому потоку своё соединение на время транзакции
         self.database_engine = create_engine(
             f'sqlite:///{path}',
             echo=False,
             pool_recycle=7200,
+            poolclass=QueuePool,
+            pool_size=5,
+            max_overflow=10,
             connect_args={
                 'check_same_thread': False})
 
+        # Настройки SQLite (журнал, синхронизация, кэш), применяются к
+        # каждому новому соединению
+        self.pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+        event.listen(self.database_engine, 'connect', self.apply_pragmas)
+
         # Создаём объект MetaData
         self.metadata = MetaData()
 
@@ -94,29 +154,79 @@ class ServerStorage:
         # Создаём таблицу истории входов
         user_login_history = Table('Login_history', self.metadata,
                                    Column('id', Integer, primary_key=True),
-                                   Column('name', ForeignKey('Users.id')),
+                                   Column('name', ForeignKey('Users.id'), index=True),
                                    Column('date_time', DateTime),
                                    Column('ip', String),
                                    Column('port', String)
                                    )
 
         # Создаём таблицу контактов пользователей
+        # Уникальный индекс (user, contact) исключает дубли и служит для
+        # поиска контактов пользователя, индекс по contact - для удаления
+        # пользователя из чужих списков.
         contacts = Table('Contacts', self.metadata,
                          Column('id', Integer, primary_key=True),
                          Column('user', ForeignKey('Users.id')),
-                         Column('contact', ForeignKey('Users.id'))
+                         Column('contact', ForeignKey('Users.id'), index=True),
+                         Index('ix_Contacts_user_contact', 'user', 'contact', unique=True)
                          )
+        self.contacts_table = contacts
 
         # Создаём таблицу статистики пользователей
         users_history_table = Table('History', self.metadata,
                                     Column('id', Integer, primary_key=True),
-                                    Column('user', ForeignKey('Users.id')),
+                                    Column('user', ForeignKey('Users.id'), index=True, unique=True),
                                     Column('sent', Integer),
                                     Column('accepted', Integer)
                                     )
 
+        # Создаём таблицу сообщений для пользователей не в сети.
+        # Сообщения хранятся в JSON и выдаются пачкой при входе получателя.
+        offline_messages = Table('Offline_messages', self.metadata,
+                                 Column('id', Integer, primary_key=True),
+                                 Column('user', ForeignKey('Users.id'), index=True),
+                                 Column('date', DateTime),
+                                 Column('message', Text)
+                                 )
+        self.offline_table = offline_messages
+
+        # Создаём журнал изменений списка пользователей. Номер записи -
+        # ревизия списка, по нему клиенты получают только изменения.
+        users_changes = Table('Users_changes', self.metadata,
+                              Column('id', Integer, primary_key=True),
+                              Column('name', String),
+                              Column('removed', Boolean)
+                              )
+        self.users_changes_table = users_changes
+
+        # Создаём таблицу сведений о базе: эпоха - случайное число, задаётся
+        # при создании базы. Ревизии журнала имеют смысл только вместе с ней:
+        # у пересозданной базы ревизии начинаются заново.
+        server_info = Table('Server_info', self.metadata,
+                            Column('id', Integer, primary_key=True),
+                            Column('epoch', Integer)
+                            )
+
+        # Создаём таблицы комнат (групповых чатов) и их участников.
+        # Уникальный индекс (room, user) исключает повторное вступление,
+        # индекс по user - для удаления пользователя из всех комнат.
+        rooms = Table('Rooms', self.metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('name', String, unique=True)
+                      )
+        self.rooms_table = rooms
+        room_members = Table('Room_members', self.metadata,
+                             Column('id', Integer, primary_key=True),
+                             Column('room', ForeignKey('Rooms.id')),
+                             Column('user', ForeignKey('Users.id'), index=True),
+                             Index('ix_Room_members_room_user', 'room', 'user', unique=True)
+                             )
+        self.room_members_table = room_members
+
         # Создаём таблицы
         self.metadata.create_all(self.database_engine)
+        # В базе, созданной прежней версией, таблицы уже есть, а индексов нет
+        self.create_indexes()
 
         # Создаём отображения
         mapper(self.AllUsers, users_table)
@@ -125,50 +235,156 @@ class ServerStorage:
         mapper(self.UsersContacts, contacts)
         mapper(self.UsersHistory, users_history_table)
 
-        # Создаём сессию
-        Session = sessionmaker(bind=self.database_engine)
-        self.session = Session()
+        # Создаём фабрику сессий: у каждого потока своя сессия
+        self.Session = scoped_session(sessionmaker(bind=self.database_engine))
+        # Блокировка записи, общая для всех потоков
+        self.write_lock = threading.RLock()
+
+        # Кэш пользователей: имя -> (id, хэш пароля)
+        self.users_cache = dict()
+
+        # Кэш комнат: имя -> (id, кортеж имён участников). Заполняется при
+        # первом сообщении в комнату, сбрасывается при изменении состава.
+        self.rooms_cache = dict()
+
+        # Накопленные, но ещё не записанные в базу изменения статистики:
+        # id пользователя -> [отправлено, получено]. Сбрасываются в базу
+        # одной транзакцией раз в stats_flush_interval секунд или после
+        # stats_flush_messages сообщений.
+        self.pending_stats = dict()
+        self.pending_messages = 0
+        self.stats_flush_interval = stats_flush_interval
+        self.stats_flush_messages = stats_flush_messages
+        self.last_stats_flush = time.monotonic()
+        self.stats_lock = threading.Lock()
+
+        # Ограничения очереди сообщений для пользователей не в сети:
+        # не больше offline_limit сообщений на пользователя (старые
+        # вытесняются, при рассылке в комнату - при выдаче и запуске сервера),
+        # сообщения старше offline_ttl секунд не доставляются.
+        self.offline_limit = offline_limit
+        self.offline_ttl = offline_ttl
+
+        # Запрос пакетного обновления счётчиков статистики
+        self.stats_update = users_history_table.update(). \
+            where(users_history_table.c.user == bindparam('user_id')). \
+            values(sent=users_history_table.c.sent + bindparam('sent_delta'),
+                   accepted=users_history_table.c.accepted + bindparam('accepted_delta'))
 
         # Если в таблице активных пользователей есть записи, то их необходимо
         # удалить
         self.session.query(self.ActiveUsers).delete()
+        # Текущая ревизия списка пользователей
+        self.revision = self.session.execute(select(func.max(users_changes.c.id))).scalar() or 0
+        # Эпоха базы, в базе прежней версии создаётся при первом запуске
+        self.epoch = self.session.execute(select(server_info.c.epoch)).scalar()
+        if self.epoch is None:
+            self.epoch = int.from_bytes(os.urandom(7), 'big')
+            self.session.execute(server_info.insert().values(epoch=self.epoch))
+
+        # Удаляем просроченные сообщения для пользователей не в сети
+        # и сообщения сверх лимита, накопленные рассылками в комнаты
+        self.session.execute(offline_messages.delete().where(
+            offline_messages.c.date < self.offline_expire_date()))
+        self.trim_offline_messages()
         self.session.commit()
 
+    @property
+    def session(self):
+        """Сессия текущего потока."""
+        return self.Session()
+
+    def apply_pragmas(self, dbapi_connection, connection_record):
+        """Метод применяющий настройки SQLite к новому соединению."""
+        cursor = dbapi_connection.cursor()
+        for name, value in self.pragmas.items():
+            if not str(name).isidentifier() or not str(value).lstrip('-').isalnum():
+                SERVER_LOG.error(f'Некорректная настройка SQLite: {name} = {value}')
+                continue
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+    def create_indexes(self):
+        """
+        Метод создающий недостающие индексы в существующей базе. Перед
+        созданием уникального индекса удаляются повторяющиеся строки (остаётся
+        первая): запросы вида on_conflict_do_nothing полагаются на этот индекс,
+        поэтому если его всё же создать не удалось, сервер не запускается.
+        """
+        for table in self.metadata.sorted_tables:
+            existing = {index['name'] for index in inspect(self.database_engine).get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                try:
+                    if index.unique:
+                        self.remove_duplicates(table, index.columns)
+                    index.create(bind=self.database_engine)
+                except SQLAlchemyError as err:
+                    SERVER_LOG.error(f'Не удалось создать индекс {index.name}: {err}')
+                    if index.unique:
+                        raise
+
+    def remove_duplicates(self, table, columns):
+        """Метод удаления строк, повторяющих значения columns, кроме первой из них."""
+        first = select(func.min(table.c.id)).group_by(*columns)
+        with self.database_engine.begin() as conn:
+            removed = conn.execute(table.delete().where(table.c.id.not_in(first))).rowcount
+        if removed:
+            SERVER_LOG.warning(f'Из таблицы {table.name} удалено повторяющихся строк: {removed}')
+
+    def user_record(self, name):
+        """
+        Метод возвращающий кортеж (id, хэш пароля) пользователя.
+        Данные берутся из кэша, к базе обращаемся только при промахе.
+        Если пользователя нет, возвращает None.
+        """
+        record = self.users_cache.get(name)
+        if record is None:
+            # Кэш заполняется под блокировкой записи, чтобы не вернуть в него
+            # пользователя, которого в это время удаляет другой поток
+            with self.write_lock:
+                user = self.session.query(
+                    self.AllUsers.id,
+                    self.AllUsers.passwd_hash).filter_by(
+                    name=name).first()
+                if not user:
+                    return None
+                record = self.users_cache[name] = (user.id, user.passwd_hash)
+        return record
+
+    @write_transaction
     def user_login(self, username, ip_address, port):
         """
         Метод выполняющийся при входе пользователя, записывает в базу факт входа
         обновляет открытый ключ пользователя при его изменении.
         """
-        # Запрос в таблицу пользователей на наличие там пользователя с таким
-        # именем
-        rez = self.session.query(self.AllUsers).filter_by(name=username)
+        # Ищем пользователя с таким именем
+        record = self.user_record(username)
 
         # Если имя пользователя уже присутствует в таблице, обновляем время последнего входа
-        # и проверяем корректность ключа. Если клиент прислал новый ключ,
-        # сохраняем его.
-        if rez.count():
-            user = rez.first()
-            user.last_login = datetime.datetime.now()
-            # if user.pubkey != key:
-            #     user.pubkey = key
         # Если нет, то генерируем исключение
-        else:
+        if not record:
             raise ValueError('Пользователь не зарегистрирован.')
+        user_id = record[0]
+        self.session.query(self.AllUsers).filter_by(id=user_id).update(
+            {self.AllUsers.last_login: datetime.datetime.now()}, synchronize_session=False)
 
         # Теперь можно создать запись в таблицу активных пользователей о факте
         # входа.
         new_active_user = self.ActiveUsers(
-            user.id, ip_address, port, datetime.datetime.now())
+            user_id, ip_address, port, datetime.datetime.now())
         self.session.add(new_active_user)
 
         # и сохранить в историю входов
         history = self.LoginHistory(
-            user.id, datetime.datetime.now(), ip_address, port)
+            user_id, datetime.datetime.now(), ip_address, port)
         self.session.add(history)
 
         # Сохраняем изменения
         self.session.commit()
 
+    @write_transaction
     def add_user(self, name, passwd_hash):
         """
         Метод регистрации пользователя.
@@ -179,8 +395,13 @@ class ServerStorage:
         self.session.commit()
         history_row = self.UsersHistory(user_row.id)
         self.session.add(history_row)
+        revision = self.log_users_change(name, False)
         self.session.commit()
+        self.revision = revision
+        # Сразу заносим нового пользователя в кэш
+        self.users_cache[name] = (user_row.id, passwd_hash)
 
+    @write_transaction
     def remove_user(self, name):
         """Метод удаляющий пользователя из базы."""
         user = self.session.query(self.AllUsers).filter_by(name=name).first()
@@ -191,89 +412,161 @@ class ServerStorage:
             self.UsersContacts).filter_by(
             contact=user.id).delete()
         self.session.query(self.UsersHistory).filter_by(user=user.id).delete()
+        self.session.execute(self.offline_table.delete().where(self.offline_table.c.user == user.id))
+        self.session.execute(self.room_members_table.delete().where(self.room_members_table.c.user == user.id))
         self.session.query(self.AllUsers).filter_by(name=name).delete()
+        revision = self.log_users_change(name, True)
         self.session.commit()
-
+        self.revision = revision
+        # Удаляем пользователя из кэшей и неписанной статистики
+        self.users_cache.pop(name, None)
+        self.rooms_cache.clear()
+        with self.stats_lock:
+            self.pending_stats.pop(user.id, None)
+
+    def log_users_change(self, name, removed):
+        """Метод записи изменения в журнал списка пользователей, возвращает новую ревизию."""
+        result = self.session.execute(self.users_changes_table.insert().values(name=name, removed=removed))
+        return result.inserted_primary_key[0]
+
+    def users_revision(self):
+        """Метод возвращающий текущую ревизию списка пользователей."""
+        return self.revision
+
+    def users_epoch(self):
+        """Метод возвращающий эпоху базы, к которой относятся ревизии списка пользователей."""
+        return self.epoch
+
+    @read_transaction
+    def users_changes(self, since):
+        """
+        Метод возвращающий изменения списка пользователей после ревизии since:
+        кортеж (ревизия, добавленные, удалённые). Если ревизия неизвестна
+        (0, чужая или из будущего), возвращает None - нужен полный список.
+        """
+        revision = self.revision
+        if not isinstance(since, int) or since <= 0 or since > revision:
+            return None
+        table = self.users_changes_table
+        # Для каждого имени учитываем только последнее изменение
+        last_changes = dict()
+        for name, removed in self.session.execute(
+                select(table.c.name, table.c.removed).where(
+                    table.c.id > since, table.c.id <= revision).order_by(table.c.id)):
+            last_changes[name] = removed
+        added = [name for name, removed in last_changes.items() if not removed]
+        removed = [name for name, removed in last_changes.items() if removed]
+        return revision, added, removed
+
+    @read_transaction
     def get_hash(self, name):
         """Метод получения хэша пароля пользователя."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.passwd_hash
+        return self.user_record(name)[1]
 
     # def get_pubkey(self, name):
     #     """Метод получения публичного ключа пользователя."""
     #     user = self.session.query(self.AllUsers).filter_by(name=name).first()
     #     return user.pubkey
 
+    @read_transaction
     def check_user(self, name):
         """Метод проверяющий существование пользователя."""
-        if self.session.query(self.AllUsers).filter_by(name=name).count():
+        if self.user_record(name):
             return True
         else:
             return False
 
+    @write_transaction
     def user_logout(self, username):
         """Метод фиксирующий отключения пользователя."""
-        # Запрашиваем пользователя, что покидает нас
-        user = self.session.query(
-            self.AllUsers).filter_by(
-            name=username).first()
+        # Определяем пользователя, что покидает нас. Удалённого из базы
+        # пользователя уже нет и в таблице активных.
+        record = self.user_record(username)
+        if record is None:
+            return
+        user_id = record[0]
 
         # Удаляем его из таблицы активных пользователей.
-        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
+        self.session.query(self.ActiveUsers).filter_by(user=user_id).delete()
 
         # Применяем изменения
         self.session.commit()
 
     def process_message(self, sender, recipient):
-        """Метод записывающий в таблицу статистики факт передачи сообщения."""
+        """
+        Метод учитывающий в статистике факт передачи сообщения.
+        Счётчики накапливаются в памяти и записываются в базу пакетом.
+        """
         # Получаем ID отправителя и получателя
-        sender = self.session.query(
-            self.AllUsers).filter_by(
-            name=sender).first().id
-        recipient = self.session.query(
-            self.AllUsers).filter_by(
-            name=recipient).first().id
-        # Запрашиваем строки из истории и увеличиваем счётчики
-        sender_row = self.session.query(
-            self.UsersHistory).filter_by(
-            user=sender).first()
-        sender_row.sent += 1
-        recipient_row = self.session.query(
-            self.UsersHistory).filter_by(
-            user=recipient).first()
-        recipient_row.accepted += 1
-
+        sender = self.user_record(sender)[0]
+        recipient = self.user_record(recipient)[0]
+        # Увеличиваем накопленные счётчики
+        with self.stats_lock:
+            self.pending_stats.setdefault(sender, [0, 0])[0] += 1
+            self.pending_stats.setdefault(recipient, [0, 0])[1] += 1
+            self.pending_messages += 1
+        self.flush_stats_if_due()
+
+    def process_room_message(self, sender, recipients):
+        """
+        Метод учитывающий в статистике сообщение в комнату: одно отправленное
+        у отправителя и по одному полученному у каждого участника.
+        """
+        sender = self.user_record(sender)[0]
+        recipients = [record[0] for record in map(self.user_record, recipients) if record]
+        with self.stats_lock:
+            self.pending_stats.setdefault(sender, [0, 0])[0] += 1
+            for recipient in recipients:
+                self.pending_stats.setdefault(recipient, [0, 0])[1] += 1
+            self.pending_messages += 1
+        self.flush_stats_if_due()
+
+    def flush_stats_if_due(self):
+        """Метод записывающий статистику, если подошёл срок или набралось сообщений."""
+        if self.pending_messages >= self.stats_flush_messages or \
+                (self.pending_stats and
+                 time.monotonic() - self.last_stats_flush >= self.stats_flush_interval):
+            self.flush_stats()
+
+    @write_transaction
+    def flush_stats(self):
+        """Метод записывающий накопленную статистику в базу одной транзакцией."""
+        with self.stats_lock:
+            pending, self.pending_stats = self.pending_stats, dict()
+            self.pending_messages = 0
+            self.last_stats_flush = time.monotonic()
+        if not pending:
+            return
+        self.session.execute(self.stats_update, [
+            {'user_id': user_id, 'sent_delta': sent, 'accepted_delta': accepted}
+            for user_id, (sent, accepted) in pending.items()])
         self.session.commit()
 
+    @write_transaction
     def add_contact(self, user, contact):
         """Метод добавления контакта для пользователя."""
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(
-            self.AllUsers).filter_by(
-            name=contact).first()
-
-        # Проверяем что не дубль и что контакт может существовать (полю
-        # пользователь мы доверяем)
-        if not contact or self.session.query(
-                self.UsersContacts).filter_by(
-            user=user.id,
-            contact=contact.id).count():
+        user = self.user_record(user)
+        contact = self.user_record(contact)
+
+        # Проверяем что контакт может существовать (полю пользователь мы
+        # доверяем)
+        if not contact:
             return
 
-        # Создаём объект и заносим его в базу
-        contact_row = self.UsersContacts(user.id, contact.id)
-        self.session.add(contact_row)
+        # Заносим контакт в базу, дубль отсекает уникальный индекс
+        self.session.execute(
+            sqlite_insert(self.contacts_table).values(
+                user=user[0], contact=contact[0]).on_conflict_do_nothing())
         self.session.commit()
 
     # Функция удаляет контакт из базы данных
+    @write_transaction
     def remove_contact(self, user, contact):
         """Метод удаления контакта пользователя."""
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(
-            self.AllUsers).filter_by(
-            name=contact).first()
+        user = self.user_record(user)
+        contact = self.user_record(contact)
 
         # Проверяем что контакт может существовать (полю пользователь мы
         # доверяем)
@@ -282,11 +575,89 @@ class ServerStorage:
 
         # Удаляем требуемое
         self.session.query(self.UsersContacts).filter(
-            self.UsersContacts.user == user.id,
-            self.UsersContacts.contact == contact.id
+            self.UsersContacts.user == user[0],
+            self.UsersContacts.contact == contact[0]
         ).delete()
         self.session.commit()
 
+    def offline_expire_date(self):
+        """Метод возвращающий время, раньше которого сообщения считаются просроченными."""
+        return datetime.datetime.now() - datetime.timedelta(seconds=self.offline_ttl)
+
+    @write_transaction
+    def store_offline_messages(self, username, messages):
+        """
+        Метод сохранения сообщений для пользователя не в сети.
+        Сообщения добавляются одним пакетным запросом, сверх лимита
+        удаляются самые старые. Возвращает False, если пользователя нет.
+        """
+        record = self.user_record(username)
+        if not record or not messages:
+            return bool(record)
+        now = datetime.datetime.now()
+        table = self.offline_table
+        self.session.execute(table.insert(), [
+            {'user': record[0], 'date': now, 'message': json.dumps(message)}
+            for message in messages])
+        # Оставляем offline_limit последних сообщений пользователя
+        newest = select(table.c.id).where(table.c.user == record[0]). \
+            order_by(table.c.id.desc()).limit(self.offline_limit)
+        self.session.execute(table.delete().where(
+            table.c.user == record[0], table.c.id.not_in(newest)))
+        self.session.commit()
+        return True
+
+    def trim_offline_messages(self):
+        """
+        Метод удаления сообщений сверх лимита у всех пользователей одним
+        запросом. Вызывается при запуске сервера, без фиксации транзакции.
+        """
+        table = self.offline_table
+        ranked = select(table.c.id, func.row_number().over(
+            partition_by=table.c.user, order_by=table.c.id.desc()).label('rank')).subquery()
+        self.session.execute(table.delete().where(
+            table.c.id.in_(select(ranked.c.id).where(ranked.c.rank > self.offline_limit))))
+
+    @write_transaction
+    def store_offline_broadcast(self, usernames, message):
+        """
+        Метод сохранения одного сообщения для нескольких пользователей не
+        в сети (сообщение в комнату) одним пакетным запросом. Сообщения
+        сверх лимита здесь не удаляются: это запрос по каждому участнику
+        в потоке сервера, лимит применяется при выдаче и при запуске.
+        """
+        user_ids = [record[0] for record in map(self.user_record, usernames) if record]
+        if not user_ids:
+            return
+        now = datetime.datetime.now()
+        data = json.dumps(message)
+        table = self.offline_table
+        self.session.execute(table.insert(), [
+            {'user': user_id, 'date': now, 'message': data} for user_id in user_ids])
+        self.session.commit()
+
+    @write_transaction
+    def pop_offline_messages(self, username):
+        """
+        Метод выдачи сообщений, накопленных для пользователя, пока он был
+        не в сети. Возвращает offline_limit последних непросроченных сообщений
+        в порядке поступления и удаляет из базы все сообщения пользователя.
+        """
+        record = self.user_record(username)
+        if not record:
+            return []
+        table = self.offline_table
+        rows = self.session.execute(
+            select(table.c.message).where(
+                table.c.user == record[0],
+                table.c.date >= self.offline_expire_date()).order_by(table.c.id.desc()).
+            limit(self.offline_limit)).scalars().all()
+        if rows:
+            self.session.execute(table.delete().where(table.c.user == record[0]))
+        self.session.commit()
+        return [json.loads(message) for message in reversed(rows)]
+
+    @read_transaction
     def users_list(self):
         """Метод возвращающий список известных пользователей со временем последнего входа."""
         # Запрос строк таблицы пользователей.
@@ -297,6 +668,7 @@ class ServerStorage:
         # Возвращаем список кортежей
         return query.all()
 
+    @read_transaction
     def active_users_list(self):
         """Метод возвращающий список активных пользователей."""
         # Запрашиваем соединение таблиц и собираем кортежи имя, адрес, порт,
@@ -310,6 +682,7 @@ class ServerStorage:
         # Возвращаем список кортежей
         return query.all()
 
+    @read_transaction
     def login_history(self, username=None):
         """Метод возвращающий историю входов."""
         # Запрашиваем историю входа
@@ -325,29 +698,119 @@ class ServerStorage:
         # Возвращаем список кортежей
         return query.all()
 
+    @read_transaction
     def get_contacts(self, username):
         """Метод возвращающий список контактов пользователя."""
-        # Запрашиваем указанного пользователя
-        user = self.session.query(self.AllUsers).filter_by(name=username).one()
+        # Определяем указанного пользователя
+        user_id = self.user_record(username)[0]
 
         # Запрашиваем его список контактов
         query = self.session.query(self.UsersContacts, self.AllUsers.name). \
-            filter_by(user=user.id). \
+            filter_by(user=user_id). \
             join(self.AllUsers, self.UsersContacts.contact == self.AllUsers.id)
 
         # выбираем только имена пользователей и возвращаем их.
         return [contact[1] for contact in query.all()]
 
+    def room_id(self, name):
+        """Метод возвращающий id комнаты или None, если её нет."""
+        cached = self.rooms_cache.get(name)
+        if cached is not None:
+            return cached[0]
+        return self.session.execute(
+            select(self.rooms_table.c.id).where(self.rooms_table.c.name == name)).scalar()
+
+    @write_transaction
+    def create_room(self, name, owner):
+        """Метод создания комнаты, создатель становится участником. False - комната уже есть."""
+        if self.room_id(name) is not None:
+            return False
+        result = self.session.execute(self.rooms_table.insert().values(name=name))
+        self.session.execute(self.room_members_table.insert().values(
+            room=result.inserted_primary_key[0], user=self.user_record(owner)[0]))
+        self.session.commit()
+        return True
+
+    @write_transaction
+    def join_room(self, name, username):
+        """Метод вступления пользователя в комнату. False - комнаты нет."""
+        room_id = self.room_id(name)
+        if room_id is None:
+            return False
+        self.session.execute(sqlite_insert(self.room_members_table).values(
+            room=room_id, user=self.user_record(username)[0]).on_conflict_do_nothing())
+        self.session.commit()
+        self.rooms_cache.pop(name, None)
+        return True
+
+    @write_transaction
+    def leave_room(self, name, username):
+        """Метод выхода пользователя из комнаты. False - комнаты нет."""
+        room_id = self.room_id(name)
+        if room_id is None:
+            return False
+        table = self.room_members_table
+        self.session.execute(table.delete().where(
+            table.c.room == room_id, table.c.user == self.user_record(username)[0]))
+        self.session.commit()
+        self.rooms_cache.pop(name, None)
+        return True
+
+    def invalidate_room(self, name):
+        """Метод сброса кэша состава комнаты, изменённого другим процессом."""
+        self.rooms_cache.pop(name, None)
+
+    @read_transaction
+    def room_members(self, name):
+        """
+        Метод возвращающий кортеж имён участников комнаты или None, если
+        комнаты нет. Состав берётся из кэша, к базе обращаемся при промахе.
+        """
+        cached = self.rooms_cache.get(name)
+        if cached is None:
+            # Кэш заполняется под блокировкой записи, чтобы не сохранить
+            # состав, который в это время изменяет другой поток
+            with self.write_lock:
+                room_id = self.room_id(name)
+                if room_id is None:
+                    return None
+                table = self.room_members_table
+                members = self.session.execute(
+                    select(self.AllUsers.name).join(table, table.c.user == self.AllUsers.id).where(
+                        table.c.room == room_id)).scalars().all()
+                cached = self.rooms_cache[name] = (room_id, tuple(members))
+        return cached[1]
+
+    @read_transaction
     def message_history(self):
-        """Метод возвращающий статистику сообщений."""
+        """
+        Метод возвращающий статистику сообщений.
+        К записанным в базу счётчикам добавляются ещё не записанные.
+        """
         query = self.session.query(
             self.AllUsers.name,
             self.AllUsers.last_login,
             self.UsersHistory.sent,
-            self.UsersHistory.accepted
+            self.UsersHistory.accepted,
+            self.UsersHistory.user
         ).join(self.AllUsers)
+        # Копия накопленных счётчиков и чтение записанных - под блокировкой
+        # записи: flush_stats держит её от изъятия счётчиков до фиксации,
+        # поэтому одно и то же сообщение не учитывается ни дважды, ни ноль раз
+        with self.write_lock:
+            with self.stats_lock:
+                pending = {user_id: tuple(counters) for user_id, counters in self.pending_stats.items()}
+            rows = query.all()
         # Возвращаем список кортежей
-        return query.all()
+        result = []
+        for name, last_login, sent, accepted, user_id in rows:
+            sent_delta, accepted_delta = pending.get(user_id, (0, 0))
+            result.append((name, last_login, sent + sent_delta, accepted + accepted_delta))
+        return result
+
+    def close(self):
+        """Метод завершения работы с базой: записывает накопленную статистику."""
+        self.flush_stats()
 
 
 # Отладка
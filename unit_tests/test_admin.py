@@ -0,0 +1,66 @@
+import sys
+import os
+import socket
+import tempfile
+import shutil
+import datetime
+import unittest
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from server.admin import AdminConsole, admin_address, admin_socket
+
+
+class TestDatabase:
+    """Заглушка хранилища с одним подключённым пользователем"""
+
+    def users_list(self):
+        return [('test1', datetime.datetime(2024, 1, 1))]
+
+    def active_users_list(self):
+        return [('test1', '127.0.0.1', 7777, datetime.datetime(2024, 1, 1))]
+
+    def login_history(self, username=None):
+        return [('test1', datetime.datetime(2024, 1, 1), '127.0.0.1', 7777)]
+
+
+class TestServer:
+    running = True
+
+
+class TestAdminConsole(unittest.TestCase):
+    """класс юнит-тестов консоли администратора (server/admin)"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.server = TestServer()
+        self.console = AdminConsole(admin_address(os.path.join(self.tmp_dir, 'admin.sock')),
+                                    TestDatabase(), self.server)
+
+    def test_execute(self):
+        """Команды возвращают данные хранилища, exit останавливает сервер"""
+        self.assertIn('test1', self.console.execute('users'))
+        self.assertIn('127.0.0.1:7777', self.console.execute('connected'))
+        self.assertIn('test1', self.console.execute('loghist', 'test1'))
+        self.assertIn('help', self.console.execute('unknown'))
+        self.console.execute('exit')
+        self.assertFalse(self.server.running)
+
+    def test_socket(self):
+        """Команда по сокету, ответ завершается пустой строкой"""
+        self.console.init_socket()
+        self.console.start()
+        self.addCleanup(self.console.stop)
+        with admin_socket(self.console.address) as sock:
+            sock.settimeout(1)
+            sock.connect(self.console.address)
+            sock.sendall(b'connected\n')
+            answer = b''
+            while not answer.endswith(b'\n\n'):
+                answer += sock.recv(4096)
+        self.assertIn('test1', answer.decode('utf-8'))
+
+
+if __name__ == '__main__':
+    unittest.main()
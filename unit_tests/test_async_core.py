@@ -0,0 +1,140 @@
+import sys
+import os
+import binascii
+import hmac
+import socket
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from server.async_core import AsyncServer
+from common.utils import get_message, send_message
+from common.variables import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, RESPONSE, DATA, MESSAGE, SENDER, \
+    MESSAGE_RECEIVER, MESSAGE_TEXT, EXIT
+
+
+class TestDatabase:
+    """Заглушка хранилища: зарегистрированы test1, test2, test3"""
+
+    users = ('test1', 'test2', 'test3')
+
+    def check_user(self, username):
+        return username in self.users
+
+    def get_hash(self, username):
+        return f'{username}_hash'.encode()
+
+    def user_login(self, username, ip_address, port):
+        pass
+
+    def user_logout(self, username):
+        pass
+
+    def users_revision(self):
+        return 0
+
+    def pop_offline_messages(self, username):
+        return []
+
+    def store_offline_messages(self, username, messages):
+        return True
+
+    def process_message(self, sender, recipient):
+        pass
+
+    def flush_stats_if_due(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TestAsyncServer(unittest.TestCase):
+    """класс юнит-тестов сервера на asyncio (server/async_core) на петлевом интерфейсе"""
+
+    @classmethod
+    def setUpClass(cls):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            cls.port = sock.getsockname()[1]
+        cls.server = AsyncServer('127.0.0.1', cls.port, TestDatabase())
+        cls.server.daemon = True
+        cls.server.start()
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', cls.port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.running = False
+        cls.server.join(5)
+
+    def connect(self, account_name):
+        """Подключение и запрос авторизации, возвращает сокет и запрос 511"""
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+        self.addCleanup(sock.close)
+        send_message(sock, {ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: account_name}})
+        return sock, get_message(sock)
+
+    def login(self, account_name, passwd_hash):
+        """Авторизация с хэшем пароля passwd_hash, возвращает сокет и ответ сервера"""
+        sock, challenge = self.connect(account_name)
+        digest = hmac.new(passwd_hash, challenge[DATA].encode('ascii'), 'MD5').digest()
+        send_message(sock, {RESPONSE: 511, DATA: binascii.b2a_base64(digest).decode('ascii')})
+        return sock, get_message(sock)
+
+    def wait_closed(self, sock):
+        """Ожидание закрытия соединения сервером и удаления его из списка клиентов"""
+        self.assertEqual(sock.recv(1), b'')
+        deadline = time.monotonic() + 5
+        while self.server.clients and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.clients, [])
+
+    def logout(self, sock, account_name):
+        send_message(sock, {ACTION: EXIT, TIME: time.time(), ACCOUNT_NAME: account_name})
+        self.wait_closed(sock)
+
+    def test_login(self):
+        """Верный ответ - пользователь авторизован"""
+        sock, answer = self.login('test1', b'test1_hash')
+        self.assertEqual(answer[RESPONSE], 200)
+        self.assertTrue(self.server.user_online('test1'))
+        self.logout(sock, 'test1')
+        self.assertFalse(self.server.user_online('test1'))
+
+    def test_wrong_password(self):
+        """Неверный ответ - отказ и закрытие соединения"""
+        sock, answer = self.login('test1', b'wrong_hash')
+        self.assertEqual(answer[RESPONSE], 400)
+        self.wait_closed(sock)
+
+    def test_malformed_answer(self):
+        """Ответ не в base64 - отказ, соединение не остаётся в списке клиентов"""
+        sock, challenge = self.connect('test1')
+        send_message(sock, {RESPONSE: 511, DATA: 'a'})
+        self.assertEqual(get_message(sock)[RESPONSE], 400)
+        self.wait_closed(sock)
+
+    def test_message(self):
+        """Сообщение доставляется получателю, отправитель получает 200"""
+        sender, _ = self.login('test2', b'test2_hash')
+        receiver, _ = self.login('test3', b'test3_hash')
+        message = {ACTION: MESSAGE, SENDER: 'test2', MESSAGE_RECEIVER: 'test3', TIME: 1.1, MESSAGE_TEXT: 'hello'}
+        send_message(sender, message)
+        self.assertEqual(get_message(sender)[RESPONSE], 200)
+        self.assertEqual(get_message(receiver), message)
+        send_message(sender, {ACTION: EXIT, TIME: time.time(), ACCOUNT_NAME: 'test2'})
+        self.assertEqual(sender.recv(1), b'')
+        self.logout(receiver, 'test3')
+
+
+if __name__ == '__main__':
+    unittest.main()
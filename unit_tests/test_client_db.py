@@ -0,0 +1,86 @@
+import sys
+import os
+import unittest
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from client.client_db import ClientDatabase
+
+
+class TestClientDatabase(unittest.TestCase):
+    """класс юнит-тестов базы данных клиента (client/client_db)"""
+
+    @classmethod
+    def setUpClass(cls):
+        # Классические отображения ORM позволяют создать базу только
+        # один раз за процесс, поэтому база общая для всех тестов класса.
+        cls.database = ClientDatabase('unit_test')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.database.session.close()
+        cls.database.database_engine.dispose()
+        os.remove(cls.database.database_engine.url.database)
+
+    def setUp(self):
+        self.database.add_users(['test1', 'test2', 'test3'], 5)
+        self.database.contacts_clear()
+
+    def test_add_users(self):
+        """Полный список заменяет известных пользователей и ревизию"""
+        self.assertEqual(sorted(self.database.get_users()), ['test1', 'test2', 'test3'])
+        self.assertEqual(self.database.get_users_revision(), 5)
+        self.database.add_users(['test1', 'test2', 'test3'], 5, 42)
+        self.assertEqual(self.database.get_users_epoch(), 42)
+
+    def test_apply_users_changes(self):
+        """Изменения списка применяются, удалённые пропадают из контактов"""
+        self.database.add_contact('test2')
+        self.database.apply_users_changes(7, ['test1', 'test4'], ['test2'])
+        self.assertEqual(sorted(self.database.get_users()), ['test1', 'test3', 'test4'])
+        self.assertEqual(self.database.get_contacts(), [])
+        self.assertEqual(self.database.get_users_revision(), 7)
+
+    def test_contacts(self):
+        """Повторное добавление контакта не создаёт дубль, список заменяется целиком"""
+        self.database.add_contact('test1')
+        self.database.add_contact('test1')
+        self.assertEqual(self.database.get_contacts(), ['test1'])
+        self.database.set_contacts(['test2', 'test3', 'test3'])
+        self.assertEqual(sorted(self.database.get_contacts()), ['test2', 'test3'])
+        self.assertTrue(self.database.check_contact('test2'))
+        self.assertFalse(self.database.check_contact('test1'))
+
+    def test_bulk_users(self):
+        """Большой список пользователей и большие изменения одной транзакцией"""
+        users = [f'user_{i}' for i in range(50000)]
+        self.database.add_users(users, 10)
+        self.database.apply_users_changes(11, [f'user_{i}' for i in range(49000, 51000)], users[:40000])
+        self.assertEqual(len(self.database.get_users()), 11000)
+        self.assertTrue(self.database.check_user('user_50999'))
+        self.assertFalse(self.database.check_user('user_1'))
+
+    def test_history_pages(self):
+        """История выдаётся страницами от новых к старым, без пропусков и повторов"""
+        for i in range(25):
+            self.database.save_message('test1', 'in' if i % 2 else 'out', str(i))
+        self.database.save_message('test2', 'in', 'other')
+        messages, cursor = [], None
+        while True:
+            page = self.database.get_history('test1', 10, before=cursor)
+            if not page:
+                break
+            messages = page + messages
+            cursor = page[0][3:5]
+        self.assertEqual([row[2] for row in messages], [str(i) for i in range(25)])
+        self.assertEqual([row[2] for row in self.database.get_history('test1', 3)], ['22', '23', '24'])
+        self.assertEqual(len(self.database.get_history('test1')), 25)
+
+    def test_save_message(self):
+        """Сохранённое сообщение возвращается в виде записи истории"""
+        item = self.database.save_message('test3', 'out', 'hello')
+        self.assertEqual(self.database.get_history('test3', 1), [item])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import sys
+import os
+import socket
+import unittest
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from common.proj_decorators import func_to_log, login_required, set_call_logging
+from common.variables import ACTION, PRESENCE, MESSAGE
+
+
+class TestServer:
+    """Заглушка сервера - только словари имён"""
+
+    def __init__(self):
+        self.names = dict()
+        self.client_names = dict()
+
+    @login_required
+    def process_client_message(self, message, client):
+        return message[ACTION]
+
+
+class TestDecorators(unittest.TestCase):
+    """класс юнит-тестов декораторов (common/proj_decorators)"""
+
+    def setUp(self):
+        self.server = TestServer()
+        self.client = socket.socket()
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_login_required_authorized(self):
+        """Сообщение от авторизованного сокета обрабатывается"""
+        self.server.names['test1'] = self.client
+        self.server.client_names[self.client] = 'test1'
+        self.assertEqual(self.server.process_client_message({ACTION: MESSAGE}, self.client), MESSAGE)
+
+    def test_login_required_presence(self):
+        """Presence принимается от неавторизованного сокета"""
+        self.assertEqual(self.server.process_client_message({ACTION: PRESENCE}, self.client), PRESENCE)
+
+    def test_login_required_unauthorized(self):
+        """Остальные сообщения от неавторизованного сокета - TypeError"""
+        self.assertRaises(TypeError, self.server.process_client_message, {ACTION: MESSAGE}, self.client)
+
+    def test_func_to_log_disabled(self):
+        """При выключенном логировании функция возвращается без обёртки"""
+        def func(value):
+            return value
+        set_call_logging(False)
+        try:
+            self.assertIs(func_to_log(func), func)
+        finally:
+            set_call_logging(True)
+        wrapped = func_to_log(func)
+        self.assertIsNot(wrapped, func)
+        self.assertEqual(wrapped.__name__, 'func')
+        self.assertEqual(wrapped(1), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,408 @@
+import sys
+import os
+import binascii
+import hmac
+import socket
+import selectors
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from server.core import Server, USER_LOGIN, USER_LOGOUT
+from server.cluster import ClusterServer, BUS_LOGIN, WORKER
+from common.utils import MessageBuffer, get_message, send_message
+from common.variables import SLOW_CLIENT_DROP, SLOW_CLIENT_DISCONNECT, SLOW_CLIENT_SPILL, ACTION, MESSAGE, \
+    SENDER, MESSAGE_RECEIVER, TIME, MESSAGE_TEXT, PRESENCE, USER, ACCOUNT_NAME, RESPONSE, DATA, ADD_CONTACT, \
+    REQUEST_ID, ROOM_MESSAGE, ROOM, RESPONSE_400, ERROR, USERS_REQUEST, REVISION, EPOCH, ADDED, LIST_INFO
+
+
+class TestDatabase:
+    """Заглушка хранилища - только очередь сообщений для пользователей не в сети"""
+
+    def __init__(self):
+        self.offline = dict()
+        self.invalidated_rooms = []
+
+    def store_offline_messages(self, username, messages):
+        self.offline.setdefault(username, []).extend(messages)
+        return True
+
+    def store_offline_broadcast(self, usernames, message):
+        for username in usernames:
+            self.offline.setdefault(username, []).append(message)
+
+    def pop_offline_messages(self, username):
+        return self.offline.pop(username, [])
+
+    def users_revision(self):
+        return 5
+
+    def users_epoch(self):
+        return 42
+
+    def users_changes(self, since):
+        return (5, ['test2'], []) if since == 4 else None
+
+    def users_list(self):
+        return [('test1', None), ('test2', None)]
+
+    def check_user(self, username):
+        return username == 'test1'
+
+    def get_hash(self, username):
+        return b'test1_hash'
+
+    def user_login(self, username, ip_address, port):
+        pass
+
+    def user_logout(self, username):
+        pass
+
+    def add_contact(self, user, contact):
+        pass
+
+    def process_message(self, sender, recipient):
+        pass
+
+    def invalidate_room(self, name):
+        self.invalidated_rooms.append(name)
+
+
+class ServerTestCase(unittest.TestCase):
+    """Общие методы тестов сервера: сервер с одним клиентским сокетом"""
+
+    def make_server(self, policy):
+        server = Server('127.0.0.1', 7777, TestDatabase(), high_watermark=64 * 1024, low_watermark=16 * 1024,
+                        slow_client_policy=policy)
+        # Соединение по TCP с маленькими буферами, чтобы очередь быстро заполнялась
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.peer = socket.socket()
+        self.peer.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.peer.connect(listener.getsockname())
+        client = listener.accept()[0]
+        listener.close()
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        client.setblocking(False)
+        self.peer.settimeout(1)
+        server.clients.append(client)
+        server.buffers[client] = MessageBuffer()
+        server.outboxes[client] = bytearray()
+        server.selector.register(client, selectors.EVENT_READ, server.serve_client)
+        self.addCleanup(self.peer.close)
+        self.addCleanup(client.close)
+        return server, client
+
+    def fill(self, server, client):
+        """Отправка клиенту, который не читает, до превышения верхней границы"""
+        frame = b'x' * 1024
+        while client not in server.slow_clients:
+            self.assertTrue(server.write_to_client(client, frame))
+
+
+class TestOutbox(ServerTestCase):
+    """класс юнит-тестов очереди отправки сервера (server/core)"""
+
+    def test_queue_and_flush(self):
+        """Неотправленное ставится в очередь и досылается при готовности к записи"""
+        server, client = self.make_server(SLOW_CLIENT_DROP)
+        server.write_to_client(client, b'x' * 100000)
+        self.assertTrue(server.outboxes[client])
+        self.assertTrue(server.selector.get_key(client).events & selectors.EVENT_WRITE)
+        received = 0
+        while received < 100000:
+            received += len(self.peer.recv(65536))
+            server.write_client(client)
+        self.assertEqual(server.outboxes[client], bytearray())
+        self.assertEqual(server.selector.get_key(client).events, selectors.EVENT_READ)
+
+    def test_drop_policy(self):
+        """Медленному клиенту новые сообщения не ставятся в очередь, чтение приостановлено"""
+        server, client = self.make_server(SLOW_CLIENT_DROP)
+        self.fill(server, client)
+        size = len(server.outboxes[client])
+        self.assertFalse(server.write_to_client(client, b'y' * 10))
+        self.assertEqual(len(server.outboxes[client]), size)
+        self.assertEqual(server.selector.get_key(client).events, selectors.EVENT_WRITE)
+        # Клиент дочитал очередь до нижней границы - снова нормальный
+        while client in server.slow_clients:
+            self.peer.recv(65536)
+            server.write_client(client)
+        self.assertTrue(server.selector.get_key(client).events & selectors.EVENT_READ)
+        self.assertTrue(server.write_to_client(client, b'y' * 10))
+
+    def test_disconnect_policy(self):
+        """При превышении верхней границы клиент отключается"""
+        server, client = self.make_server(SLOW_CLIENT_DISCONNECT)
+        with self.assertRaises(OSError):
+            for _ in range(1000):
+                server.write_to_client(client, b'x' * 1024)
+
+    def test_spill_policy(self):
+        """Сообщения медленному клиенту откладываются и досылаются после разгрузки очереди"""
+        server, client = self.make_server(SLOW_CLIENT_SPILL)
+        server.register_name('test1', client)
+        self.fill(server, client)
+        message = {ACTION: MESSAGE, SENDER: 'test2', MESSAGE_RECEIVER: 'test1', TIME: 1.1, MESSAGE_TEXT: 'spill'}
+        server.process_message(message)
+        self.assertEqual(server.database.offline['test1'], [message])
+        while client in server.slow_clients:
+            self.peer.recv(65536)
+            server.write_client(client)
+        self.assertNotIn('test1', server.database.offline)
+        self.assertTrue(server.outboxes[client].endswith(b'"spill"}'))
+
+
+    def test_closed_in_batch(self):
+        """Клиент, отключённый при обработке той же выборки селектора, пропускается"""
+        server, client = self.make_server(SLOW_CLIENT_DROP)
+        server.write_to_client(client, b'x' * 100000)
+        self.peer.recv(65536)
+        events = server.selector.select(1)
+        self.assertTrue(any(key.fileobj is client and mask & selectors.EVENT_WRITE for key, mask in events))
+        server.close_connection(client)
+        for key, mask in events:
+            key.data(key.fileobj, mask)
+        self.assertNotIn(client, server.outboxes)
+
+
+class TestRequestId(ServerTestCase):
+    """класс юнит-тестов идентификаторов запросов (server/core)"""
+
+    def test_echo(self):
+        """Идентификатор запроса повторяется в ответах 200 и 400, без него ответ прежний"""
+        server, client = self.make_server(SLOW_CLIENT_DROP)
+        server.register_name('test1', client)
+        server.process_client_message({ACTION: ADD_CONTACT, TIME: 1.1, USER: 'test1', ACCOUNT_NAME: 'test2',
+                                       REQUEST_ID: 1}, client)
+        server.process_client_message({ACTION: MESSAGE, SENDER: 'test1', MESSAGE_RECEIVER: 'unknown', TIME: 1.1,
+                                       MESSAGE_TEXT: 'text', REQUEST_ID: 2}, client)
+        server.process_client_message({ACTION: ADD_CONTACT, TIME: 1.1, USER: 'test1', ACCOUNT_NAME: 'test2'}, client)
+        self.assertEqual(get_message(self.peer), {RESPONSE: 200, REQUEST_ID: 1})
+        answer = get_message(self.peer)
+        self.assertEqual((answer[RESPONSE], answer[REQUEST_ID]), (400, 2))
+        self.assertEqual(get_message(self.peer), {RESPONSE: 200})
+        # Общие словари ответов не изменяются обработчиками
+        self.assertEqual(RESPONSE_400, {RESPONSE: 400, ERROR: None})
+
+
+class TestUsersRequest(ServerTestCase):
+    """класс юнит-тестов запроса списка пользователей (server/core)"""
+
+    def users_request(self, revision, epoch):
+        server, client = self.make_server(SLOW_CLIENT_DROP)
+        server.register_name('test1', client)
+        server.process_client_message({ACTION: USERS_REQUEST, TIME: 1.1, ACCOUNT_NAME: 'test1', REVISION: revision,
+                                       EPOCH: epoch}, client)
+        return get_message(self.peer)
+
+    def test_changes(self):
+        """Ревизия той же эпохи - только изменения"""
+        answer = self.users_request(4, 42)
+        self.assertEqual((answer[REVISION], answer[ADDED], answer[EPOCH]), (5, ['test2'], 42))
+        self.assertNotIn(LIST_INFO, answer)
+
+    def test_other_epoch(self):
+        """Ревизия другой эпохи (база сервера пересоздана) - полный список"""
+        answer = self.users_request(4, 7)
+        self.assertEqual((answer[REVISION], answer[LIST_INFO], answer[EPOCH]), (5, ['test1', 'test2'], 42))
+
+
+class TestRooms(ServerTestCase):
+    """класс юнит-тестов рассылки в комнаты (server/core)"""
+
+    def test_room_message(self):
+        """Подключённый участник получает сообщение, остальным оно откладывается"""
+        server, client = self.make_server(SLOW_CLIENT_DROP)
+        server.register_name('test1', client)
+        message = {ACTION: ROOM_MESSAGE, SENDER: 'test2', ROOM: 'room', TIME: 1.1, MESSAGE_TEXT: 'hello'}
+        server.process_room_message(message, ['test1', 'test3', 'test4'])
+        self.assertEqual(get_message(self.peer), message)
+        self.assertEqual(server.database.offline, {'test3': [message], 'test4': [message]})
+
+
+class TestCommands(ServerTestCase):
+    """класс юнит-тестов команд других потоков (server/core)"""
+
+    def test_call_soon(self):
+        """Команда из другого потока выполняется в потоке сервера после пробуждения"""
+        server, client = self.make_server(SLOW_CLIENT_DROP)
+        server.register_name('test1', client)
+        server.init_wakeup()
+        self.addCleanup(server.auth_executor.shutdown)
+        self.addCleanup(server.wakeup_reader.close)
+        self.addCleanup(server.wakeup_writer.close)
+        thread = threading.Thread(target=server.call_soon, args=(server.disconnect_user, 'test1'))
+        thread.start()
+        thread.join()
+        # До обработки пробуждения соединение не тронуто
+        self.assertIn(client, server.buffers)
+        for key, mask in server.selector.select(1):
+            key.data(key.fileobj, mask)
+        self.assertNotIn(client, server.buffers)
+        self.assertFalse(server.user_online('test1'))
+
+    def test_disconnect_user(self):
+        """Отключение удалённого пользователя: событие выхода без отметки в базе"""
+        server, client = self.make_server(SLOW_CLIENT_DROP)
+        server.register_name('test1', client)
+        events = []
+        logouts = []
+        server.add_listener(lambda event, account_name, info: events.append((event, account_name)))
+        server.database.user_logout = logouts.append
+        server.disconnect_user('test1')
+        self.assertEqual(events, [(USER_LOGOUT, 'test1')])
+        self.assertEqual(logouts, [])
+        self.assertNotIn(client, server.buffers)
+
+
+class TestAuth(ServerTestCase):
+    """класс юнит-тестов авторизации без блокировки (server/core)"""
+
+    def setUp(self):
+        self.server, self.client = self.make_server(SLOW_CLIENT_DROP)
+        self.server.init_wakeup()
+        self.addCleanup(self.server.auth_executor.shutdown)
+        self.addCleanup(self.server.wakeup_reader.close)
+        self.addCleanup(self.server.wakeup_writer.close)
+        self.server.process_client_message(
+            {ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: 'test1'}}, self.client)
+        self.challenge = get_message(self.peer)
+
+    def answer(self, passwd_hash):
+        """Ответ на запрос авторизации и ожидание результата проверки"""
+        digest = hmac.new(passwd_hash, self.challenge[DATA].encode('ascii'), 'MD5').digest()
+        send_message(self.peer, {RESPONSE: 511, DATA: binascii.b2a_base64(digest).decode('ascii')})
+        self.server.read_client(self.client)
+        while self.client in self.server.auth_states:
+            for key, mask in self.server.selector.select(1):
+                key.data(key.fileobj, mask)
+        return get_message(self.peer)
+
+    def test_login(self):
+        """Верный ответ - пользователь авторизован"""
+        self.assertEqual(self.challenge[RESPONSE], 511)
+        self.assertIn(self.client, self.server.auth_states)
+        self.assertEqual(self.answer(b'test1_hash')[RESPONSE], 200)
+        self.assertEqual(self.server.client_names[self.client], 'test1')
+
+    def test_login_events(self):
+        """Подписчики получают события входа и выхода пользователя"""
+        events = []
+        self.server.add_listener(lambda event, account_name, info: events.append((event, account_name)))
+        self.answer(b'test1_hash')
+        self.server.remove_client(self.client)
+        self.assertEqual(events, [(USER_LOGIN, 'test1'), (USER_LOGOUT, 'test1')])
+
+    def test_wrong_password(self):
+        """Неверный ответ - отказ и закрытие соединения"""
+        self.assertEqual(self.answer(b'wrong_hash')[RESPONSE], 400)
+        self.assertNotIn(self.client, self.server.buffers)
+
+    def test_reset_during_check(self):
+        """Клиент сбросил соединение, пока ответ проверялся - соединение закрывается, имя не занято"""
+        digest = hmac.new(b'test1_hash', self.challenge[DATA].encode('ascii'), 'MD5').digest()
+        send_message(self.peer, {RESPONSE: 511, DATA: binascii.b2a_base64(digest).decode('ascii')})
+        self.server.read_client(self.client)
+        self.peer.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.peer.close()
+        # Обрабатываем только результат проверки, без события чтения клиентского сокета
+        while self.client in self.server.auth_states:
+            for key, mask in self.server.selector.select(1):
+                if key.fileobj is self.server.wakeup_reader:
+                    key.data(key.fileobj, mask)
+        self.assertNotIn(self.client, self.server.buffers)
+        self.assertFalse(self.server.user_online('test1'))
+
+    def test_timeout(self):
+        """Клиент, не ответивший вовремя, отключается"""
+        self.server.auth_states[self.client].deadline = 0
+        self.server.check_auth_timeouts()
+        self.assertNotIn(self.client, self.server.auth_states)
+        self.assertNotIn(self.client, self.server.buffers)
+
+
+class TestCluster(unittest.TestCase):
+    """класс юнит-тестов шины многопроцессного режима (server/cluster)"""
+
+    def setUp(self):
+        bus_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bus_dir)
+        self.workers = [ClusterServer('127.0.0.1', 7777, TestDatabase(), i, 2, bus_dir) for i in range(2)]
+        for worker in self.workers:
+            self.addCleanup(worker.bus_out.close)
+            self.addCleanup(worker.bus_in.close)
+
+    def deliver(self, worker):
+        """Обработка событий, пришедших процессу worker"""
+        worker.read_bus(worker.bus_in, selectors.EVENT_READ)
+
+    def test_presence(self):
+        """Вход и выход пользователя видны другому процессу"""
+        first, second = self.workers
+        client = socket.socket()
+        self.addCleanup(client.close)
+        first.register_name('test1', client)
+        self.deliver(second)
+        self.assertTrue(second.user_online('test1'))
+        first.unregister_name(client)
+        self.deliver(second)
+        self.assertFalse(second.user_online('test1'))
+
+    def test_mutual_send(self):
+        """Процессы, одновременно заполняющие очереди друг друга, не ждут друг друга до таймаута"""
+        results = []
+
+        def flood(worker):
+            other = 1 - worker.worker_id
+            results.extend(worker.bus_send(other, {ACTION: BUS_LOGIN, ACCOUNT_NAME: f'user{worker.worker_id}_{i}',
+                                                   WORKER: worker.worker_id}) for i in range(200))
+            # Закончивший процесс продолжает принимать события, как в основном цикле
+            while len(results) < 400:
+                self.deliver(worker)
+
+        threads = [threading.Thread(target=flood, args=(worker,)) for worker in self.workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for worker in self.workers:
+            self.deliver(worker)
+        self.assertEqual(results, [True] * 400)
+        self.assertEqual(len(self.workers[0].remote_names), 200)
+        self.assertEqual(len(self.workers[1].remote_names), 200)
+
+    def test_forward_message(self):
+        """Сообщение пользователю другого процесса пересылается через шину"""
+        first, second = self.workers
+        second.remote_names['test1'] = 0
+        message = {ACTION: MESSAGE, SENDER: 'test2', MESSAGE_RECEIVER: 'test1', TIME: 1.1, MESSAGE_TEXT: 'bus'}
+        second.process_message(message)
+        # Получатель уже отключился от первого процесса - сообщение откладывается
+        self.deliver(first)
+        self.assertEqual(first.database.offline['test1'], [message])
+        self.assertEqual(second.database.offline, {})
+
+    def test_room_changed(self):
+        """Изменение состава комнаты сбрасывает её кэш в остальных процессах"""
+        first, second = self.workers
+        first.room_changed('room')
+        self.deliver(second)
+        self.assertEqual(second.database.invalidated_rooms, ['room'])
+        self.assertEqual(first.database.invalidated_rooms, [])
+
+    def test_forward_room_message(self):
+        """Участникам комнаты в другом процессе сообщение пересылается одним событием"""
+        first, second = self.workers
+        second.remote_names.update({'test1': 0, 'test3': 0})
+        message = {ACTION: ROOM_MESSAGE, SENDER: 'test2', ROOM: 'room', TIME: 1.1, MESSAGE_TEXT: 'bus'}
+        self.assertEqual(second.deliver_room_message(message, ['test1', 'test3', 'test4']), ['test4'])
+        self.deliver(first)
+        self.assertEqual(first.database.offline, {'test1': [message], 'test3': [message]})
+
+
+if __name__ == '__main__':
+    unittest.main()
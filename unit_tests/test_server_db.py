@@ -0,0 +1,287 @@
+import sys
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from sqlalchemy import event, select, func
+
+from server.server_db import ServerStorage
+
+
+class TestServerStorage(unittest.TestCase):
+    """класс юнит-тестов хранилища сервера (server/server_db)"""
+
+    @classmethod
+    def setUpClass(cls):
+        # Классические отображения ORM позволяют создать хранилище только
+        # один раз за процесс, поэтому база общая для всех тестов класса,
+        # а каждый тест заводит своих пользователей.
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.database = ServerStorage(os.path.join(cls.tmp_dir, 'test_server.db3'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.database.database_engine.dispose()
+        shutil.rmtree(cls.tmp_dir)
+
+    def setUp(self):
+        # Тестовые пользователи с уникальными для теста именами
+        prefix = self.id().rsplit('.', 1)[-1]
+        self.test1, self.test2, self.test3 = (f'{prefix}_{i}' for i in range(1, 4))
+        for name in (self.test1, self.test2, self.test3):
+            self.database.add_user(name, f'{name}_hash'.encode())
+        # Счётчик SQL запросов к базе
+        self.statements = []
+        event.listen(self.database.database_engine, 'before_cursor_execute', self.count_statement)
+
+    def tearDown(self):
+        event.remove(self.database.database_engine, 'before_cursor_execute', self.count_statement)
+
+    def count_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def stat(self):
+        """Статистика сообщений: имя -> (отправлено, получено)"""
+        return {row[0]: (row[2], row[3]) for row in self.database.message_history()}
+
+    def test_check_user(self):
+        """Проверка существования пользователя без обращения к базе для известных имён"""
+        self.assertTrue(self.database.check_user(self.test1))
+        self.assertFalse(self.database.check_user('unknown'))
+        self.statements.clear()
+        self.assertTrue(self.database.check_user(self.test2))
+        self.assertEqual(self.database.get_hash(self.test2), f'{self.test2}_hash'.encode())
+        self.assertEqual(self.statements, [])
+
+    def test_process_message_batched(self):
+        """Статистика копится в памяти и записывается одним пакетным запросом"""
+        for _ in range(3):
+            self.database.process_message(self.test1, self.test2)
+        self.database.process_message(self.test2, self.test3)
+        self.assertEqual(self.statements, [])
+        # Накопленные счётчики уже видны в статистике
+        self.assertEqual(self.stat()[self.test2], (1, 3))
+        self.statements.clear()
+        self.database.flush_stats()
+        self.assertEqual(len(self.statements), 1)
+        self.assertTrue(self.statements[0].lstrip().upper().startswith('UPDATE'))
+        self.assertEqual(self.stat()[self.test1], (3, 0))
+        self.assertEqual(self.stat()[self.test2], (1, 3))
+        self.assertEqual(self.stat()[self.test3], (0, 1))
+
+    def test_history_during_flush(self):
+        """Статистика, прочитанная во время записи накопленного, не теряет и не удваивает счётчики"""
+        self.database.flush_stats()
+        self.database.process_message(self.test1, self.test2)
+        in_flush = threading.Event()
+
+        def slow_update(conn, cursor, statement, *args):
+            if statement.lstrip().upper().startswith('UPDATE'):
+                in_flush.set()
+                time.sleep(0.2)
+
+        event.listen(self.database.database_engine, 'before_cursor_execute', slow_update)
+        self.addCleanup(event.remove, self.database.database_engine, 'before_cursor_execute', slow_update)
+        thread = threading.Thread(target=self.database.flush_stats)
+        thread.start()
+        try:
+            self.assertTrue(in_flush.wait(5))
+            # Счётчики уже изъяты из памяти, но ещё не зафиксированы в базе
+            self.assertEqual(self.stat()[self.test1], (1, 0))
+        finally:
+            thread.join()
+        self.assertEqual(self.stat()[self.test1], (1, 0))
+
+    def test_flush_by_count(self):
+        """Статистика записывается после stats_flush_messages сообщений"""
+        self.database.flush_stats()
+        self.statements.clear()
+        for _ in range(self.database.stats_flush_messages):
+            self.database.process_message(self.test1, self.test2)
+        self.assertEqual(len(self.statements), 1)
+        self.assertEqual(self.database.pending_stats, {})
+
+    def test_cache_invalidation(self):
+        """Удалённый и заново созданный пользователь не берётся из кэша"""
+        self.database.check_user(self.test3)
+        self.database.remove_user(self.test3)
+        self.assertFalse(self.database.check_user(self.test3))
+        self.database.add_user(self.test3, b'new_hash')
+        self.assertEqual(self.database.get_hash(self.test3), b'new_hash')
+        self.database.process_message(self.test3, self.test1)
+        self.database.flush_stats()
+        self.assertEqual(self.stat()[self.test3], (1, 0))
+
+    def test_contacts(self):
+        """Добавление, повторное добавление и удаление контакта"""
+        self.database.add_contact(self.test1, self.test2)
+        self.database.add_contact(self.test1, self.test2)
+        self.database.add_contact(self.test1, 'unknown')
+        self.assertEqual(self.database.get_contacts(self.test1), [self.test2])
+        self.database.remove_contact(self.test1, self.test2)
+        self.assertEqual(self.database.get_contacts(self.test1), [])
+
+    def test_login_logout(self):
+        """Вход и выход пользователя отражаются в списке активных"""
+        self.database.user_login(self.test1, '127.0.0.1', 7777)
+        self.assertIn(self.test1, [row[0] for row in self.database.active_users_list()])
+        self.database.user_logout(self.test1)
+        self.assertNotIn(self.test1, [row[0] for row in self.database.active_users_list()])
+        self.assertEqual(len(self.database.login_history(self.test1)), 1)
+        # Выход пользователя, удалённого из базы, ничего не делает
+        self.database.remove_user(self.test2)
+        self.database.user_logout(self.test2)
+
+    def test_concurrent_read_write(self):
+        """Чтение из другого потока (как в GUI) идёт параллельно с записью"""
+        errors = []
+        stop = threading.Event()
+
+        def reader():
+            try:
+                while not stop.is_set():
+                    self.database.active_users_list()
+                    self.database.message_history()
+                    self.database.users_list()
+            except Exception as err:
+                errors.append(err)
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        try:
+            for i in range(50):
+                self.database.user_login(self.test1, '127.0.0.1', i)
+                self.database.process_message(self.test1, self.test2)
+                self.database.flush_stats()
+                self.database.user_logout(self.test1)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.stat()[self.test1], (50, 0))
+
+    def test_offline_messages(self):
+        """Сообщения для пользователя не в сети выдаются один раз в порядке поступления"""
+        messages = [{'mess_text': str(i)} for i in range(3)]
+        self.assertTrue(self.database.store_offline_messages(self.test1, messages[:2]))
+        self.assertTrue(self.database.store_offline_messages(self.test1, messages[2:]))
+        self.assertFalse(self.database.store_offline_messages('unknown', messages))
+        self.assertEqual(self.database.pop_offline_messages(self.test1), messages)
+        self.assertEqual(self.database.pop_offline_messages(self.test1), [])
+
+    def test_offline_messages_limits(self):
+        """Сверх лимита вытесняются старые сообщения, просроченные не выдаются"""
+        limit, ttl = self.database.offline_limit, self.database.offline_ttl
+        try:
+            self.database.offline_limit = 3
+            messages = [{'mess_text': str(i)} for i in range(5)]
+            self.database.store_offline_messages(self.test1, messages)
+            self.assertEqual(self.database.pop_offline_messages(self.test1), messages[2:])
+            self.database.offline_ttl = -1
+            self.database.store_offline_messages(self.test1, messages)
+            self.assertEqual(self.database.pop_offline_messages(self.test1), [])
+            # Рассылка в комнату не удаляет лишнее сразу - лимит при выдаче и при запуске
+            self.database.offline_ttl = ttl
+            for message in messages:
+                self.database.store_offline_broadcast([self.test1, self.test2], message)
+            self.assertEqual(self.database.pop_offline_messages(self.test1), messages[2:])
+            self.database.trim_offline_messages()
+            table = self.database.offline_table
+            self.assertEqual(self.database.session.execute(
+                select(func.count()).select_from(table)).scalar(), 3)
+            self.assertEqual(self.database.pop_offline_messages(self.test2), messages[2:])
+        finally:
+            self.database.offline_limit, self.database.offline_ttl = limit, ttl
+
+    def test_users_changes(self):
+        """Изменения списка пользователей выдаются с заданной ревизии"""
+        since = self.database.users_revision()
+        self.assertEqual(self.database.users_changes(since), (since, [], []))
+        self.assertIsNone(self.database.users_changes(0))
+        self.assertIsNone(self.database.users_changes(since + 1))
+        self.database.add_user(f'{self.test1}_new', b'hash')
+        self.database.remove_user(self.test2)
+        self.database.add_user(f'{self.test1}_tmp', b'hash')
+        self.database.remove_user(f'{self.test1}_tmp')
+        revision, added, removed = self.database.users_changes(since)
+        self.assertEqual(revision, since + 4)
+        self.assertEqual(added, [f'{self.test1}_new'])
+        self.assertEqual(sorted(removed), sorted([self.test2, f'{self.test1}_tmp']))
+
+    def test_epoch(self):
+        """Эпоха базы создаётся один раз и хранится в базе"""
+        epoch = self.database.users_epoch()
+        self.assertTrue(epoch)
+        with self.database.database_engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql('SELECT epoch FROM Server_info').all(), [(epoch,)])
+
+    def test_rooms(self):
+        """Создание комнаты, вступление, выход и удаление участника"""
+        room = f'{self.test1}_room'
+        self.assertTrue(self.database.create_room(room, self.test1))
+        self.assertFalse(self.database.create_room(room, self.test2))
+        self.assertFalse(self.database.join_room('unknown', self.test2))
+        self.assertEqual(self.database.room_members(room), (self.test1,))
+        self.assertTrue(self.database.join_room(room, self.test2))
+        self.assertTrue(self.database.join_room(room, self.test3))
+        self.assertTrue(self.database.join_room(room, self.test3))
+        self.assertEqual(sorted(self.database.room_members(room)), [self.test1, self.test2, self.test3])
+        self.assertTrue(self.database.leave_room(room, self.test2))
+        # Кэш, сброшенный по событию другого процесса, читается из базы заново
+        self.database.room_members(room)
+        self.database.invalidate_room(room)
+        self.assertNotIn(room, self.database.rooms_cache)
+        self.database.remove_user(self.test3)
+        self.assertEqual(self.database.room_members(room), (self.test1,))
+        self.assertIsNone(self.database.room_members('unknown'))
+
+    def test_room_message(self):
+        """Сообщение в комнату: статистика и очередь для участников не в сети пакетом"""
+        self.database.flush_stats()
+        message = {'mess_text': 'room'}
+        self.statements.clear()
+        self.database.process_room_message(self.test1, [self.test2, self.test3])
+        self.database.store_offline_broadcast([self.test2, self.test3, 'unknown'], message)
+        # Вставка одним пакетным запросом, лишнее удаляется при выдаче
+        self.assertEqual(len([s for s in self.statements if not s.lstrip().upper().startswith('SELECT')]), 1)
+        self.assertEqual(self.stat()[self.test1], (1, 0))
+        self.assertEqual(self.stat()[self.test3], (0, 1))
+        self.assertEqual(self.database.pop_offline_messages(self.test2), [message])
+        self.assertEqual(self.database.pop_offline_messages(self.test3), [message])
+
+    def test_schema_tuning(self):
+        """Индексы созданы, настройки SQLite применены"""
+        with self.database.database_engine.connect() as conn:
+            indexes = {row[0] for row in conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index'")}
+            journal_mode = conn.exec_driver_sql('PRAGMA journal_mode').scalar()
+            plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN SELECT * FROM History WHERE user = 1').all()
+        self.assertTrue({'ix_Contacts_user_contact', 'ix_Contacts_contact', 'ix_History_user',
+                         'ix_Login_history_name'} <= indexes)
+        self.assertEqual(journal_mode.lower(), 'wal')
+        self.assertIn('ix_History_user', str(plan))
+
+    def test_unique_index_duplicates(self):
+        """В базе прежней версии повторы удаляются перед созданием уникального индекса"""
+        self.database.add_contact(self.test1, self.test2)
+        table = self.database.contacts_table
+        user, contact = self.database.user_record(self.test1)[0], self.database.user_record(self.test2)[0]
+        with self.database.database_engine.begin() as conn:
+            conn.exec_driver_sql('DROP INDEX ix_Contacts_user_contact')
+            conn.execute(table.insert(), [{'user': user, 'contact': contact}] * 2)
+        self.database.create_indexes()
+        self.assertEqual(self.database.get_contacts(self.test1), [self.test2])
+        self.database.add_contact(self.test1, self.test2)
+        self.assertEqual(self.database.get_contacts(self.test1), [self.test2])
+        with self.database.database_engine.connect() as conn:
+            self.assertIsNotNone(conn.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE name = 'ix_Contacts_user_contact'").scalar())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import sys
+import os
+import socket
+import threading
+import unittest
+from importlib.util import find_spec
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from common.utils import get_message, send_message
+from common.variables import ACTION, RESPONSE, ERROR, MESSAGE, SENDER, MESSAGE_RECEIVER, TIME, MESSAGE_TEXT, \
+    REQUEST_ID
+
+# Транспорт клиента - QObject с сигналами, без PyQt5 его не создать
+if find_spec('PyQt5') is not None:
+    from PyQt5.QtCore import Qt
+    from client.transport import ClientTransport
+
+    class SocketTransport(ClientTransport):
+        """Транспорт поверх готового сокета, без подключения, авторизации и загрузки списков"""
+        sock = None
+
+        def connection_init(self, port, ip):
+            self.transport = self.sock
+
+        def user_list_update(self):
+            pass
+
+        def contacts_list_update(self):
+            pass
+
+
+@unittest.skipUnless(find_spec('PyQt5'), 'требуется PyQt5')
+class TestClientTransport(unittest.TestCase):
+    """класс юнит-тестов приёма сообщений и сопоставления ответов (client/transport)"""
+
+    def setUp(self):
+        client, self.server = socket.socketpair()
+        self.server.settimeout(5)
+        SocketTransport.sock = client
+        self.transport = SocketTransport(0, '', None, 'test1', '')
+        self.addCleanup(self.server.close)
+        self.addCleanup(client.close)
+
+    def start(self):
+        """Запуск потока транспорта, по окончании теста - его завершение"""
+        self.transport.start()
+        self.addCleanup(self.transport.join, 5)
+        self.addCleanup(self.transport.transport_shutdown)
+
+    def request(self, text):
+        return {ACTION: 'test', TIME: 1.1, MESSAGE_TEXT: text}
+
+    def test_fifo_without_ids(self):
+        """Ответы без идентификатора (сервер прежней версии) сопоставляются запросам по порядку"""
+        self.start()
+        first = self.transport.send_request(self.request('first'))
+        second = self.transport.send_request(self.request('second'))
+        self.assertEqual([get_message(self.server)[REQUEST_ID] for _ in range(2)], [1, 2])
+        send_message(self.server, {RESPONSE: 200})
+        send_message(self.server, {RESPONSE: 400, ERROR: 'second'})
+        self.assertEqual(first.result(5), {RESPONSE: 200})
+        self.assertEqual(second.result(5), {RESPONSE: 400, ERROR: 'second'})
+        self.assertEqual(self.transport.pending, {})
+
+    def test_pushed_before_start(self):
+        """Сообщение, пришедшее в ожидании ответа до запуска потока, обрабатывается после запуска"""
+        received = []
+        delivered = threading.Event()
+        # Цикла событий Qt в тесте нет - слоты вызываются прямо в потоке транспорта
+        self.transport.new_message_sig.connect(lambda message: (received.append(message), delivered.set()),
+                                               Qt.DirectConnection)
+        message = {ACTION: MESSAGE, SENDER: 'test2', MESSAGE_RECEIVER: 'test1', TIME: 1.1, MESSAGE_TEXT: 'hi'}
+        send_message(self.server, message)
+        send_message(self.server, {RESPONSE: 200, REQUEST_ID: 1})
+        self.assertEqual(self.transport.request(self.request('request')), {RESPONSE: 200, REQUEST_ID: 1})
+        self.assertEqual(received, [])
+        self.start()
+        self.assertTrue(delivered.wait(5))
+        self.assertEqual(received, [message])
+
+    def test_timeout(self):
+        """Запрос без ответа убирается из таблицы, следующий ответ без идентификатора - следующему запросу"""
+        self.transport.transport.settimeout(0.1)
+        with self.assertRaises(TimeoutError):
+            self.transport.request(self.request('lost'))
+        self.assertEqual(self.transport.pending, {})
+        send_message(self.server, {RESPONSE: 200})
+        self.transport.transport.settimeout(5)
+        self.assertEqual(self.transport.request(self.request('next')), {RESPONSE: 200})
+
+    def test_connection_lost(self):
+        """При закрытии соединения сервером ожидающие запросы завершаются ConnectionResetError"""
+        lost = threading.Event()
+        self.transport.connection_lost_sig.connect(lost.set, Qt.DirectConnection)
+        self.start()
+        future = self.transport.send_request(self.request('request'))
+        self.server.close()
+        self.assertIsInstance(future.exception(5), ConnectionResetError)
+        self.assertTrue(lost.wait(5))
+        self.assertEqual(self.transport.pending, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
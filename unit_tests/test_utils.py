@@ -5,8 +5,17 @@ import json
 
 sys.path.insert(0, os.path.join(os.getcwd(), '..'))
 
-from common.variables import RESPONSE, ERROR, USER, ACCOUNT_NAME, TIME, ACTION, PRESENCE, ENCODING
-from common.utils import get_message, send_message
+from common.variables import RESPONSE, ERROR, USER, ACCOUNT_NAME, TIME, ACTION, PRESENCE, ENCODING, \
+    MAX_MESSAGE_LENGTH, LIST_INFO
+from common.utils import get_message, send_message, MessageBuffer, HEADER, encode_message
+from common.errors import IncorrectDataRecivedError
+from common.codecs import AVAILABLE_CODECS, JsonCodec, choose_codec
+
+
+def make_frame(message):
+    """Кодирование сообщения в кадр: заголовок (длина, кодек json) + JSON"""
+    encoded = json.dumps(message).encode(ENCODING)
+    return HEADER.pack(len(encoded), JsonCodec.code) + encoded
 
 
 class TestSocket:
@@ -18,21 +27,21 @@ class TestSocket:
         self.test_message = test_message
         self.encoded_message = None
         self.sent_message = None
+        self.received = make_frame(test_message)
 
-    def send(self, sent_message):
+    def sendall(self, sent_message):
         """Тестовый метод отправки, он корректно кодирует сообщение (self.encoded_message),
         а так-же сохраняет результат  работы тестируемой функции send() (message_to_send ->self.sent_message) .
         """
-        json_test_message = json.dumps(self.test_message)
         # кодируем сообщение
-        self.encoded_message = json_test_message.encode(ENCODING)
+        self.encoded_message = make_frame(self.test_message)
         # здесь сохраняем то, что отправлено в сокет тестируемой функцией
         self.sent_message = sent_message
 
     def recv(self, max_len):
-        """Получаем данные из сокета"""
-        json_test_message = json.dumps(self.test_message)
-        return json_test_message.encode(ENCODING)
+        """Получаем данные из сокета (не более max_len байт за вызов)"""
+        data, self.received = self.received[:max_len], self.received[max_len:]
+        return data
 
 
 class TestSocket_resv_no_coding:
@@ -116,5 +125,53 @@ class TestUtils(unittest.TestCase):
         self.assertRaises(ValueError, get_message, test_sock_non_coding_msg)
 
 
+class TestMessageBuffer(unittest.TestCase):
+    """класс юнит-тестов буфера приёма кадров (common/utils.MessageBuffer)"""
+    test_msg_ok = {RESPONSE: 200}
+    test_msg_big = {RESPONSE: 202, LIST_INFO: [f'user_{i}' for i in range(1000)]}
+
+    def test_coalesced_frames(self):
+        """Два склеенных кадра разбираются за одно чтение"""
+        buffer = MessageBuffer()
+        data = make_frame(self.test_msg_ok) + make_frame(self.test_msg_big)
+        self.assertEqual(buffer.feed(data), [self.test_msg_ok, self.test_msg_big])
+
+    def test_split_frame(self):
+        """Кадр, пришедший по частям, возвращается только целиком"""
+        buffer = MessageBuffer()
+        data = make_frame(self.test_msg_big)
+        self.assertEqual(buffer.feed(data[:2]), [])
+        self.assertEqual(buffer.feed(data[2:1500]), [])
+        self.assertEqual(buffer.feed(data[1500:] + make_frame(self.test_msg_ok)[:3]), [self.test_msg_big])
+        self.assertEqual(buffer.feed(make_frame(self.test_msg_ok)[3:]), [self.test_msg_ok])
+
+    def test_too_long_frame(self):
+        """Кадр с длиной больше допустимой вызывает исключение"""
+        buffer = MessageBuffer()
+        self.assertRaises(IncorrectDataRecivedError, buffer.feed, HEADER.pack(MAX_MESSAGE_LENGTH + 1, 0))
+
+    def test_unknown_codec(self):
+        """Кадр с неизвестным номером кодека вызывает исключение"""
+        buffer = MessageBuffer()
+        self.assertRaises(IncorrectDataRecivedError, buffer.feed, HEADER.pack(2, 255) + b'{}')
+
+    def test_codecs(self):
+        """Кадры разных кодеков в одном потоке декодируются по заголовку"""
+        buffer = MessageBuffer()
+        data = b''.join(encode_message(self.test_msg_big, codec) for codec in AVAILABLE_CODECS)
+        self.assertEqual(buffer.feed(data), [self.test_msg_big] * len(AVAILABLE_CODECS))
+
+    def test_choose_codec(self):
+        """Выбор кодека: неизвестные и отсутствующие списки дают json"""
+        self.assertIs(choose_codec(['xml', 'json']), JsonCodec)
+        self.assertIs(choose_codec(None), JsonCodec)
+        self.assertIs(choose_codec([codec.name for codec in AVAILABLE_CODECS]), AVAILABLE_CODECS[0])
+
+    def test_get_message_big(self):
+        """Сообщение больше размера одного чтения принимается целиком"""
+        test_socket = TestSocket(self.test_msg_big)
+        self.assertEqual(get_message(test_socket), self.test_msg_big)
+
+
 if __name__ == '__main__':
     unittest.main()